@@ -0,0 +1,75 @@
+'''
+Startup benchmark for the analysis path of the scripts.
+
+Each module is imported in a fresh python process, the best time of a few 
+repeats is compared to its budget, and the modules that were loaded are 
+checked for the heavy toolkits, which only the functions that need them may
+import. Exits with status 1 if any module is over budget or loads a toolkit.
+
+Run from the repository root with the environment created from openfe.yaml
+	python benchmarks/bench_import_time.py
+'''
+
+import subprocess
+import sys
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent / 'scripts'
+
+# import time budget of each module (s), generous enough for a cold laptop
+IMPORT_BUDGETS = {
+	'charge_analysis': 0.5,
+	'charge_store': 0.5,
+	'charge_exchange': 0.5,
+	'run_manifest': 0.5,
+	'charge_cache': 0.5,
+	'charging': 0.5,
+	'tracing': 0.5,
+	'conformers': 1.5,
+	'network': 0.5,
+	'utils': 1.5,
+	'calculate_bond_dq': 2.0,
+}
+
+# top level packages that must not be loaded just by importing the modules
+HEAVY_PACKAGES = ['openfe', 'gufe', 'openeye', 'openmm', 'openff', 'torch', 'dgl']
+
+NUM_REPEATS = 3
+
+# prints the import time and the loaded heavy packages as "seconds pkg1,pkg2"
+_IMPORT_SNIPPET = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = sorted({{m.split('.')[0] for m in sys.modules}} & set({heavy!r}))
+print(elapsed, ','.join(loaded))
+'''
+
+
+def time_import(module):
+	''' returns the time (s) to import module in a fresh python process and the
+		list of HEAVY_PACKAGES it loaded
+	'''
+	result = subprocess.run(
+		[sys.executable, '-c', _IMPORT_SNIPPET.format(module=module, heavy=HEAVY_PACKAGES)],
+		cwd=SCRIPTS_DIR, capture_output=True, text=True, check=True,
+	)
+	elapsed, loaded = result.stdout.split('\n')[-2].split(' ')
+	return float(elapsed), [pkg for pkg in loaded.split(',') if pkg]
+
+
+if __name__ == "__main__":
+
+	failed = False
+	print(f"{'module':<20}{'time (s)':>10}{'budget (s)':>12}  heavy packages loaded")
+	for module, budget in IMPORT_BUDGETS.items():
+		timings = [time_import(module) for _ in range(NUM_REPEATS)]
+		elapsed = min(t for t, _ in timings)
+		loaded = timings[0][1]
+
+		over = elapsed > budget or loaded
+		failed = failed or over
+		print(f"{module:<20}{elapsed:>10.3f}{budget:>12.2f}  {','.join(loaded) or '-'}{'  FAIL' if over else ''}")
+
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,76 @@
+'''
+Regression check of the bond delta q table of calculate_bond_dq.py.
+
+The table computed by charge_analysis.get_bond_dq_table from the example
+charges of lig_206 (examples/openeye_am1bcc_lig_206.csv) is compared to the
+example bond delta q table (examples/openeye_am1bcc_lig_206_dq.csv). The
+atom indices and atomic numbers must match exactly. The bond delta q values
+and their statistics must match to within ATOL, because summing in a
+different order can change the last bit of a float.
+Exits with status 1 if they do not.
+
+Run from the repository root with the environment created from openfe.yaml
+	python benchmarks/check_bond_dq.py
+'''
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from rdkit import Chem
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR / 'scripts'))
+
+from charge_analysis import get_bond_dq_table, get_charge_matrix
+
+SDF_FILE = REPO_DIR / 'molecules' / 'PLB_simulation_all.sdf'
+MOLECULE = 'lig_206'
+CHARGES_CSV = REPO_DIR / 'examples' / 'openeye_am1bcc_lig_206.csv'
+DQ_CSV = REPO_DIR / 'examples' / 'openeye_am1bcc_lig_206_dq.csv'
+
+# largest difference allowed between the computed and example values (e)
+ATOL = 1e-12
+
+INTEGER_COLUMNS = ['idx', 'a1', 'a2', 'atmnum1', 'atmnum2']
+
+
+def load_mol(sdf_file, name):
+	for rdmol in Chem.SDMolSupplier(str(sdf_file), removeHs=False):
+		if rdmol is not None and rdmol.GetProp('_Name') == name:
+			return rdmol
+	raise KeyError(f'{name} is not in {sdf_file}')
+
+def compare_tables(computed, expected, atol=ATOL):
+	''' returns a list of the differences between the computed and expected
+		bond delta q DataFrames, empty if they match
+	'''
+	if list(computed.columns) != list(expected.columns):
+		return [f'columns {list(computed.columns)} != {list(expected.columns)}']
+	if len(computed) != len(expected):
+		return [f'{len(computed)} bonds != {len(expected)} bonds']
+
+	errors = []
+	for column in computed.columns:
+		values, expected_values = computed[column].to_numpy(), expected[column].to_numpy()
+		if column in INTEGER_COLUMNS:
+			mismatched = np.flatnonzero(values != expected_values)
+		else:
+			mismatched = np.flatnonzero(~np.isclose(values, expected_values, rtol=0, atol=atol))
+		if len(mismatched):
+			errors.append(f'{column}: {len(mismatched)} bonds differ, first at bond {mismatched[0]}')
+	return errors
+
+
+if __name__ == "__main__":
+	rdmol = load_mol(SDF_FILE, MOLECULE)
+	charge_matrix = get_charge_matrix(pd.read_csv(CHARGES_CSV))
+	header, rows = get_bond_dq_table(rdmol, charge_matrix)
+
+	errors = compare_tables(pd.DataFrame(list(rows), columns=header), pd.read_csv(DQ_CSV))
+	for error in errors:
+		print(f"FAIL {error}")
+	if errors:
+		sys.exit(1)
+	print(f"bond dq of {MOLECULE} matches {DQ_CSV.name} to within {ATOL}")
@@ -0,0 +1,94 @@
+'''
+Check that the compact export of network_export.py is lossless.
+
+For the first molecules of molecules/PLB_simulation_subset.sdf, a ligand with
+arbitrary partial charges is made into a transformation by
+create_transformations and written in the compact format, with
+export_transformations and with export_transformation, using orjson for the
+deltas if it is installed and json otherwise. Each Transformation rebuilt by
+load_transformation, and each ahfe.json written by materialize, must have the
+same gufe key as the original.
+Exits with status 1 if one does not, skipped if openfe is not installed.
+
+Run from the repository root with the environment created from openfe.yaml
+	python benchmarks/check_compact_export.py
+'''
+
+import importlib.util
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from rdkit import Chem
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR / 'scripts'))
+
+SDF_FILE = REPO_DIR / 'molecules' / 'PLB_simulation_subset.sdf'
+NUM_MOLECULES = 3
+SEED = 42
+
+
+def get_charged_ligands(sdf_file, num_molecules):
+	''' returns SmallMoleculeComponents of the first num_molecules molecules of
+		sdf_file with random partial charges, which use every digit of a float
+	'''
+	import openfe
+	from openff.toolkit import Molecule
+	from openff.units import unit
+
+	rng = np.random.default_rng(SEED)
+	ligands = []
+	for rdmol in list(Chem.SDMolSupplier(str(sdf_file), removeHs=False))[:num_molecules]:
+		offmol = Molecule.from_rdkit(rdmol, allow_undefined_stereo=True)
+		offmol.partial_charges = rng.normal(0, 0.3, offmol.n_atoms) * unit.elementary_charge
+		ligands.append(openfe.SmallMoleculeComponent.from_openff(offmol))
+	return ligands
+
+def check_round_trip(transformations, directory):
+	''' returns a list of the transformations that do not come back the same
+		from the compact files written to directory
+	'''
+	import gufe
+	import network_export
+
+	outdirs = [directory / 'batch' / str(i) for i in range(len(transformations))]
+	network_export.export_transformations(transformations, outdirs, directory)
+	for i, transformation in enumerate(transformations):
+		outdirs.append(directory / 'single' / str(i))
+		network_export.export_transformation(transformation, outdirs[-1], directory)
+
+	errors = []
+	for outdir, transformation in zip(outdirs, transformations * 2):
+		delta_path = outdir / network_export.DELTA_FILE
+		if network_export.load_transformation(delta_path).key != transformation.key:
+			errors.append(f'{delta_path}: load_transformation changed the key of {transformation.name}')
+		full_path = network_export.materialize(delta_path)
+		if gufe.Transformation.load(full_path).key != transformation.key:
+			errors.append(f'{full_path}: materialize changed the key of {transformation.name}')
+	return errors
+
+
+if __name__ == "__main__":
+	if importlib.util.find_spec('openfe') is None:
+		print("skipped: openfe is not installed")
+		sys.exit(0)
+
+	import network_export
+	from network import create_transformations, get_ahfe_settings
+
+	transformations = create_transformations(get_ahfe_settings(None), get_charged_ligands(SDF_FILE, NUM_MOLECULES))
+
+	encoders = ['orjson', 'json'] if network_export.ORJSON_EXISTS else ['json']
+	errors = []
+	for encoder in encoders:
+		network_export.ORJSON_EXISTS = encoder == 'orjson'
+		with tempfile.TemporaryDirectory() as directory:
+			errors += [f'{encoder} {error}' for error in check_round_trip(transformations, Path(directory))]
+
+	for error in errors:
+		print(f"FAIL {error}")
+	if errors:
+		sys.exit(1)
+	print(f"{len(transformations)} transformations exported losslessly with {' and '.join(encoders)}")
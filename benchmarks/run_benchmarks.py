@@ -0,0 +1,225 @@
+'''
+Benchmark suite of the charging pipeline.
+
+Times, on fixed inputs from molecules/,
+	* conformers 	get_mols_from_random_confs with 1, 50 and 500 conformers
+	* charging 		gen_charges_offmol with AmberTools AM1-BCC, per molecule size
+	* bond_dq 		the bond delta q table and csv of calculate_bond_dq.py
+	* network 		create_network and dumping every transformation to json
+
+Every result is appended as one JSON record per line to the history file
+(benchmarks/results/history.jsonl by default) along with the git commit, host
+and python version, and compared to the previous result of the same benchmark
+on the same host. Benchmarks whose toolkits are not installed are skipped.
+
+Run from the repository root with the environment created from openfe.yaml
+	python benchmarks/run_benchmarks.py
+	python benchmarks/run_benchmarks.py --quick --filter bond_dq
+Exits with status 1 if a benchmark is slower than the previous result by more
+than --threshold.
+'''
+
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR / 'scripts'))
+
+from rdkit import Chem
+
+from charge_analysis import get_bond_dq_table, write_table_csv
+
+SUBSET_SDF = REPO_DIR / 'molecules' / 'PLB_simulation_subset.sdf'
+ALL_SDF = REPO_DIR / 'molecules' / 'PLB_simulation_all.sdf'
+HISTORY_FILE = REPO_DIR / 'benchmarks' / 'results' / 'history.jsonl'
+
+SEED = 42
+CONFORMER_COUNTS = [1, 50, 500]
+NUM_CHARGE_SETS = 50
+
+
+class BenchmarkSkipped(Exception):
+	''' raised by a benchmark's setup when a toolkit it needs is not available
+	'''
+
+
+def load_mols(sdf_file):
+	return [mol for mol in Chem.SDMolSupplier(str(sdf_file), removeHs=False)]
+
+def _require(module):
+	try:
+		__import__(module)
+	except ImportError:
+		raise BenchmarkSkipped(f'{module} is not installed')
+
+def bench_conformers(rdmols):
+	''' yields (name, params, function) timing the embedding and splitting of
+		random conformers of the first molecule
+	'''
+	_require('openff.toolkit')
+	from conformers import get_mols_from_random_confs
+
+	rdmol = rdmols[0]
+	for numconfs in CONFORMER_COUNTS:
+		params = {'molecule': rdmol.GetProp('_Name'), 'n_atoms': rdmol.GetNumAtoms(), 'num_confs': numconfs}
+		yield 'conformers', params, lambda numconfs=numconfs: get_mols_from_random_confs(rdmol, numconfs, SEED)
+
+def bench_charging(rdmols):
+	''' yields (name, params, function) timing AmberTools AM1-BCC charging of a
+		single conformer of each molecule
+	'''
+	_require('openff.toolkit')
+	from openff.toolkit import Molecule
+	from charging import check_provided_charge_type, get_toolkit_wrapper, gen_charges_offmol
+	from conformers import get_mols_from_random_confs
+
+	if not check_provided_charge_type('ambertools', 'am1bcc'):
+		raise BenchmarkSkipped('AmberTools is not available')
+	toolkit_wrapper = get_toolkit_wrapper('ambertools')
+
+	for rdmol in rdmols:
+		_, rdmols_by_conf = get_mols_from_random_confs(rdmol, 1, SEED)
+		offmol = Molecule.from_rdkit(rdmols_by_conf[0])
+		params = {'molecule': rdmol.GetProp('_Name'), 'n_atoms': rdmol.GetNumAtoms()}
+		yield 'charging', params, lambda offmol=offmol: gen_charges_offmol(toolkit_wrapper, 'am1bcc', Molecule(offmol))
+
+def bench_bond_dq(rdmols):
+	''' yields (name, params, function) timing the bond delta q table and csv of
+		every molecule from a fixed random atoms x sets charge matrix
+	'''
+	rng = np.random.default_rng(SEED)
+	charge_matrices = [rng.normal(0, 0.3, (rdmol.GetNumAtoms(), NUM_CHARGE_SETS)) for rdmol in rdmols]
+	outdir = Path(tempfile.mkdtemp(prefix='bench_bond_dq_'))
+
+	def run():
+		for rdmol, charge_matrix in zip(rdmols, charge_matrices):
+			header, rows = get_bond_dq_table(rdmol, charge_matrix)
+			write_table_csv(outdir / f"{rdmol.GetProp('_Name')}_dq.csv", header, rows)
+
+	params = {'num_molecules': len(rdmols), 'num_charge_sets': NUM_CHARGE_SETS}
+	yield 'bond_dq', params, run
+
+def bench_network(rdmols):
+	''' yields (name, params, function) timing the creation of the AHFE network
+		of every molecule and dumping each transformation to json
+	'''
+	_require('openfe')
+	import openfe
+	from openff.toolkit import Molecule
+	from network import get_ahfe_settings, create_network
+
+	ligands = []
+	for rdmol in rdmols:
+		offmol = Molecule.from_rdkit(rdmol)
+		offmol.assign_partial_charges('formal_charge')
+		ligands.append(openfe.SmallMoleculeComponent.from_openff(offmol))
+	outdir = Path(tempfile.mkdtemp(prefix='bench_network_'))
+
+	def run():
+		network = create_network(get_ahfe_settings(), ligands)
+		for i, transformation in enumerate(network.edges):
+			transformation.dump(outdir / f'{i}.json')
+
+	yield 'network', {'num_molecules': len(rdmols)}, run
+
+# benchmark name and the function yielding its cases
+BENCHMARKS = {
+	'conformers': bench_conformers,
+	'charging': bench_charging,
+	'bond_dq': bench_bond_dq,
+	'network': bench_network,
+}
+
+def time_function(function, repeat):
+	''' returns the min, median and mean time (s) of repeat calls of function,
+		after one untimed call to warm up caches and lazy imports
+	'''
+	function()
+	times = timeit.Timer(function).repeat(repeat=repeat, number=1)
+	return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times), 'repeat': repeat}
+
+def get_run_info():
+	''' returns the commit, host and python version recorded with each result
+	'''
+	try:
+		commit = subprocess.run(
+			['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True,
+		).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		commit = None
+	return {
+		'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		'commit': commit,
+		'host': platform.node(),
+		'machine': platform.machine(),
+		'python': platform.python_version(),
+	}
+
+def load_previous(history_file, host):
+	''' returns the last recorded result of each (name, params) on host
+	'''
+	previous = {}
+	if not Path(history_file).exists():
+		return previous
+	with open(history_file) as f:
+		for line in f:
+			record = json.loads(line)
+			if record['host'] == host:
+				previous[(record['name'], json.dumps(record['params'], sort_keys=True))] = record
+	return previous
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--filter', nargs='*', choices=list(BENCHMARKS), help='benchmarks to run, all of them by default')
+	parser.add_argument('--quick', action='store_true', help=f'use {SUBSET_SDF.name} for every benchmark')
+	parser.add_argument('--repeat', type=int, default=5, help='number of timed calls of each benchmark')
+	parser.add_argument('--history', default=HISTORY_FILE, type=Path, help='JSON lines file the results are appended to')
+	parser.add_argument('--threshold', type=float, default=1.2, help='ratio to the previous min time reported as a regression')
+	args = parser.parse_args()
+
+	subset_mols = load_mols(SUBSET_SDF)
+	all_mols = subset_mols if args.quick else load_mols(ALL_SDF)
+	# inputs of each benchmark, the slow per conformer and per charge
+	# benchmarks always use the subset
+	inputs = {'conformers': subset_mols, 'charging': subset_mols, 'bond_dq': all_mols, 'network': all_mols}
+
+	run_info = get_run_info()
+	previous = load_previous(args.history, run_info['host'])
+	args.history.parent.mkdir(exist_ok=True, parents=True)
+
+	regressions = []
+	for name in args.filter or BENCHMARKS:
+		try:
+			cases = list(BENCHMARKS[name](inputs[name]))
+		except BenchmarkSkipped as e:
+			print(f"{name:<12} skipped: {e}")
+			continue
+
+		for bench_name, params, function in cases:
+			timing = time_function(function, args.repeat)
+			record = {**run_info, 'name': bench_name, 'params': params, **timing}
+			with open(args.history, 'a') as f:
+				f.write(json.dumps(record) + '\n')
+
+			last = previous.get((bench_name, json.dumps(params, sort_keys=True)))
+			ratio = timing['min'] / last['min'] if last is not None else None
+			flag = ''
+			if ratio is not None and ratio > args.threshold:
+				regressions.append((bench_name, params, ratio))
+				flag = '  REGRESSION'
+			ratio_str = f'{ratio:6.2f}x' if ratio is not None else '      -'
+			print(f"{bench_name:<12} {json.dumps(params):<70} {timing['min']:10.4f} s {ratio_str}{flag}")
+
+	sys.exit(1 if regressions else 0)
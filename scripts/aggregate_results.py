@@ -0,0 +1,238 @@
+'''
+Script to collect the hydration free energies computed by `openfe quickrun`
+across a simulations tree laid out like ../simulations/start_files
+	{MoleculeDatabase}_{ChargeMethod}[_{hardware}]/{molecule}/{replicate}/output/output.json
+
+The tree is scanned in parallel and every output.json parsed is saved in an
+index keyed by its path, modification time and size, so a re-run only parses
+results that are new or have changed. An output.json that cannot be read, e.g.
+one still being written, counts as a failed replicate until it changes.
+Three tables are written:
+	* {output_prefix}_replicates 	one row per replicate with its DG and uncertainty
+	* {output_prefix}_molecules 	the mean, stdev, var and range of DG across
+									the replicates of each molecule and method
+	* {output_prefix}_methods 		the mean and max across the molecules of a
+									method of the stdev and range across replicates
+as parquet files if pyarrow is installed, otherwise as HDF5 tables.
+
+Instructions:
+	* Run with conda environment created from openfe.yaml
+	* modify the variables below within the EDIT THESE VARIABLES blocks below
+'''
+
+import importlib.util
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from charge_analysis import STATISTICS, get_statistics
+
+PYARROW_EXISTS = importlib.util.find_spec('pyarrow') is not None
+
+OUTPUT_FILE = Path('output') / 'output.json'
+
+KJ_PER_KCAL = 4.184
+
+
+def _scan_dir(directory):
+	''' returns the (path, mtime_ns, size) of every output.json under directory
+	'''
+	found = []
+	for dirpath, dirnames, filenames in os.walk(directory):
+		if 'output.json' in filenames and Path(dirpath).name == OUTPUT_FILE.parent.name:
+			stat = os.stat(os.path.join(dirpath, 'output.json'))
+			found.append((os.path.join(dirpath, 'output.json'), stat.st_mtime_ns, stat.st_size))
+			# the simulation files under output/ are not searched
+			dirnames.clear()
+	return found
+
+def find_outputs(results_dir, max_workers=8):
+	''' returns the (path, mtime_ns, size) of every output.json under
+		results_dir, each top level directory being scanned in its own thread
+	'''
+	top_dirs = sorted(p for p in Path(results_dir).iterdir() if p.is_dir())
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		return [found for found_dir in executor.map(_scan_dir, top_dirs) for found in found_dir]
+
+def _quantity_kcal_per_mol(quantity):
+	''' returns a quantity serialized by gufe ({'magnitude', 'unit'}) in kcal/mol
+	'''
+	if quantity is None:
+		return np.nan
+	magnitude = float(quantity['magnitude'])
+	if 'kilojoule' in str(quantity['unit']):
+		magnitude /= KJ_PER_KCAL
+	return magnitude
+
+def parse_output(path, results_dir):
+	''' returns the record of the output.json at path, the DG and uncertainty
+		(kcal/mol, NaN for failed simulations or an unreadable file, with the
+		reason in error) and what its path says about it
+		The output.json of a replicate is at {molecule}/{replicate}/output/ in
+		a campaign directory, which is results_dir itself if there is no
+		directory between them
+	'''
+	results_dir = Path(results_dir)
+	parts = Path(path).relative_to(results_dir).parts[:-len(OUTPUT_FILE.parts)]
+	if len(parts) < 2:
+		raise ValueError(f'{path} is not in a {{molecule}}/{{replicate}} directory under {results_dir}')
+	molecule, replicate = parts[-2], parts[-1]
+	campaign = parts[-3] if len(parts) > 2 else results_dir.resolve().name
+	# {MoleculeDatabase}_{ChargeMethod}[_{hardware}]
+	database, _, method_hardware = campaign.partition('_')
+	charge_method, _, hardware = method_hardware.partition('_')
+
+	try:
+		with open(path) as f:
+			output = json.load(f)
+		error = ''
+	except (OSError, ValueError) as e:
+		output = {}
+		error = f'{type(e).__name__}: {e}'
+
+	return {
+		'path': str(path),
+		'campaign': campaign,
+		'database': database,
+		'charge_method': charge_method,
+		'hardware': hardware,
+		'molecule': molecule,
+		'replicate': int(replicate) if replicate.isdigit() else replicate,
+		'dG': _quantity_kcal_per_mol(output.get('estimate')),
+		'dG_uncertainty': _quantity_kcal_per_mol(output.get('uncertainty')),
+		'error': error,
+	}
+
+def _parse_output_task(task):
+	return parse_output(*task)
+
+def load_index(index_file):
+	try:
+		with open(index_file) as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return {}
+
+def save_index(index_file, index):
+	tmp_path = Path(f'{index_file}.tmp')
+	with open(tmp_path, 'w') as f:
+		json.dump(index, f)
+	os.replace(tmp_path, index_file)
+
+def update_index(results_dir, index, max_workers=8):
+	''' parses the output.json files under results_dir that are not in index
+		or have changed since and removes the ones that no longer exist.
+		Returns the number of files parsed
+
+		results_dir: 		str or Path of the simulations tree
+		index: 				dictionary of {'mtime_ns', 'size', 'record'} by path
+		max_workers: 		int number of threads scanning and processes parsing
+	'''
+	outputs = find_outputs(results_dir, max_workers)
+
+	changed = [
+		(path, mtime_ns, size) for path, mtime_ns, size in outputs
+		if path not in index or (index[path]['mtime_ns'], index[path]['size']) != (mtime_ns, size)
+	]
+	if changed:
+		with ProcessPoolExecutor(max_workers=max_workers) as executor:
+			records = executor.map(_parse_output_task, [(path, results_dir) for path, _, _ in changed], chunksize=16)
+			for (path, mtime_ns, size), record in zip(changed, records):
+				index[path] = {'mtime_ns': mtime_ns, 'size': size, 'record': record}
+
+	existing = {path for path, _, _ in outputs}
+	for path in list(index):
+		if path not in existing:
+			del index[path]
+	return len(changed)
+
+def get_molecule_table(replicates):
+	''' returns the statistics of DG across the replicates of each molecule of
+		each campaign, from the replicates table
+	'''
+	rows = []
+	for (campaign, molecule), group in replicates.groupby(['campaign', 'molecule'], sort=True):
+		dG = group['dG'].dropna().to_numpy()
+		if len(dG) > 1:
+			stats = {name: values[0] for name, values in get_statistics(dG.reshape(1, -1)).items()}
+		else:
+			# the spread is undefined with fewer than two finished replicates
+			stats = dict.fromkeys(STATISTICS, np.nan)
+			stats['mean'] = dG.mean() if len(dG) else np.nan
+		rows.append({
+			'campaign': campaign,
+			'database': group['database'].iloc[0],
+			'charge_method': group['charge_method'].iloc[0],
+			'hardware': group['hardware'].iloc[0],
+			'molecule': molecule,
+			'n_replicates': len(group),
+			'n_failed': int(group['dG'].isna().sum()),
+			**{f'dG_{name}': value for name, value in stats.items()},
+			'dG_uncertainty_mean': group['dG_uncertainty'].mean(),
+		})
+	return pd.DataFrame(rows)
+
+def get_method_table(molecules):
+	''' returns the mean and max across molecules of the stdev and range of DG
+		across replicates for each campaign, from the molecules table
+	'''
+	return molecules.groupby(['campaign', 'database', 'charge_method', 'hardware'], sort=True).agg(
+		n_molecules=('molecule', 'count'),
+		dG_stdev_mean=('dG_stdev', 'mean'),
+		dG_stdev_max=('dG_stdev', 'max'),
+		dG_range_mean=('dG_range', 'mean'),
+		dG_range_max=('dG_range', 'max'),
+	).reset_index()
+
+def write_table(df, path_prefix):
+	''' writes df to {path_prefix}.parquet, or {path_prefix}.h5 without pyarrow
+		and returns the path
+	'''
+	if PYARROW_EXISTS:
+		path = f'{path_prefix}.parquet'
+		df.to_parquet(path, index=False)
+	else:
+		path = f'{path_prefix}.h5'
+		df.to_hdf(path, key='table', mode='w', format='table', index=False)
+	return path
+
+
+if __name__ == "__main__":
+
+	####################################
+	#### START EDIT THESE VARIABLES ####
+	####################################
+	results_dir = '../simulations/start_files'
+	output_prefix = '../simulations/ahfe_results'
+
+	# index of the results parsed so far, re-running with the same file only
+	# parses new or changed output.json files
+	index_file = '../simulations/ahfe_results_index.json'
+
+	# number of threads scanning the tree and of processes parsing results
+	max_workers = 8
+	####################################
+	#### END   EDIT THESE VARIABLES ####
+	####################################
+
+	results_dir = Path(results_dir)
+	index = load_index(index_file)
+	num_parsed = update_index(results_dir, index, max_workers)
+	save_index(index_file, index)
+	print(f"{len(index)} results, {num_parsed} parsed")
+
+	if not index:
+		raise SystemExit("No output.json files found")
+
+	replicates = pd.DataFrame([entry['record'] for entry in index.values()])
+	replicates = replicates.sort_values(['campaign', 'molecule', 'replicate']).reset_index(drop=True)
+	molecules = get_molecule_table(replicates)
+	methods = get_method_table(molecules)
+
+	for name, df in [('replicates', replicates), ('molecules', molecules), ('methods', methods)]:
+		print(write_table(df, f'{output_prefix}_{name}'))
+	print(methods.to_string(index=False))
@@ -13,12 +13,13 @@ Instructions:
 	
 '''
 
-import pandas as pd
 from rdkit import Chem
-import statistics
-import csv
 from pathlib import Path
 
+from charge_analysis import get_bond_dq_table, write_table_csv
+from charge_store import ChargeStore, get_store_path, load_charge_matrix
+from run_manifest import RunManifest
+
 # length of SEEDS list should be longer than the num_charge_sets
 # if running OpenEye AM1-BCC ELF10 charges
 # must use seed numbers used with charge_molecules.py 
@@ -30,7 +31,6 @@ SEEDS = [
 	125, 88, 7, 30, 45, 130, 0, 86, 136, 41, 8, 
 	17, 152, 51, 104, 89, 39, 96, 114, 11, 71
 ]
-CSV_OFFSET = 2
 
 if __name__ == "__main__":
 
@@ -44,76 +44,54 @@ if __name__ == "__main__":
 	charge_method = 'am1bcc'
 	input_path = '/Users/megosato/Desktop/testing'
 	output_path = '/Users/megosato/Desktop/testing'
+
+	# 'csv' reads the per molecule csv files, 'store' reads the charge store
+	# written by charge_molecules.py with 'store' in output_formats
+	input_format = 'csv'
+
+	# file recording the molecules that have been finished, re-running the
+	# script with the same file only does the work that is missing. 
+	# None disables resuming
+	manifest_file = None
 	####################################
 	#### END   EDIT THESE VARIABLES ####
 	####################################
 
 	all_rdmols = [mol for mol in Chem.SDMolSupplier(sdf_file, removeHs=False)]
 
+	run_manifest = RunManifest(manifest_file) if manifest_file is not None else None
+
+	charge_store = None
+	if input_format == 'store':
+		charge_store = ChargeStore(get_store_path(input_path, toolkit, charge_method))
+
 	for rdmol in all_rdmols:
 		molname = rdmol.GetProp('_Name')
+		if run_manifest is not None and run_manifest.is_done(molname):
+			continue
 
 		# step 1
-		# load in charges csv generated from charge_molecules.py
-		# create a pandas dataframe
-		charge_csv = f'{input_path}/{toolkit}_{charge_method}/{toolkit}_{charge_method}_{molname}_charges.csv'
-		df = pd.read_csv(charge_csv)
-			
+		# load in the atoms x sets matrix of charges generated from
+		# charge_molecules.py, either from the charge store or from the csv
+		charge_matrix = load_charge_matrix(input_path, toolkit, charge_method, molname, charge_store)[:, :num_charge_sets]
 
 		# step 2
 		# Based on the bonds in the rdkit molecule loaded by sdf determine the
 		# bond dq by taking the absolute value of difference in charge at 
 		# the two atoms involved in the bond
-		# store the bond dq for each conformer in a dictionary by bond index
-		# and the indices of the atoms involved in the bond
-		bond_dq_dict_list = []
-		for i in range(num_charge_sets):
-		
-			for j,bond in enumerate(rdmol.GetBonds()):
-				bgn_idx = bond.GetBeginAtomIdx()
-				end_idx = bond.GetEndAtomIdx()
-			
-
-				if i == 0:
-					bond_dq_dict_list.append(dict())
-					bond_dq_dict_list[j]['idx'] = bond.GetIdx()
-					bond_dq_dict_list[j]['a1'] = bgn_idx
-					bond_dq_dict_list[j]['a2'] = end_idx
-					bond_dq_dict_list[j]['atmnum1'] = bond.GetBeginAtom().GetAtomicNum()
-					bond_dq_dict_list[j]['atmnum2'] = bond.GetBeginAtom().GetAtomicNum()
-
-				bond_dq_dict_list[j][i] = abs(df.iloc[bgn_idx,i+2] - df.iloc[end_idx,i+2])
-		
-
-		# step 4
-		# generate the bond dq statistics for each bond in the molecule
-		for dq_dict in bond_dq_dict_list:
-			dqs = [dq_dict[i] for i in range(num_charge_sets)]
-			mean = statistics.mean(dqs)
-			stdev = statistics.stdev(dqs)
-			var = statistics.stdev(dqs) ** 2
-			dq_dict['mean'] = mean
-			dq_dict['stdev'] = stdev
-			dq_dict['var'] = var
-			dq_dict['range'] = abs(min(dqs) - max(dqs))
-
-		# step 5
-		# save the partial charges for each conformer as well as the statistics in
+		# the bond dq of every bond in every partial charge set and the bond dq
+		# statistics of each bond are computed at once from the atoms x sets
+		# charge matrix
+		header, rows = get_bond_dq_table(rdmol, charge_matrix)
+
+		# step 3
+		# save the bond dq for each conformer as well as the statistics in
 		# a csv file
 		csv_dir_path = Path(f'{output_path}/{toolkit}_{charge_method}_dq/')
 		csv_dir_path.mkdir(exist_ok=True, parents=True)
 
 		csv_file_path = csv_dir_path / f'{toolkit}_{charge_method}_{molname}_dq.csv'
-		# Define column headers
-		fieldnames = [k for k in bond_dq_dict_list[0]]
-		
-		# Write data to CSV file
-		with open(str(csv_file_path), mode='w', newline='') as file:
-			writer = csv.DictWriter(file, fieldnames=fieldnames)
-			
-			# Write header row
-			writer.writeheader()
-			
-			# Write data rows
-			for row in bond_dq_dict_list:
-				writer.writerow(row)
\ No newline at end of file
+		write_table_csv(csv_file_path, header, rows)
+
+		if run_manifest is not None:
+			run_manifest.mark_done(molname)
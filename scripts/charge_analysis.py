@@ -0,0 +1,250 @@
+'''
+NumPy helpers to analyze the variability of partial charges across many
+partial charge sets.
+
+Charges are held as an atoms x sets matrix, so the per-atom statistics and the
+bond delta q of every bond in every charge set are each computed with a single
+array operation instead of looping over atoms, bonds and charge sets.
+
+Only depends on numpy so it can be imported without any of the toolkits.
+'''
+
+import csv
+
+import numpy as np
+
+# names of the statistics columns written after the per set columns
+STATISTICS = ['mean', 'stdev', 'var', 'range']
+
+
+def get_statistics(values):
+	''' returns a dictionary with the mean, stdev, var and range of each row
+		of values, a 2D array with one row per atom (or bond) and one column
+		per partial charge set
+	'''
+	values = np.asarray(values, dtype=np.float64)
+	stdev = values.std(axis=1, ddof=1)
+	return {
+		'mean': values.mean(axis=1),
+		'stdev': stdev,
+		'var': stdev ** 2,
+		'range': values.max(axis=1) - values.min(axis=1),
+	}
+
+def get_set_columns(columns):
+	''' returns the names of the partial charge set columns ("0", "1", ...)
+		in a charges or dq table, in order
+	'''
+	return sorted([c for c in columns if str(c).isdigit()], key=int)
+
+def get_charge_matrix(df, num_charge_sets=None):
+	''' returns the atoms x sets matrix of partial charges from a pandas
+		DataFrame of a charges csv written by charge_molecules.py
+
+		df: 				DataFrame of the charges csv
+		num_charge_sets:	int number of partial charge sets to use, all of
+							them if None
+	'''
+	set_columns = get_set_columns(df.columns)
+	if num_charge_sets is not None:
+		set_columns = set_columns[:num_charge_sets]
+	return df[set_columns].to_numpy(dtype=np.float64)
+
+def get_bond_index_array(rdmol):
+	''' returns a bonds x 2 array of the begin and end atom indices of each
+		bond in the rdkit molecule, in bond index order
+	'''
+	return np.array(
+		[(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()) for bond in rdmol.GetBonds()],
+		dtype=np.intp,
+	).reshape(-1, 2)
+
+def calc_bond_dq(charge_matrix, bond_atoms):
+	''' returns the bonds x sets matrix of bond delta q, the absolute value of
+		the difference in partial charge between the two atoms of each bond
+
+		charge_matrix: 		atoms x sets array of partial charges
+		bond_atoms: 		bonds x 2 array of atom indices from get_bond_index_array
+	'''
+	return np.abs(charge_matrix[bond_atoms[:, 0]] - charge_matrix[bond_atoms[:, 1]])
+
+def get_bond_dq_table(rdmol, charge_matrix):
+	''' returns the header and rows of the bond delta q table of rdmol in the
+		*_dq.csv format: idx, a1, a2, atmnum1, atmnum2, one column per partial
+		charge set, then the statistics of each bond across the sets
+	'''
+	bond_atoms = get_bond_index_array(rdmol)
+	atmnums = np.array([atom.GetAtomicNum() for atom in rdmol.GetAtoms()])
+	dq = calc_bond_dq(charge_matrix, bond_atoms)
+	stats = get_statistics(dq)
+
+	header = ['idx', 'a1', 'a2', 'atmnum1', 'atmnum2']
+	header += [str(i) for i in range(dq.shape[1])]
+	header += STATISTICS
+
+	columns = [
+		np.arange(len(bond_atoms)),
+		bond_atoms[:, 0],
+		bond_atoms[:, 1],
+		atmnums[bond_atoms[:, 0]],
+		atmnums[bond_atoms[:, 1]],
+	]
+	columns += list(dq.T)
+	columns += [stats[s] for s in STATISTICS]
+
+	# tolist gives python ints and floats so the csv matches csv.DictWriter output
+	rows = zip(*[np.asarray(c).tolist() for c in columns])
+	return header, rows
+
+def write_table_csv(csv_file_path, header, rows):
+	''' writes a table from get_bond_dq_table (or with the same layout) to csv
+	'''
+	with open(str(csv_file_path), mode='w', newline='') as file:
+		writer = csv.writer(file)
+		writer.writerow(header)
+		writer.writerows(rows)
+
+def get_set_distances(charge_matrix):
+	''' returns the sets x sets matrix of root mean square differences (e) 
+		between the partial charges of every pair of charge sets (columns) of
+		the atoms x sets charge_matrix
+	'''
+	charge_matrix = np.asarray(charge_matrix, dtype=np.float64)
+	sq_norms = (charge_matrix ** 2).sum(axis=0)
+	sq_dist = sq_norms[:, None] + sq_norms[None, :] - 2 * charge_matrix.T @ charge_matrix
+	return np.sqrt(np.clip(sq_dist, 0, None) / charge_matrix.shape[0])
+
+def farthest_point_sets(distances, k):
+	''' returns the indices of k charge sets picked by farthest point sampling,
+		starting from the medoid of all sets and then repeatedly adding the set
+		farthest from those already picked
+
+		distances: 			sets x sets matrix from get_set_distances
+		k: 					int number of sets to pick
+	'''
+	selected = [int(np.argmin(distances.sum(axis=1)))]
+	min_dist = distances[selected[0]].copy()
+	# picked sets are never picked again, even if all the others are duplicates
+	min_dist[selected[0]] = -np.inf
+	while len(selected) < k:
+		idx = int(np.argmax(min_dist))
+		selected.append(idx)
+		np.minimum(min_dist, distances[idx], out=min_dist)
+		min_dist[idx] = -np.inf
+	return np.array(selected)
+
+def kmedoids_sets(distances, k, max_iter=100):
+	''' returns the indices of the k medoid charge sets found by alternating 
+		k-medoids started from farthest_point_sets. Each set is assigned to its
+		nearest medoid and each medoid is moved to the set of its cluster with
+		the smallest total distance to the others, until nothing changes
+
+		distances: 			sets x sets matrix from get_set_distances
+		k: 					int number of medoids
+		max_iter: 			int maximum number of iterations
+	'''
+	medoids = farthest_point_sets(distances, k)
+	for _ in range(max_iter):
+		labels = np.argmin(distances[:, medoids], axis=1)
+		# each medoid is in its own cluster, even if another medoid is as close
+		labels[medoids] = np.arange(k)
+		new_medoids = medoids.copy()
+		for cluster in range(k):
+			members = np.flatnonzero(labels == cluster)
+			new_medoids[cluster] = members[np.argmin(distances[np.ix_(members, members)].sum(axis=1))]
+		if np.array_equal(new_medoids, medoids):
+			break
+		medoids = new_medoids
+	return medoids
+
+# functions picking representative charge sets by selection method name
+SELECTION_METHODS = {
+	'kmedoids': kmedoids_sets,
+	'farthest_point': farthest_point_sets,
+}
+
+def select_representative_sets(charge_matrix, k, method='kmedoids'):
+	''' picks k partial charge sets (columns of charge_matrix) that span the
+		variability of all of them, and assigns every set to its nearest pick
+		Returns the indices of the picked sets, the fraction of all sets 
+		assigned to each (its weight) and the index into the picks that each
+		set is assigned to
+
+		charge_matrix: 		atoms x sets array of partial charges
+		k: 					int number of sets to pick, every set is picked if 
+							there are no more than k
+		method: 			str, a key of SELECTION_METHODS
+	'''
+	distances = get_set_distances(charge_matrix)
+	num_sets = distances.shape[0]
+	if k >= num_sets:
+		selected = np.arange(num_sets)
+	else:
+		selected = SELECTION_METHODS[method](distances, k)
+
+	labels = np.argmin(distances[:, selected], axis=1)
+	labels[selected] = np.arange(len(selected))
+	weights = np.bincount(labels, minlength=len(selected)) / num_sets
+	return selected, weights, labels
+
+
+class ChargeAccumulator:
+	''' Online (Welford) accumulator of the mean, stdev and range of the
+		partial charge at each atom, updated one partial charge set at a time
+		so the number of charge sets can be decided while charging
+	'''
+
+	def __init__(self):
+		self.n = 0
+		self.mean = None
+		self._m2 = None
+		self.min = None
+		self.max = None
+
+	def update(self, charges):
+		''' adds one partial charge set (array with one charge per atom)
+		'''
+		charges = np.asarray(charges, dtype=np.float64)
+		self.n += 1
+		if self.n == 1:
+			self.mean = charges.copy()
+			self._m2 = np.zeros_like(charges)
+			self.min = charges.copy()
+			self.max = charges.copy()
+			return
+
+		delta = charges - self.mean
+		self.mean += delta / self.n
+		self._m2 += delta * (charges - self.mean)
+		np.minimum(self.min, charges, out=self.min)
+		np.maximum(self.max, charges, out=self.max)
+
+	def stdev(self):
+		''' returns the sample stdev of the partial charge at each atom
+		'''
+		if self.n < 2:
+			return np.full_like(self.mean, np.nan)
+		return np.sqrt(self._m2 / (self.n - 1))
+
+	def range(self):
+		''' returns the range of the partial charge at each atom
+		'''
+		return self.max - self.min
+
+	def stdev_ci_halfwidth(self, z=1.96):
+		''' returns the half width of the confidence interval on the stdev of
+			each atom, using the normal approximation to the standard error of
+			a sample stdev, s / sqrt(2 (n - 1)). z = 1.96 gives a 95% interval
+		'''
+		if self.n < 2:
+			return np.full_like(self.mean, np.inf)
+		return z * self.stdev() / np.sqrt(2 * (self.n - 1))
+
+	def is_converged(self, tolerance, min_sets=2):
+		''' returns True once at least min_sets partial charge sets have been
+			added and the stdev confidence interval of every atom is narrower
+			than tolerance (e)
+		'''
+		if self.n < max(min_sets, 2):
+			return False
+		return bool(np.all(self.stdev_ci_halfwidth() <= tolerance))
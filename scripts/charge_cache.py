@@ -0,0 +1,170 @@
+'''
+Persistent on-disk cache of partial charge results so that conformers that
+have already been charged with the same toolkit and charge method are not
+charged again on later runs.
+
+Each entry is a .npy file of per-atom partial charges (in units of e) named
+by a hash of everything that determines the charges:
+	* the mapped SMILES of the molecule
+	* the conformer coordinates, rounded to COORDINATE_DECIMALS
+	* the toolkit name and version
+	* the charge method
+
+A ChargeCache handed to worker processes (see charging.get_charge_executor)
+writes entries there, but only the process that made it keeps track of the
+size of the cache and evicts entries, from the bytes_written the workers
+report through track_write.
+'''
+
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+# coordinates are rounded to this many decimal places (in Angstrom) before
+# hashing so that numerical noise from file round trips does not cause misses
+COORDINATE_DECIMALS = 4
+
+# default maximum size of the cache on disk before old entries are evicted
+DEFAULT_MAX_SIZE_BYTES = 2 * 1024 ** 3
+
+# an eviction brings the cache down to this fraction of its maximum size, so
+# the writes that follow do not each start another scan of the cache
+EVICTION_FRACTION = 0.9
+
+
+class ChargeCache:
+	''' Content-addressed cache of partial charges stored in cache_dir
+		Once the entries in the cache take up more than max_size_bytes the least
+		recently used entries are deleted, by the process that made this object
+		only. hits and misses count the lookups made through this object and
+		bytes_written the size of the entries it wrote
+
+		cache_dir: 			str or Path of the directory holding the cache
+		max_size_bytes: 	int maximum size of the cache on disk
+	'''
+
+	def __init__(self, cache_dir, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+		self.cache_dir = Path(cache_dir)
+		self.cache_dir.mkdir(exist_ok=True, parents=True)
+		self.max_size_bytes = max_size_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.bytes_written = 0
+		# total size of the entries on disk, computed on the first write
+		self._size_bytes = None
+		# other processes this object is pickled into do not evict
+		self._owner_pid = os.getpid()
+
+	def get_key(self, toolkit_wrapper, charge_method, offmol):
+		''' returns the hash identifying the charges of offmol's conformer(s)
+			with the given toolkit_wrapper and charge_method
+		'''
+		from openff.units import unit
+
+		h = hashlib.sha256()
+		h.update(offmol.to_smiles(mapped=True).encode())
+		for conf in offmol.conformers or []:
+			# adding 0.0 turns -0.0 into 0.0 so both hash the same
+			coords = np.round(conf.m_as(unit.angstrom), COORDINATE_DECIMALS) + 0.0
+			h.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+		h.update(str(toolkit_wrapper.toolkit_name).encode())
+		h.update(str(toolkit_wrapper.toolkit_version).encode())
+		h.update(str(charge_method).encode())
+		return h.hexdigest()
+
+	def _entry_path(self, key):
+		return self.cache_dir / key[:2] / f'{key}.npy'
+
+	def get(self, toolkit_wrapper, charge_method, offmol):
+		''' returns the cached partial charges of offmol as a numpy array, or
+			None if they have not been cached yet
+		'''
+		path = self._entry_path(self.get_key(toolkit_wrapper, charge_method, offmol))
+		try:
+			charges = np.load(path)
+		except (FileNotFoundError, ValueError, OSError):
+			self.misses += 1
+			return None
+
+		# mark the entry as recently used so it is evicted last
+		os.utime(path)
+		self.hits += 1
+		return charges
+
+	def put(self, toolkit_wrapper, charge_method, offmol, charges):
+		''' stores charges (numpy array of partial charges in units of e) as
+			the result of charging offmol with toolkit_wrapper and charge_method
+		'''
+		path = self._entry_path(self.get_key(toolkit_wrapper, charge_method, offmol))
+		path.parent.mkdir(exist_ok=True)
+
+		# write to a temporary file first so that a concurrent reader or a
+		# crash never leaves a partially written entry behind
+		tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.tmp')
+		with open(tmp_path, 'wb') as f:
+			np.save(f, np.asarray(charges, dtype=np.float64))
+		os.replace(tmp_path, path)
+
+		size = path.stat().st_size
+		self.bytes_written += size
+		if os.getpid() == self._owner_pid:
+			self.track_write(size)
+
+	def track_write(self, size):
+		''' adds size (bytes) written to the cache, by this process or by a
+			worker process, to the size of the cache and evicts entries if it
+			is over max_size_bytes. Only does anything in the process that made
+			this object
+		'''
+		if os.getpid() != self._owner_pid:
+			return
+
+		if self._size_bytes is None:
+			# the only full scan of the cache directory until the next eviction
+			self._size_bytes = sum(p.stat().st_size for p in self._entries())
+		else:
+			self._size_bytes += size
+
+		if self._size_bytes > self.max_size_bytes:
+			self.evict()
+
+	def _entries(self):
+		return self.cache_dir.glob('*/*.npy')
+
+	def evict(self):
+		''' deletes the least recently used entries until the cache is at most
+			EVICTION_FRACTION of max_size_bytes on disk
+		'''
+		entries = []
+		for p in self._entries():
+			try:
+				st = p.stat()
+			except FileNotFoundError:
+				continue
+			entries.append((st.st_mtime, st.st_size, p))
+		entries.sort()
+
+		self._size_bytes = sum(size for _, size, _ in entries)
+		for _, size, p in entries:
+			if self._size_bytes <= EVICTION_FRACTION * self.max_size_bytes:
+				break
+			try:
+				p.unlink()
+			except FileNotFoundError:
+				pass
+			self._size_bytes -= size
+			self.evictions += 1
+
+	def stats(self):
+		''' returns a dictionary of the hit, miss and eviction counters
+		'''
+		return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+	def __getstate__(self):
+		# only the process that made the cache tracks its size
+		state = self.__dict__.copy()
+		state['_size_bytes'] = None
+		return state
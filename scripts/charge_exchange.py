@@ -0,0 +1,285 @@
+'''
+Exchange of the NAGL partial charges of a whole dataset between the nagl.yaml
+environment, which generates them, and the openfe.yaml environment, which
+builds the simulations with them, used instead of one charged.mol2 file per
+molecule.
+
+An exchange file holds, for each molecule, its name, its mapped SMILES (the
+atom order of the arrays), its partial charges (e) and its reference
+coordinates (atoms x 3, Angstrom). It is laid out as
+	* MAGIC
+	* the charges then the coordinates of every molecule (float64), one
+	  molecule after another
+	* a json footer with the name, mapped SMILES, number of atoms and offset of
+	  each molecule, followed by its length (uint64) and MAGIC
+so it is written in a single pass and its arrays are memory-mapped when read.
+
+NAGLSubprocess runs the NAGL charging of nagl_batch.py in a long-lived process
+of the nagl.yaml environment, so prep_fe_nagl_pt2.py can charge a whole
+library in one request over a pipe, see README.md. The requests and responses
+are single lines of json, with the charges as base64 encoded float64 bytes.
+'''
+
+import base64
+import json
+import os
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b'CHGEXCH1'
+# the arrays are little-endian float64 whatever the machine writing them
+DTYPE = np.dtype('<f8')
+_FOOTER_TAIL = len(MAGIC) + 8
+
+
+def get_exchange_path(output_path, toolkit, charge_method):
+	''' returns the path of the charge exchange file for the toolkit and
+		charge_method
+	'''
+	return Path(f'{output_path}/{toolkit}_{charge_method}.exchange')
+
+def get_reference(offmol):
+	''' returns the name, mapped SMILES and coordinates (atoms x 3, Angstrom)
+		of the first conformer of the OpenFF Molecule offmol
+	'''
+	return offmol.name, offmol.to_smiles(mapped=True), offmol.conformers[0].m_as('angstrom')
+
+
+class ChargeExchangeWriter:
+	''' Writes an exchange file one molecule at a time, see module docstring.
+		The file is written under a temporary name and only replaces path on
+		close, so an existing exchange file can be read while its replacement
+		is written
+
+		path: 				str or Path of the exchange file
+		metadata: 			json serializable dictionary saved in the footer, e.g.
+							the toolkit and charge method
+	'''
+
+	def __init__(self, path, metadata=None):
+		self.path = Path(path)
+		self.path.parent.mkdir(exist_ok=True, parents=True)
+		self._tmp_path = Path(f'{self.path}.tmp')
+		self._file = open(self._tmp_path, 'wb')
+		self._file.write(MAGIC)
+		self._offset = 0
+		self._footer = {'metadata': metadata or {}, 'molecules': {}}
+
+	def __contains__(self, name):
+		return name in self._footer['molecules']
+
+	def write(self, name, mapped_smiles, charges, coordinates):
+		''' adds a molecule to the exchange file
+
+			name: 				str name of the molecule
+			mapped_smiles: 		str mapped SMILES giving the atom order of the arrays
+			charges: 			array of the partial charge (e) of each atom
+			coordinates: 		atoms x 3 array of reference coordinates (Angstrom)
+		'''
+		if name in self._footer['molecules']:
+			raise ValueError(f'{name} was already written to the charge exchange file {self.path}')
+
+		charges = np.ascontiguousarray(charges, dtype=DTYPE).reshape(-1)
+		n_atoms = len(charges)
+		coordinates = np.ascontiguousarray(coordinates, dtype=DTYPE)
+		if coordinates.shape != (n_atoms, 3):
+			raise ValueError(f'{name} has {n_atoms} charges but coordinates of shape {coordinates.shape}')
+
+		self._file.write(charges.tobytes())
+		self._file.write(coordinates.tobytes())
+		self._footer['molecules'][name] = {'smiles': mapped_smiles, 'n_atoms': n_atoms, 'offset': self._offset}
+		self._offset += 4 * n_atoms
+
+	def copy(self, exchange, name):
+		''' adds molecule name of the ChargeExchange exchange to the file
+		'''
+		self.write(name, exchange.mapped_smiles(name), exchange.charges(name), exchange.coordinates(name))
+
+	def close(self):
+		''' writes the footer and moves the file to path
+		'''
+		if self._file.closed:
+			return
+		footer = json.dumps(self._footer).encode()
+		self._file.write(footer)
+		self._file.write(np.uint64(len(footer)).astype('<u8').tobytes())
+		self._file.write(MAGIC)
+		self._file.close()
+		os.replace(self._tmp_path, self.path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			# an interrupted write leaves any existing exchange file untouched
+			self._file.close()
+			self._tmp_path.unlink(missing_ok=True)
+
+
+class ChargeExchange:
+	''' Memory-mapped exchange file, see module docstring. The arrays returned
+		are read only views into the file
+
+		path: 				str or Path of the exchange file
+	'''
+
+	def __init__(self, path):
+		self.path = Path(path)
+
+		with open(self.path, 'rb') as f:
+			if f.read(len(MAGIC)) != MAGIC:
+				raise ValueError(f'{self.path} is not a charge exchange file')
+			end = f.seek(-_FOOTER_TAIL, os.SEEK_END)
+			tail = f.read(_FOOTER_TAIL)
+			if tail[8:] != MAGIC:
+				raise ValueError(f'{self.path} is an incomplete charge exchange file')
+			footer_size = int(np.frombuffer(tail[:8], dtype='<u8')[0])
+			f.seek(end - footer_size)
+			footer = json.loads(f.read(footer_size))
+
+		self.metadata = footer['metadata']
+		self._index = footer['molecules']
+		data_size = (end - footer_size - len(MAGIC)) // DTYPE.itemsize
+		if data_size:
+			self._data = np.memmap(self.path, dtype=DTYPE, mode='r', offset=len(MAGIC), shape=(data_size,))
+		else:
+			self._data = np.empty(0, dtype=DTYPE)
+
+	def names(self):
+		''' returns the names of the molecules in the exchange file
+		'''
+		return list(self._index)
+
+	def __contains__(self, name):
+		return name in self._index
+
+	def __len__(self):
+		return len(self._index)
+
+	def _entry(self, name):
+		try:
+			return self._index[name]
+		except KeyError:
+			raise KeyError(f'{name} is not in the charge exchange file {self.path}') from None
+
+	def mapped_smiles(self, name):
+		''' returns the mapped SMILES of molecule name, which gives the atom
+			order of its charges and coordinates
+		'''
+		return self._entry(name)['smiles']
+
+	def charges(self, name):
+		''' returns the partial charges (e) of the atoms of molecule name
+		'''
+		entry = self._entry(name)
+		return self._data[entry['offset']:entry['offset'] + entry['n_atoms']]
+
+	def coordinates(self, name):
+		''' returns the atoms x 3 reference coordinates (Angstrom) of molecule name
+		'''
+		entry = self._entry(name)
+		start = entry['offset'] + entry['n_atoms']
+		return self._data[start:start + 3 * entry['n_atoms']].reshape(-1, 3)
+
+	def to_openff(self, name):
+		''' returns an OpenFF Molecule of molecule name with its partial charges
+			and its reference coordinates as its conformer
+		'''
+		from openff.toolkit import Molecule
+		from openff.units import unit
+
+		offmol = Molecule.from_mapped_smiles(self.mapped_smiles(name), allow_undefined_stereo=True)
+		offmol.name = name
+		offmol.add_conformer(np.array(self.coordinates(name)) * unit.angstrom)
+		offmol.partial_charges = np.array(self.charges(name)) * unit.elementary_charge
+		return offmol
+
+
+def encode_array(array):
+	''' returns the float64 bytes of array as a base64 string
+	'''
+	return base64.b64encode(np.ascontiguousarray(array, dtype=DTYPE).tobytes()).decode('ascii')
+
+def decode_array(text):
+	''' returns the float64 array of a string from encode_array
+	'''
+	return np.frombuffer(base64.b64decode(text), dtype=DTYPE)
+
+def serve(charge_function, stdin, stdout):
+	''' answers the charging requests of a NAGLSubprocess, one json line each,
+		until stdin is closed
+
+		charge_function: 	function(charge_method, mapped_smiles, batch_size)
+							returning the partial charges of each mapped SMILES
+		stdin: 				text file the requests are read from
+		stdout: 			text file the responses are written to
+	'''
+	for line in stdin:
+		if not line.strip():
+			continue
+		try:
+			request = json.loads(line)
+			all_charges = charge_function(request['charge_method'], request['mapped_smiles'], request['batch_size'])
+			response = {'charges': [encode_array(charges) for charges in all_charges]}
+		except Exception as e:
+			response = {'error': f'{type(e).__name__}: {e}'}
+		stdout.write(json.dumps(response) + '\n')
+		stdout.flush()
+
+
+class NAGLSubprocess:
+	''' NAGL charging in a long-lived process started with command, which
+		loads each NAGL model once and answers requests until closed
+
+		command: 			list of the command starting the process, e.g.
+							['conda', 'run', '--no-capture-output', '-n', 'nagl',
+							'python', 'nagl_batch.py', 'serve']
+		cwd: 				str or Path the command is run from, the current
+							directory if None
+	'''
+
+	def __init__(self, command, cwd=None):
+		self.command = command
+		self._process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+	def charge(self, charge_method, mapped_smiles, batch_size=64):
+		''' returns the NAGL partial charges (e) of each molecule of
+			mapped_smiles as a list of numpy arrays, in the same order
+
+			charge_method: 		str NAGL model file name
+			mapped_smiles: 		list of mapped SMILES of the molecules to charge
+			batch_size: 		int number of molecules per forward pass
+		'''
+		request = {'charge_method': charge_method, 'mapped_smiles': list(mapped_smiles), 'batch_size': batch_size}
+		try:
+			self._process.stdin.write(json.dumps(request) + '\n')
+			self._process.stdin.flush()
+			line = self._process.stdout.readline()
+		except BrokenPipeError:
+			line = ''
+		if not line:
+			returncode = self._process.wait()
+			raise RuntimeError(f'The NAGL process {self.command} exited with status {returncode}')
+
+		response = json.loads(line)
+		if 'error' in response:
+			raise RuntimeError(f'NAGL charging failed: {response["error"]}')
+		return [decode_array(charges) for charges in response['charges']]
+
+	def close(self):
+		''' closes the pipe to the process and waits for it to exit
+		'''
+		if self._process.poll() is None:
+			self._process.stdin.close()
+			self._process.wait()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
@@ -15,10 +15,23 @@ Instructions:
 	
 '''
 
-from utils import * 
+from openff.toolkit import Molecule
+from rdkit import Chem
+import numpy as np
+
+from conformers import get_mols_from_random_confs, iter_elf10_conformer_sets, prune_conformers, write_confs_oeb
+from charging import (
+	check_provided_charge_type, is_conformer_dependent, check_conformer_independent, 
+	get_toolkit_wrapper, get_charge_executor, use_scratch_dir, charge_missing_conformers, charge_pruned_conformers, charge_conformers_adaptive, prefetch,
+)
+from charge_analysis import write_table_csv
+from charge_cache import ChargeCache
+from charge_store import ChargeStore, get_charge_table, get_csv_path, get_store_path
+from conformer_archive import BackgroundWriter, ConformerArchive, get_archive_path
+from conformer_pool import ConformerPool
+from run_manifest import RunManifest
+import tracing
 import sys
-import csv
-import statistics
 from pathlib import Path
 
 # length of SEEDS list should be longer than the num_charge_sets
@@ -47,6 +60,84 @@ if __name__ == "__main__":
 
 	# only applicable to am1bccelf10 charge_method
 	num_confs_elf10 = 500
+
+	# number of worker processes used to charge conformers in parallel
+	# 1 charges every conformer serially in this process
+	num_workers = 1
+
+	# number of conformers (conformer sets for am1bccelf10) submitted to the
+	# worker processes ahead of the results collected, None uses 2 x num_workers
+	# this and molecules_ahead bound the conformers held in memory at once
+	max_pending_confs = None
+
+	# number of molecules whose conformers are embedded and submitted for
+	# charging while the results of the current molecule are collected
+	molecules_ahead = 1
+
+	# number of conformers each worker process charges before it is replaced
+	# by a fresh process, None keeps the same workers for the whole run
+	max_tasks_per_worker = None
+
+	# directory that the scratch files of each charge calculation are written
+	# to, e.g. the antechamber/sqm files for AmberTools AM1-BCC. '/dev/shm' 
+	# keeps them in RAM on Linux. None uses the system temporary directory
+	scratch_dir = None
+
+	# number of threads RDKit uses to embed conformers, 0 uses all cores
+	# the conformers generated for a seed do not depend on this
+	num_embed_threads = 1
+
+	# directory of the persistent conformer pool, conformers embedded for a
+	# seed in an earlier run are reused. None disables the pool
+	conformer_pool_dir = None
+
+	# 'archive' appends the conformers of every molecule to one indexed archive,
+	# {output_path}/conformers.archive (see conformer_archive.py), 'oeb' writes
+	# one .oeb.gz file per molecule (and per seed for am1bccelf10). Both are
+	# written in a background thread while the conformers are charged
+	conformer_formats = ['archive']
+
+	# directory of the persistent charge cache, conformers charged in an
+	# earlier run are not charged again. None disables the cache
+	charge_cache_dir = None
+
+	# 'store' saves the charges of every molecule in a single binary charge
+	# store (see charge_store.py), 'csv' saves one csv file per molecule
+	output_formats = ['csv']
+
+	# adaptive mode keeps charging conformers of a molecule until the 95% 
+	# confidence interval on the stdev of the partial charge at every atom is 
+	# narrower than charge_set_tolerance (e), with at least min_charge_sets and
+	# at most num_charge_sets partial charge sets
+	adaptive_charge_sets = False
+	charge_set_tolerance = 0.005
+	min_charge_sets = 10
+	# number of partial charge sets between convergence checks, None uses 
+	# max_pending_confs (at least 5)
+	adaptive_batch_size = None
+
+	# file recording the molecules and partial charge sets that have been 
+	# finished, re-running the script with the same file only does the work
+	# that is missing. None disables resuming
+	manifest_file = None
+
+	# conformers whose symmetry aware heavy atom RMSD (Angstrom) to an earlier
+	# conformer is below prune_rmsd are not charged, they get a copy of the
+	# charges of that conformer. The mapping is saved to 
+	# {output_path}/{molecule}/{molecule}_conformer_map.csv. Not used with
+	# am1bccelf10, adaptive_charge_sets or conformer independent methods. 
+	# None charges every conformer
+	prune_rmsd = None
+
+	# methods of toolkits in CONFORMER_INDEPENDENT_TOOLKITS (NAGL) in charging.py
+	# are charged once and the charges are copied to every partial charge set
+	# this many extra conformers are charged to check that the charges agree
+	num_verify_confs = 2
+
+	# directory to write a trace of the time spent in each stage (embedding,
+	# conversions, charging, writing files) by each molecule to, as a Chrome
+	# trace (trace.json) and csv summary tables. None disables tracing
+	trace_dir = None
 	####################################
 	#### END   EDIT THESE VARIABLES ####
 	####################################
@@ -56,101 +147,182 @@ if __name__ == "__main__":
 	if not check_provided_charge_type(toolkit, charge_method):
 		print("ERROR: Invalid toolkit and charge method pairing", file=sys.stderr)
 		sys.exit()
-	toolkit_wrapper = get_toolkit_wrapper(toolkit)
 
 	if len(SEEDS) < num_charge_sets and charge_method == 'am1bccelf10':
 		print("ERROR: More random seeds needed, must have at least as many SEEDS as num_charge_sets", file=sys.stderr)
 		sys.exit()
 
-	all_rdmols = [mol for mol in Chem.SDMolSupplier(sdf_file, removeHs=False)]
+	# number of conformers that need to be embedded and charged per molecule
+	conformer_dependent = is_conformer_dependent(toolkit, charge_method)
+	num_confs_charged = num_charge_sets if conformer_dependent else min(num_charge_sets, 1 + num_verify_confs)
 
-	
+	prune = prune_rmsd is not None and conformer_dependent and charge_method != 'am1bccelf10'
+	if prune and adaptive_charge_sets:
+		print("WARNING: prune_rmsd is ignored with adaptive_charge_sets", file=sys.stderr)
+		prune = False
+
+	# enabled before the worker processes start so they trace too
+	if trace_dir is not None:
+		tracing.enable(trace_dir)
+
+	charge_cache = ChargeCache(charge_cache_dir) if charge_cache_dir is not None else None
+	charge_executor = get_charge_executor(toolkit, num_workers, max_tasks_per_worker, scratch_dir, charge_cache)
+	max_pending = max_pending_confs if max_pending_confs is not None else 2 * num_workers
+	if charge_executor is None and scratch_dir is not None:
+		use_scratch_dir(scratch_dir)
+	# a parallel run only builds the toolkit wrapper inside the worker processes
+	toolkit_wrapper = get_toolkit_wrapper(toolkit) if charge_executor is None else None
 
-	for rdmol in all_rdmols:
+	conformer_pool = ConformerPool(conformer_pool_dir) if conformer_pool_dir is not None else None
 
+	run_manifest = RunManifest(manifest_file) if manifest_file is not None else None
+
+	# conformers are saved for record keeping off the charging loop
+	conformer_writer = BackgroundWriter()
+	conformer_archive = None
+	if 'archive' in conformer_formats:
+		conformer_archive = ConformerArchive(get_archive_path(output_path), mode='a')
+
+	def save_confs(rdmol_w_confs, seed, oeb_path):
+		# the writer thread gets its own copy as RDKit caches properties on a
+		# Mol while writing it, and the conformers are still being charged
+		rdmol_w_confs = Chem.Mol(rdmol_w_confs)
+		if conformer_archive is not None:
+			conformer_writer.submit(conformer_archive.append, rdmol_w_confs, seed)
+		if 'oeb' in conformer_formats:
+			conformer_writer.submit(write_confs_oeb, rdmol_w_confs, oeb_path)
+
+	charge_store = None
+	if 'store' in output_formats:
+		charge_store = ChargeStore(get_store_path(output_path, toolkit, charge_method), mode='a')
+
+	# (name, number of partial charge sets) of each molecule in adaptive mode
+	num_charge_sets_used = []
+	adaptive = adaptive_charge_sets and conformer_dependent
+	if adaptive_batch_size is None:
+		adaptive_batch_size = max(max_pending, 5)
+
+	def start_charge_job(rdmol):
+		''' embeds the conformers of rdmol and starts charging them, returns 
+			the OpenFF Molecule and an iterator over (index, charges, charged)
+			of every partial charge set, or None if it was finished by an
+			earlier run
+		'''
 		offmol_orig = Molecule.from_rdkit(rdmol)
+		if run_manifest is not None and run_manifest.is_done(offmol_orig.name):
+			return None
+
+		# partial charge sets finished by an earlier, interrupted run
+		completed_sets = run_manifest.load_sets(offmol_orig.name) if run_manifest is not None else {}
+
 		parent_outdir = Path(f"{output_path}/{offmol_orig.name}")
 		parent_outdir.mkdir(exist_ok=True,parents=True)
 
 		# step 1
 		# generate conformers based off the random seed
-		# save out conformers as oeb.gz
+		# save out conformers to the archive and/or as oeb.gz
 		if charge_method != 'am1bccelf10':
-			rdmol_w_confs, rdmols_by_conf = get_mols_from_random_confs(rdmol, num_charge_sets, SEEDS[0])
-			offmol_w_confs = Molecule.from_rdkit(rdmol_w_confs)
-			oemol_w_confs = Molecule.to_openeye(offmol_w_confs)
-			ofs = oechem.oemolostream(f"{str(parent_outdir)}/{offmol_orig.name}.oeb.gz")
-			ofs.SetFormat(oechem.OEFormat_OEB)
-			# Write the molecule to the stream
-			oechem.OEWriteMolecule(ofs, oemol_w_confs)
-			# Close the stream
-			ofs.close()
+			rdmol_w_confs, rdmols_by_conf = get_mols_from_random_confs(rdmol, num_confs_charged, SEEDS[0], num_embed_threads, lazy=True, conformer_pool=conformer_pool)
+			save_confs(rdmol_w_confs, SEEDS[0], f"{str(parent_outdir)}/{offmol_orig.name}.oeb.gz")
 
 		if charge_method == 'am1bccelf10':
-			rdmols_by_conf = []
-			for i in range(num_charge_sets):
-				print(i)
-				rdmol_w_confs_500,_ = get_mols_from_random_confs(rdmol, num_confs_elf10, SEEDS[i])
-				rdmols_by_conf.append(rdmol_w_confs_500)
-
-				offmol_w_confs = Molecule.from_rdkit(rdmol_w_confs_500)
-				oemol_w_confs = Molecule.to_openeye(offmol_w_confs)
-				ofs = oechem.oemolostream(f"{str(parent_outdir)}/{offmol_orig.name}_{SEEDS[i]}.oeb.gz")
-				ofs.SetFormat(oechem.OEFormat_OEB)
-				# Write the molecule to the stream
-				oechem.OEWriteMolecule(ofs, oemol_w_confs)
-				# Close the stream
-				ofs.close()
-				
+			# each set of conformers is only embedded when it is about to be charged
+			save_elf10_confs = lambda rdmol_w_confs, seed, outdir=parent_outdir, name=offmol_orig.name: save_confs(rdmol_w_confs, seed, f"{str(outdir)}/{name}_{seed}.oeb.gz")
+			rdmols_by_conf = iter_elf10_conformer_sets(rdmol, SEEDS[:num_confs_charged], num_confs_elf10, save_elf10_confs, num_embed_threads, conformer_pool, completed_sets)
 
-		# step 3
-		# generate the partial charges for each conformer 
-		# store the partial charges for each conformer in a dictionary by atom
-		# one dictionary per conformer/partial charge set
-		am1bcc_partial_charge_dict_list = list()
-		for i,rdmol in enumerate(rdmols_by_conf):
-			offmol = Molecule.from_rdkit(rdmol)
+		# step 2
+		# generate the partial charges for each conformer
+		if adaptive:
+			charge_results = charge_conformers_adaptive(
+				charge_method, rdmols_by_conf, charge_set_tolerance, min_charge_sets, 
+				adaptive_batch_size, toolkit_wrapper, charge_executor, charge_cache,
+				completed_sets, max_pending,
+			)
+		elif prune:
+			with tracing.span('prune', molecule=offmol_orig.name):
+				representatives, rmsd = prune_conformers(rdmol_w_confs, prune_rmsd)
+			write_table_csv(
+				parent_outdir / f'{offmol_orig.name}_conformer_map.csv',
+				['conformer', 'representative', 'rmsd'],
+				zip(range(len(representatives)), representatives, rmsd),
+			)
+			print(f"{offmol_orig.name}: {len(set(representatives))} of {len(representatives)} conformers charged")
+			charge_results = charge_pruned_conformers(charge_method, rdmols_by_conf, representatives, completed_sets, toolkit_wrapper, charge_executor, charge_cache, max_pending)
+		else:
+			charge_results = charge_missing_conformers(charge_method, rdmols_by_conf, completed_sets, toolkit_wrapper, charge_executor, charge_cache, max_pending)
+		return offmol_orig, charge_results
+
+	# molecules are read, embedded, charged, collected and written one after
+	# another, only molecules_ahead molecules are started before they are
+	# needed so the memory used does not grow with the number of molecules
+	rdmols = Chem.SDMolSupplier(sdf_file, removeHs=False)
+	charge_jobs = prefetch((start_charge_job(rdmol) for rdmol in rdmols), molecules_ahead)
+
+	for charge_job in charge_jobs:
+		if charge_job is None:
+			continue
+		offmol_orig, charge_results = charge_job
 
-			offmol = gen_charges_offmol(toolkit_wrapper, charge_method, offmol)
+		# save each newly charged partial charge set as soon as it is collected
+		# so an interrupted run does not have to charge it again
+		charge_sets = []
+		for i, charges, charged in charge_results:
+			if charged and run_manifest is not None:
+				run_manifest.save_set(offmol_orig.name, i, charges)
+			charge_sets.append(charges)
 
-			for j,a in enumerate(offmol.atoms):
-				if i == 0:
-					am1bcc_partial_charge_dict_list.append(dict())
-					am1bcc_partial_charge_dict_list[j]['idx'] = a.molecule_atom_index
-					am1bcc_partial_charge_dict_list[j]['atmnum'] = a.atomic_number
+		if adaptive:
+			print(f"{offmol_orig.name}: {len(charge_sets)} charge sets")
+			num_charge_sets_used.append((offmol_orig.name, len(charge_sets)))
 
-				am1bcc_partial_charge_dict_list[j][i] = a.partial_charge.magnitude
+		if not conformer_dependent:
+			if not check_conformer_independent(charge_sets):
+				print(f"WARNING: {offmol_orig.name} partial charges differ between conformers", file=sys.stderr)
+			# the charges of the first conformer are used for every partial charge set
+			charge_sets = [charge_sets[0]] * num_charge_sets
+
+		# step 3
+		# store the partial charges for each conformer as one column of an 
+		# atoms x sets matrix
+		charge_matrix = np.column_stack(list(charge_sets))
+		atom_idx = [a.molecule_atom_index for a in offmol_orig.atoms]
+		atmnum = [a.atomic_number for a in offmol_orig.atoms]
 
 		# step 4
-		# generate the partial charge statistics for atom in the molecule
-		for a_dict in am1bcc_partial_charge_dict_list:
-			charges = [a_dict[i] for i in range(num_charge_sets)]
-			mean = statistics.mean(charges)
-			stdev = statistics.stdev(charges)
-			var = statistics.stdev(charges) ** 2
-			a_dict['mean'] = mean
-			a_dict['stdev'] = stdev
-			a_dict['var'] = var
-			a_dict['range'] = abs(min(charges) - max(charges))
-
-
-		# step 5
-		# save the partial charges for each conformer as well as the statistics in
-		# a csv file
-		csv_dir_path = Path(f'{output_path}/{toolkit}_{charge_method}_charges/')
-		csv_dir_path.mkdir(exist_ok=True, parents=True)
-
-		csv_file_path = csv_dir_path / f'{toolkit}_{charge_method}_{offmol.name}_charges.csv'
-		# Define column headers
-		fieldnames = [k for k in am1bcc_partial_charge_dict_list[0]]
-		
-		# Write data to CSV file
-		with open(str(csv_file_path), mode='w', newline='') as file:
-			writer = csv.DictWriter(file, fieldnames=fieldnames)
-			
-			# Write header row
-			writer.writeheader()
-			
-			# Write data rows
-			for row in am1bcc_partial_charge_dict_list:
-				writer.writerow(row)
+		# save the partial charges for each conformer and the partial charge
+		# statistics for each atom in the charge store and/or a csv file
+		if charge_store is not None:
+			with tracing.span('write_store', molecule=offmol_orig.name):
+				charge_store.write(offmol_orig.name, atom_idx, atmnum, charge_matrix)
+
+		if 'csv' in output_formats:
+			csv_file_path = get_csv_path(output_path, toolkit, charge_method, offmol_orig.name)
+			csv_file_path.parent.mkdir(exist_ok=True, parents=True)
+			with tracing.span('write_csv', molecule=offmol_orig.name):
+				header, rows = get_charge_table(atom_idx, atmnum, charge_matrix)
+				write_table_csv(csv_file_path, header, rows)
+
+		if run_manifest is not None:
+			run_manifest.mark_done(offmol_orig.name)
+
+	if adaptive_charge_sets:
+		write_table_csv(
+			Path(f'{output_path}/{toolkit}_{charge_method}_num_charge_sets.csv'),
+			['name', 'num_charge_sets'],
+			num_charge_sets_used,
+		)
+
+	if charge_executor is not None:
+		charge_executor.shutdown()
+
+	# waits for the last conformers to be written
+	conformer_writer.close()
+
+	if charge_cache is not None:
+		print(f"charge cache: {charge_cache.stats()}")
+
+	if trace_dir is not None:
+		# the worker processes wrote their events as they shut down
+		tracing.flush()
+		tracing.write_chrome_trace(trace_dir, f'{trace_dir}/trace.json')
+		tracing.write_summary(trace_dir, f'{trace_dir}/summary')
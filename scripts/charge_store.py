@@ -0,0 +1,250 @@
+'''
+Compact binary store of the partial charges of many molecules generated with
+one (toolkit, charge method) pair, used instead of one csv file per molecule.
+
+A store is a directory holding
+	* charges.bin 	the atoms x sets partial charge matrix of every molecule,
+					one after another
+	* atoms.bin 	the atom index and atomic number of every atom (int32)
+	* stats.bin 	the mean, stdev, var and range of every atom (float64)
+	* index.json 	where each molecule's block starts in each file and its shape
+
+The binary files are memory-mapped when read, so the arrays returned by
+ChargeStore are views into the files and no text parsing or copying happens.
+'''
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from charge_analysis import STATISTICS, get_charge_matrix, get_statistics, write_table_csv
+
+INDEX_FILE = 'index.json'
+CHARGES_FILE = 'charges.bin'
+ATOMS_FILE = 'atoms.bin'
+STATS_FILE = 'stats.bin'
+
+
+def get_store_path(output_path, toolkit, charge_method):
+	''' returns the path of the charge store for the toolkit and charge_method
+	'''
+	return Path(f'{output_path}/{toolkit}_{charge_method}_charges.store')
+
+def get_csv_path(output_path, toolkit, charge_method, name):
+	''' returns the path of the charges csv of molecule name for the toolkit
+		and charge_method
+	'''
+	return Path(f'{output_path}/{toolkit}_{charge_method}_charges/{toolkit}_{charge_method}_{name}_charges.csv')
+
+def load_charge_matrix(output_path, toolkit, charge_method, name, charge_store=None):
+	''' returns the atoms x sets partial charge matrix of molecule name from
+		charge_store, or from its charges csv under output_path if None
+	'''
+	if charge_store is not None:
+		return np.array(charge_store.charges(name))
+	import pandas as pd
+	return get_charge_matrix(pd.read_csv(get_csv_path(output_path, toolkit, charge_method, name)))
+
+def get_charge_table(atom_idx, atmnum, charge_matrix, stats=None):
+	''' returns the header and rows of the charges csv table written by
+		charge_molecules.py: idx, atmnum, one column per partial charge set,
+		then the statistics of each atom across the sets
+
+		atom_idx: 			array of atom indices
+		atmnum: 			array of atomic numbers
+		charge_matrix: 		atoms x sets array of partial charges
+		stats: 				dictionary from get_statistics, computed if None
+	'''
+	charge_matrix = np.asarray(charge_matrix, dtype=np.float64)
+	if stats is None:
+		stats = get_statistics(charge_matrix)
+
+	header = ['idx', 'atmnum']
+	header += [str(i) for i in range(charge_matrix.shape[1])]
+	header += STATISTICS
+
+	columns = [np.asarray(atom_idx), np.asarray(atmnum)]
+	columns += list(charge_matrix.T)
+	columns += [np.asarray(stats[s], dtype=np.float64) for s in STATISTICS]
+
+	rows = zip(*[c.tolist() for c in columns])
+	return header, rows
+
+
+class ChargeStore:
+	''' Store of the partial charges of many molecules, see module docstring
+
+		path: 				str or Path of the store directory
+		mode: 				'r' to read an existing store, 'a' to create or add to one
+		dtype: 				dtype of the stored partial charges, only used when
+							creating a new store
+	'''
+
+	def __init__(self, path, mode='r', dtype='float64'):
+		self.path = Path(path)
+		self.mode = mode
+
+		if mode not in ('r', 'a'):
+			raise ValueError(f"mode must be 'r' or 'a', not {mode!r}")
+
+		index_path = self.path / INDEX_FILE
+		if index_path.exists():
+			with open(index_path) as f:
+				self._index = json.load(f)
+		elif mode == 'a':
+			self.path.mkdir(exist_ok=True, parents=True)
+			self._index = {'dtype': np.dtype(dtype).name, 'molecules': {}}
+			for file in (CHARGES_FILE, ATOMS_FILE, STATS_FILE):
+				(self.path / file).touch()
+			self._write_index()
+		else:
+			raise FileNotFoundError(f'No charge store found at {self.path}')
+
+		self.dtype = np.dtype(self._index['dtype'])
+		self._maps = {}
+		if mode == 'a':
+			self._truncate()
+
+	def names(self):
+		''' returns the names of the molecules in the store, in the order they
+			were written
+		'''
+		return list(self._index['molecules'])
+
+	def __contains__(self, name):
+		return name in self._index['molecules']
+
+	def __len__(self):
+		return len(self._index['molecules'])
+
+	def _write_index(self):
+		# write to a temporary file first so the index is never left half written
+		tmp_path = self.path / f'{INDEX_FILE}.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(self._index, f)
+		os.replace(tmp_path, self.path / INDEX_FILE)
+
+	def _extents(self):
+		''' returns the size (bytes) of each binary file covered by the index
+		'''
+		extents = {CHARGES_FILE: 0, ATOMS_FILE: 0, STATS_FILE: 0}
+		for e in self._index['molecules'].values():
+			extents[CHARGES_FILE] = max(extents[CHARGES_FILE], (e['offset'] + e['n_atoms'] * e['n_sets']) * self.dtype.itemsize)
+			extents[ATOMS_FILE] = max(extents[ATOMS_FILE], (e['atom_offset'] + e['n_atoms']) * 2 * 4)
+			extents[STATS_FILE] = max(extents[STATS_FILE], (e['stats_offset'] + e['n_atoms']) * len(STATISTICS) * 8)
+		return extents
+
+	def _truncate(self):
+		''' drops the data a write that was interrupted before its index update
+			left at the end of the binary files
+		'''
+		for file, size in self._extents().items():
+			if os.path.getsize(self.path / file) > size:
+				os.truncate(self.path / file, size)
+
+	def _map(self, file, dtype):
+		''' returns the memory map of one of the binary files, opened once
+		'''
+		if file not in self._maps:
+			if os.path.getsize(self.path / file) == 0:
+				return np.empty(0, dtype=dtype)
+			self._maps[file] = np.memmap(self.path / file, dtype=dtype, mode='r')
+		return self._maps[file]
+
+	def _append(self, file, array):
+		''' appends array to file, returns the element offset it was written at
+		'''
+		with open(self.path / file, 'ab') as f:
+			offset = f.tell() // array.itemsize
+			f.write(np.ascontiguousarray(array).tobytes())
+		# the file grew, existing maps no longer cover it
+		self._maps.pop(file, None)
+		return offset
+
+	def write(self, name, atom_idx, atmnum, charge_matrix):
+		''' adds the partial charges of the molecule called name to the store
+			Writing a name that is already in the store replaces it
+
+			name: 				str name of the molecule
+			atom_idx: 			array of atom indices
+			atmnum: 			array of atomic numbers
+			charge_matrix: 		atoms x sets array of partial charges
+		'''
+		if self.mode != 'a':
+			raise ValueError('ChargeStore was opened read only')
+
+		charge_matrix = np.asarray(charge_matrix, dtype=np.float64)
+		n_atoms, n_sets = charge_matrix.shape
+		stats = get_statistics(charge_matrix)
+
+		atoms = np.column_stack([atom_idx, atmnum]).astype(np.int32)
+		stats_matrix = np.column_stack([stats[s] for s in STATISTICS])
+
+		charge_offset = self._append(CHARGES_FILE, charge_matrix.astype(self.dtype))
+		atom_offset = self._append(ATOMS_FILE, atoms) // 2
+		stats_offset = self._append(STATS_FILE, stats_matrix) // len(STATISTICS)
+
+		# the index is only updated after all of the data has been written
+		self._index['molecules'][name] = {
+			'offset': charge_offset,
+			'atom_offset': atom_offset,
+			'stats_offset': stats_offset,
+			'n_atoms': n_atoms,
+			'n_sets': n_sets,
+		}
+		self._write_index()
+
+	def _entry(self, name):
+		try:
+			return self._index['molecules'][name]
+		except KeyError:
+			raise KeyError(f'{name} is not in the charge store {self.path}') from None
+
+	def charges(self, name):
+		''' returns the atoms x sets matrix of partial charges of molecule name
+			as a read only view into the store
+		'''
+		e = self._entry(name)
+		size = e['n_atoms'] * e['n_sets']
+		flat = self._map(CHARGES_FILE, self.dtype)
+		return flat[e['offset']:e['offset'] + size].reshape(e['n_atoms'], e['n_sets'])
+
+	def _atoms(self, name):
+		e = self._entry(name)
+		flat = self._map(ATOMS_FILE, np.int32)
+		start = 2 * e['atom_offset']
+		return flat[start:start + 2 * e['n_atoms']].reshape(e['n_atoms'], 2)
+
+	def atom_indices(self, name):
+		''' returns the atom indices of molecule name
+		'''
+		return self._atoms(name)[:, 0]
+
+	def atomic_numbers(self, name):
+		''' returns the atomic numbers of the atoms of molecule name
+		'''
+		return self._atoms(name)[:, 1]
+
+	def statistics(self, name):
+		''' returns a dictionary of the mean, stdev, var and range of the
+			partial charge at each atom of molecule name
+		'''
+		e = self._entry(name)
+		flat = self._map(STATS_FILE, np.float64)
+		start = len(STATISTICS) * e['stats_offset']
+		stats_matrix = flat[start:start + len(STATISTICS) * e['n_atoms']].reshape(e['n_atoms'], len(STATISTICS))
+		return {s: stats_matrix[:, i] for i, s in enumerate(STATISTICS)}
+
+	def export_csv(self, name, csv_file_path):
+		''' writes molecule name to a csv file in the format written by
+			charge_molecules.py
+		'''
+		header, rows = get_charge_table(
+			self.atom_indices(name),
+			self.atomic_numbers(name),
+			self.charges(name),
+			self.statistics(name),
+		)
+		write_table_csv(csv_file_path, header, rows)
@@ -0,0 +1,534 @@
+'''
+Charging helpers: the valid toolkit and charge method pairs, toolkit wrappers,
+and charging conformers serially, in a process pool or adaptively.
+
+Only numpy is imported with this module, OpenFF and openfe are imported by
+the functions that need them so that pool workers and analysis scripts do
+not pay for them up front.
+'''
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache
+import importlib
+import itertools
+import multiprocessing
+import multiprocessing.util
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from charge_analysis import ChargeAccumulator
+import tracing
+
+# registry of the toolkits that can be used, by the name used in the scripts
+# (module, class name) of the OpenFF toolkit wrapper of each toolkit, the
+# module is only imported when that toolkit is asked for
+TOOLKIT_WRAPPER_CLASSES = {
+	'ambertools': ('openff.toolkit.utils.ambertools_wrapper', 'AmberToolsToolkitWrapper'),
+	'openeye': ('openff.toolkit.utils.openeye_wrapper', 'OpenEyeToolkitWrapper'),
+	'nagl': ('openff.toolkit.utils.nagl_wrapper', 'NAGLToolkitWrapper'),
+}
+
+# every charge method of these toolkits assigns the same charges whatever the 
+# conformer(s) charged, the methods of the other toolkits are conformer dependent
+CONFORMER_INDEPENDENT_TOOLKITS = {'nagl'}
+
+# toolkit wrappers built so far in this process, by toolkit name
+_TOOLKIT_WRAPPERS = {}
+
+# toolkit wrapper owned by a charging worker process, built once by 
+# init_charge_worker and reused by every task that worker runs
+_WORKER_TOOLKIT_WRAPPER = None
+# charge cache of a charging worker process, handed to it once by init_charge_worker
+_WORKER_CHARGE_CACHE = None
+
+
+@lru_cache(maxsize=None)
+def get_toolkit_wrapper_class(toolkit):
+	''' returns the OpenFF toolkit wrapper class of toolkit, or None if the 
+		installed OpenFF toolkit does not have it
+	'''
+	module_name, class_name = TOOLKIT_WRAPPER_CLASSES[toolkit]
+	try:
+		return getattr(importlib.import_module(module_name), class_name)
+	except (ImportError, AttributeError):
+		return None
+
+def nagl_wrapper_exists():
+	''' returns True if the installed OpenFF toolkit has the NAGL toolkit wrapper
+	'''
+	return get_toolkit_wrapper_class('nagl') is not None
+
+def get_toolkit_wrapper(toolkit):
+	''' returns the toolkit wrapper of toolkit, only constructing it the first
+		time it is asked for in this process so license checks, executable 
+		discovery and model loading happen once and only for that toolkit
+
+		toolkit: 			str name of the toolkit, a key of TOOLKIT_WRAPPER_CLASSES
+	'''
+	if toolkit not in _TOOLKIT_WRAPPERS:
+		wrapper_class = get_toolkit_wrapper_class(toolkit)
+		if wrapper_class is None:
+			raise ValueError(f"The {toolkit} toolkit wrapper is not available in this environment")
+		_TOOLKIT_WRAPPERS[toolkit] = wrapper_class()
+	return _TOOLKIT_WRAPPERS[toolkit]
+
+@lru_cache(maxsize=None)
+def get_supported_charge_methods(toolkit):
+	''' returns the tuple of charge methods that toolkit can assign in this 
+		environment, empty if the toolkit is not installed or not available
+		(e.g. no OpenEye license or AmberTools executables)
+
+		toolkit: 			str name of the toolkit, a key of TOOLKIT_WRAPPER_CLASSES
+	'''
+	if toolkit not in TOOLKIT_WRAPPER_CLASSES:
+		return ()
+
+	wrapper_class = get_toolkit_wrapper_class(toolkit)
+	if wrapper_class is None or not wrapper_class.is_available():
+		return ()
+
+	# most wrappers list their methods on the class, the NAGL wrapper only
+	# finds its models when it is constructed
+	charge_methods = getattr(wrapper_class, '_supported_charge_methods', None)
+	if not charge_methods:
+		charge_methods = getattr(get_toolkit_wrapper(toolkit), '_supported_charge_methods', None) or ()
+	return tuple(str(method) for method in charge_methods)
+
+def get_valid_toolkit_charge():
+	''' returns a dictionary of the (toolkit, charge_method) pairs that can be 
+		used, tagged True if the charges they assign depend on the conformer(s)
+		that are charged and False if they are conformer independent
+		Every toolkit in TOOLKIT_WRAPPER_CLASSES is queried, use 
+		check_provided_charge_type to only query one
+	'''
+	return {
+		(toolkit, charge_method): is_conformer_dependent(toolkit, charge_method)
+		for toolkit in TOOLKIT_WRAPPER_CLASSES
+		for charge_method in get_supported_charge_methods(toolkit)
+	}
+
+def check_provided_charge_type(toolkit, charge_method):
+	return charge_method in get_supported_charge_methods(toolkit)
+
+def is_conformer_dependent(toolkit, charge_method):
+	''' returns True if the partial charges assigned by the toolkit and 
+		charge_method depend on the conformer(s) that are charged
+		Assumes toolkit and charge_method have been checked to confirm their
+		compatibility using check_provided_charge_type
+	'''
+	return toolkit not in CONFORMER_INDEPENDENT_TOOLKITS
+
+def check_conformer_independent(charge_sets, atol=1e-6):
+	''' returns True if every partial charge set in charge_sets matches the
+		first one to within atol (e)
+	'''
+	return all(np.allclose(charges, charge_sets[0], rtol=0, atol=atol) for charges in charge_sets[1:])
+
+
+def _assign_partial_charges(toolkit_wrapper, charge_method, offmol, charge_cache=None):
+	''' Assigns partial charges to offmol from its conformer(s), reusing the result
+		stored in charge_cache if the same conformer(s) have been charged before
+	'''
+	from openff.units import unit
+
+	if charge_cache is not None:
+		with tracing.span('cache_lookup', molecule=offmol.name):
+			charges = charge_cache.get(toolkit_wrapper, charge_method, offmol)
+		if charges is not None:
+			offmol.partial_charges = charges * unit.elementary_charge
+			return offmol
+
+	with tracing.span('charge', molecule=offmol.name, charge_method=charge_method, n_atoms=offmol.n_atoms):
+		offmol.assign_partial_charges(
+			charge_method, 
+			use_conformers=offmol.conformers,
+			toolkit_registry=toolkit_wrapper,
+		)
+
+	if charge_cache is not None:
+		charge_cache.put(toolkit_wrapper, charge_method, offmol, offmol.partial_charges.m_as(unit.elementary_charge))
+
+	return offmol
+
+def get_charges_array(offmol):
+	''' returns the partial charges of offmol (in units of e) as a numpy array
+	'''
+	from openff.units import unit
+
+	return offmol.partial_charges.m_as(unit.elementary_charge)
+
+def gen_charges_smc(toolkit_wrapper, charge_method, smc, offmol_orig, charge_cache=None):
+	''' Generates partial charges from the conformer(s) provided by the 
+		SmallMoleculeComponent (smc)
+		Creates a new SmallMoleculeComponent that uses the conformer 3D coordinates from the 
+		original OpenFF Molecule but with the charges from the smc
+		Assumes toolkit_wrapper and charge_method have been checked to confirm their
+		compatibility using check_provided_charge_type
+
+		toolkit_wrapper: 	ToolkitWrapper object
+		charge_method: 		str that can be provided to assign_partial_charges 
+		smc:				SmallMoleculeComponent object containing the conformer(s) you want to charge
+		offmol_orig: 		Molecule object containing the 3D conformer coordinates to be used
+		charge_cache: 		ChargeCache object to reuse previously generated charges from, or None
+	'''
+	import openfe
+	from openff.toolkit import Molecule
+
+	offmol = smc.to_openff()
+	offmol = _assign_partial_charges(toolkit_wrapper, charge_method, offmol, charge_cache)
+
+	offmol_orig_tmp = Molecule(offmol_orig)
+	
+	offmol_orig_tmp._partial_charges = offmol._partial_charges
+
+	return openfe.SmallMoleculeComponent.from_openff(offmol_orig_tmp)
+
+def get_charged_smc(offmol_orig, charges):
+	''' Creates a SmallMoleculeComponent with the conformer 3D coordinates of
+		offmol_orig and the partial charges (in units of e) charges, the same
+		as gen_charges_smc returns for charges generated earlier
+
+		offmol_orig: 		Molecule object containing the 3D conformer coordinates to be used
+		charges: 			array of the partial charge of each atom of offmol_orig
+	'''
+	import openfe
+	from openff.toolkit import Molecule
+	from openff.units import unit
+
+	offmol_orig_tmp = Molecule(offmol_orig)
+	offmol_orig_tmp.partial_charges = np.asarray(charges, dtype=np.float64) * unit.elementary_charge
+	return openfe.SmallMoleculeComponent.from_openff(offmol_orig_tmp)
+
+def gen_charges_offmol(toolkit_wrapper, charge_method, offmol, charge_cache=None):
+	''' Generates partial charges from the conformer(s) provided by the 
+		SmallMoleculeComponent (smc)
+		Creates a new SmallMoleculeComponent that uses the conformer 3D coordinates from the 
+		original OpenFF Molecule but with the charges from the smc
+		Assumes toolkit_wrapper and charge_method have been checked to confirm their
+		compatibility using check_provided_charge_type
+
+		toolkit_wrapper: 	ToolkitWrapper object
+		charge_method: 		str that can be provided to assign_partial_charges 
+		offmol_orig: 		Molecule object containing the conformer to charge
+		charge_cache: 		ChargeCache object to reuse previously generated charges from, or None
+	'''
+	return _assign_partial_charges(toolkit_wrapper, charge_method, offmol, charge_cache)
+
+def use_scratch_dir(scratch_parent):
+	''' Makes a new directory in scratch_parent the default directory of tempfile
+		for this process, so the input and output files antechamber and sqm 
+		write for every AmberTools AM1-BCC charge go there. A tmpfs such as 
+		/dev/shm keeps them in RAM. The directory is removed when the process 
+		exits. Returns the path of the directory
+
+		scratch_parent: 	str or Path of the directory to make the scratch directory in
+	'''
+	scratch_dir = tempfile.mkdtemp(prefix=f'charge_scratch_{os.getpid()}_', dir=scratch_parent)
+	tempfile.tempdir = scratch_dir
+	# run on exit by multiprocessing, in worker processes as well as the main one
+	multiprocessing.util.Finalize(None, shutil.rmtree, args=(scratch_dir,), kwargs={'ignore_errors': True}, exitpriority=0)
+	return scratch_dir
+
+def init_charge_worker(toolkit, scratch_parent=None, charge_cache=None):
+	''' Process pool initializer, builds the toolkit wrapper once per worker 
+		process so that each charging task does not have to
+
+		toolkit: 			str name of the toolkit, see get_toolkit_wrapper
+		scratch_parent: 	str or Path of the directory to make the worker's
+							scratch directory in, see use_scratch_dir, or None
+							to use the system temporary directory
+		charge_cache: 		ChargeCache object the worker's tasks use, or None
+	'''
+	global _WORKER_TOOLKIT_WRAPPER, _WORKER_CHARGE_CACHE
+	if scratch_parent is not None:
+		use_scratch_dir(scratch_parent)
+	_WORKER_TOOLKIT_WRAPPER = get_toolkit_wrapper(toolkit)
+	_WORKER_CHARGE_CACHE = charge_cache
+
+def _charge_conformer_task(task):
+	''' Charges a single conformer inside a worker process and returns the 
+		partial charges (in units of e) as a numpy array along with whether 
+		they came from the charge cache and the bytes it wrote to the cache
+	'''
+	charge_method, offmol, use_cache = task
+	charge_cache = None
+	if use_cache:
+		charge_cache = _WORKER_CHARGE_CACHE
+		if charge_cache is None:
+			raise ValueError('The charge executor was made without a charge cache, pass it to get_charge_executor')
+	hits = charge_cache.hits if charge_cache is not None else 0
+	bytes_written = charge_cache.bytes_written if charge_cache is not None else 0
+	offmol = gen_charges_offmol(_WORKER_TOOLKIT_WRAPPER, charge_method, offmol, charge_cache)
+	if charge_cache is None:
+		return get_charges_array(offmol), False, 0
+	return get_charges_array(offmol), charge_cache.hits > hits, charge_cache.bytes_written - bytes_written
+
+def _collect_charge_results(results, charge_cache):
+	''' Yields the charges returned by _charge_conformer_task, adding the cache
+		lookups and writes made inside the worker processes to charge_cache
+	'''
+	for charges, cache_hit, bytes_written in results:
+		if charge_cache is not None:
+			if cache_hit:
+				charge_cache.hits += 1
+			else:
+				charge_cache.misses += 1
+			if bytes_written:
+				charge_cache.bytes_written += bytes_written
+				charge_cache.track_write(bytes_written)
+		yield charges
+
+class RecyclingPool:
+	''' Process pool with the submit and shutdown methods of 
+		ProcessPoolExecutor that charge_conformers uses, where each worker process is replaced by a
+		fresh one after max_tasks_per_worker tasks. ProcessPoolExecutor's own 
+		max_tasks_per_child can deadlock once workers start exiting, so this 
+		uses multiprocessing.Pool
+
+		num_workers: 			int number of worker processes
+		max_tasks_per_worker: 	int number of tasks a worker runs before it is replaced
+		initializer: 			function run at the start of each worker process
+		initargs: 				tuple of arguments of initializer
+	'''
+
+	def __init__(self, num_workers, max_tasks_per_worker, initializer=None, initargs=()):
+		self._pool = multiprocessing.Pool(num_workers, initializer, initargs, maxtasksperchild=max_tasks_per_worker)
+
+	def submit(self, fn, *args):
+		''' submits fn(*args) and returns a Future of its result
+		'''
+		future = Future()
+		self._pool.apply_async(fn, args, callback=future.set_result, error_callback=future.set_exception)
+		return future
+
+	def shutdown(self, wait=True):
+		self._pool.close()
+		if wait:
+			self._pool.join()
+
+def get_charge_executor(toolkit, num_workers, max_tasks_per_worker=None, scratch_parent=None, charge_cache=None):
+	''' Returns a process pool for charging conformers in parallel, or None 
+		if the charging should be done serially in the current process
+
+		toolkit: 				str name of the toolkit, see get_toolkit_wrapper
+		num_workers: 			int number of worker processes
+		max_tasks_per_worker: 	int number of conformers a worker charges before it is
+								replaced by a new one, or None to keep every worker
+		scratch_parent: 		str or Path of the directory to make each worker's 
+								scratch directory in, see use_scratch_dir
+		charge_cache: 			ChargeCache object handed to each worker once, which
+								charge_conformers uses when given the same cache
+	'''
+	if num_workers is None or num_workers <= 1:
+		return None
+
+	if max_tasks_per_worker is not None:
+		return RecyclingPool(num_workers, max_tasks_per_worker, init_charge_worker, (toolkit, scratch_parent, charge_cache))
+
+	return ProcessPoolExecutor(
+		max_workers=num_workers,
+		initializer=init_charge_worker,
+		initargs=(toolkit, scratch_parent, charge_cache),
+	)
+
+def map_bounded(executor, fn, iterable, max_pending=None):
+	''' Submits fn for the items of iterable to executor and returns an 
+		iterator over the results in order. The first max_pending items are 
+		submitted straight away and one more each time a result is taken, so 
+		at most max_pending items (and their results) are held at once. 
+		None submits every item straight away
+
+		executor: 			process pool from get_charge_executor
+		fn: 				function to run on each item
+		iterable: 			iterable of items, only taken from as they are submitted
+		max_pending: 		int number of items submitted ahead of the results taken, or None
+	'''
+	iterable = iter(iterable)
+	pending = deque(executor.submit(fn, item) for item in itertools.islice(iterable, max_pending))
+
+	def _results():
+		while pending:
+			future = pending.popleft()
+			# the next item is submitted before waiting so the workers stay busy
+			pending.extend(executor.submit(fn, item) for item in itertools.islice(iterable, 1))
+			yield future.result()
+
+	return _results()
+
+def prefetch(iterable, num_ahead):
+	''' Yields the items of iterable, taking num_ahead items from it before
+		they are needed, e.g. so the charging of the next molecules is submitted
+		while the results of the current one are collected
+	'''
+	iterable = iter(iterable)
+	ahead = deque(itertools.islice(iterable, num_ahead))
+	while ahead:
+		item = ahead.popleft()
+		ahead.extend(itertools.islice(iterable, 1))
+		yield item
+
+def charge_conformers(charge_method, offmols, toolkit_wrapper=None, executor=None, charge_cache=None, max_pending=None):
+	''' Charges each OpenFF Molecule in offmols and returns the partial charges
+		(in units of e) of each one as a numpy array, in the same order as offmols
+		If an executor from get_charge_executor is given the molecules are 
+		submitted to the pool straight away, max_pending at a time (see 
+		map_bounded), and an iterator over the results is returned, so charging 
+		continues while the caller works on something else. Otherwise the 
+		molecules are charged serially with toolkit_wrapper, one at a time as 
+		the returned generator is consumed
+
+		charge_method: 		str that can be provided to assign_partial_charges 
+		offmols: 			iterable of Molecule objects, each containing the conformer(s) to charge
+		toolkit_wrapper: 	ToolkitWrapper object, used when charging serially
+		executor: 			process pool from get_charge_executor or None
+		charge_cache: 		ChargeCache object to reuse previously generated charges from, or None
+		max_pending: 		int number of molecules submitted to the executor ahead of 
+							the results taken, None submits all of them
+	'''
+	if executor is None:
+		return (
+			get_charges_array(gen_charges_offmol(toolkit_wrapper, charge_method, offmol, charge_cache))
+			for offmol in offmols
+		)
+
+	# the workers use the charge cache given to get_charge_executor
+	tasks = ((charge_method, offmol, charge_cache is not None) for offmol in offmols)
+	results = map_bounded(executor, _charge_conformer_task, tasks, max_pending)
+	return _collect_charge_results(results, charge_cache)
+
+def charge_missing_conformers(charge_method, rdmols_by_conf, completed_sets=None, toolkit_wrapper=None, executor=None, charge_cache=None, max_pending=None):
+	''' Charges the conformers in rdmols_by_conf whose index is not already in 
+		completed_sets, for example the charge sets saved by an interrupted run
+		Returns an iterator over (index, charges, charged) for every conformer 
+		in order, where charges are the partial charges (in units of e) and 
+		charged is False for the charge sets taken from completed_sets
+		Conformers are only taken from rdmols_by_conf and converted as they are
+		charged, so a generator of conformers is never held in memory at once
+		If an executor is given the first max_pending missing conformers are 
+		submitted straight away
+
+		charge_method: 		str that can be provided to assign_partial_charges 
+		rdmols_by_conf: 	iterable of rdkit Mols, each containing the conformer(s) to charge
+		completed_sets: 	dictionary of partial charge arrays by conformer index, or None
+		toolkit_wrapper: 	ToolkitWrapper object, used when charging serially
+		executor: 			process pool from get_charge_executor or None
+		charge_cache: 		ChargeCache object to reuse previously generated charges from, or None
+		max_pending: 		int number of conformers submitted to the executor ahead of 
+							the results taken, None submits all of them
+	'''
+	from openff.toolkit import Molecule
+
+	completed_sets = completed_sets or {}
+
+	# indices of the conformers handed to charge_conformers, in order, and
+	# the number of conformers once rdmols_by_conf has run out
+	charged_indices = deque()
+	num_confs = []
+
+	def _offmols():
+		i = -1
+		for i, rdmol in enumerate(rdmols_by_conf):
+			if i not in completed_sets:
+				with tracing.span('convert', molecule=tracing.mol_name(rdmol), conformer=i):
+					offmol = Molecule.from_rdkit(rdmol)
+				charged_indices.append(i)
+				yield offmol
+		num_confs.append(i + 1)
+
+	results = charge_conformers(charge_method, _offmols(), toolkit_wrapper, executor, charge_cache, max_pending)
+
+	def _merge():
+		next_i = 0
+		for charges in results:
+			charged_i = charged_indices.popleft()
+			for i in range(next_i, charged_i):
+				yield i, completed_sets[i], False
+			yield charged_i, charges, True
+			next_i = charged_i + 1
+		for i in range(next_i, num_confs[0]):
+			yield i, completed_sets[i], False
+
+	return _merge()
+
+def charge_pruned_conformers(charge_method, rdmols_by_conf, representatives, completed_sets=None, toolkit_wrapper=None, executor=None, charge_cache=None, max_pending=None):
+	''' Charges only the conformers in rdmols_by_conf that represent themselves
+		in representatives (see prune_conformers in conformers.py), each pruned
+		conformer gets a copy of the charges of its representative
+		Returns an iterator over (index, charges, charged) for every conformer 
+		in order, as charge_missing_conformers does, where charged is False for
+		the pruned conformers and the charge sets taken from completed_sets
+
+		charge_method: 		str that can be provided to assign_partial_charges 
+		rdmols_by_conf: 	iterable of rdkit Mols, each containing the conformer(s) to charge
+		representatives: 	array of the index of the representative of every conformer,
+							no greater than the conformer's own index
+		completed_sets: 	dictionary of partial charge arrays by conformer index, or None
+		toolkit_wrapper: 	ToolkitWrapper object, used when charging serially
+		executor: 			process pool from get_charge_executor or None
+		charge_cache: 		ChargeCache object to reuse previously generated charges from, or None
+		max_pending: 		int number of conformers submitted to the executor ahead of 
+							the results taken, None submits all of them
+	'''
+	completed_sets = completed_sets or {}
+	kept = [i for i, representative in enumerate(representatives) if representative == i]
+
+	# charge_missing_conformers indexes the kept conformers from 0
+	completed_kept = {k: completed_sets[i] for k, i in enumerate(kept) if i in completed_sets}
+	kept_rdmols = (rdmol for i, rdmol in enumerate(rdmols_by_conf) if representatives[i] == i)
+	results = charge_missing_conformers(
+		charge_method, kept_rdmols, completed_kept, toolkit_wrapper, executor, charge_cache, max_pending,
+	)
+
+	def _expand():
+		kept_charges = {}
+		for i, representative in enumerate(representatives):
+			if representative == i:
+				_, charges, charged = next(results)
+				kept_charges[i] = charges
+				yield i, charges, charged
+			else:
+				yield i, kept_charges[representative], False
+
+	return _expand()
+
+def charge_conformers_adaptive(charge_method, rdmols_by_conf, tolerance, min_charge_sets, batch_size, toolkit_wrapper=None, executor=None, charge_cache=None, completed_sets=None, max_pending=None):
+	''' Charges the conformers from rdmols_by_conf until the confidence 
+		interval on the stdev of the partial charge at every atom is narrower
+		than tolerance (see ChargeAccumulator.is_converged), checked every
+		batch_size partial charge sets, or until rdmols_by_conf runs out. 
+		Returns an iterator over (index, charges, charged) like 
+		charge_missing_conformers, that stops once the charges have converged
+		The conformers are submitted to the executor max_pending ahead of the
+		results taken, so the pool keeps charging while the convergence is 
+		checked and the next molecule can be started before this one has 
+		converged. Up to max_pending conformers submitted before the charges
+		converged are charged and not used
+
+		charge_method: 		str that can be provided to assign_partial_charges 
+		rdmols_by_conf: 	iterable of rdkit Mols, each containing the conformer(s) to charge
+		tolerance: 			float convergence tolerance on the stdev (e)
+		min_charge_sets: 	int minimum number of conformers to charge
+		batch_size: 		int number of partial charge sets between convergence checks
+		toolkit_wrapper: 	ToolkitWrapper object, used when charging serially
+		executor: 			process pool from get_charge_executor or None
+		charge_cache: 		ChargeCache object to reuse previously generated charges from, or None
+		completed_sets: 	dictionary of partial charge arrays by conformer index that 
+							do not need to be charged again, or None
+		max_pending: 		int number of conformers submitted to the executor ahead of 
+							the results taken, None submits all of them
+	'''
+	results = charge_missing_conformers(charge_method, rdmols_by_conf, completed_sets, toolkit_wrapper, executor, charge_cache, max_pending)
+
+	def _until_converged():
+		accumulator = ChargeAccumulator()
+		for i, charges, charged in results:
+			accumulator.update(charges)
+			yield i, charges, charged
+			if (i + 1) % batch_size == 0 and accumulator.is_converged(tolerance, min_charge_sets):
+				return
+
+	return _until_converged()
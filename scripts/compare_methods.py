@@ -0,0 +1,429 @@
+'''
+Script to compare the partial charges of several (toolkit, charge method)
+pairs across every molecule of one or more datasets (sdf files).
+
+The charges written by charge_molecules.py for each method are loaded into
+aligned methods x atoms and methods x bonds arrays of the mean and stdev
+across partial charge sets of the partial charge of each atom and the bond
+delta q of each bond, the atoms (bonds) of every molecule of a dataset one
+after another. Every comparison is then a single array operation over all
+molecules. The tables written are
+	* {output_prefix}_methods.csv 		the variability of each method: the mean,
+										95th percentile and max stdev and range
+	* {output_prefix}_pairs.csv 		the distribution of the difference between
+										every two methods of each quantity
+	* {output_prefix}_elements.csv 		the same by element (atoms) or pair of
+										elements (bonds), using atmnum
+	* {output_prefix}_molecules.csv 	the largest absolute difference between every
+										two methods in each molecule
+	* {output_prefix}_outliers.csv 		the atoms and bonds whose values differ the
+										most between methods
+The methods, pairs and elements tables also have rows for the datasets combined
+(dataset 'all').
+
+Usage, with the conda environment created from openfe.yaml
+	python compare_methods.py <input_path> <output_prefix> \\
+		--methods ambertools:am1bcc openeye:am1bcc openeye:am1bccelf10 nagl:openff-gnn-am1bcc-0.1.0-rc.1.pt
+where input_path is the output_path of charge_molecules.py, in which {dataset}
+is replaced by the name of each sdf file (e.g. PLB_tyk2), and every sdf file
+in ../molecules is compared unless --sdf-files is given
+'''
+
+import argparse
+import itertools
+import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from rdkit import Chem
+
+from charge_analysis import calc_bond_dq, get_bond_index_array, get_statistics, write_table_csv
+from charge_store import ChargeStore, get_store_path, load_charge_matrix
+
+MOLECULES_DIR = Path(__file__).resolve().parent.parent / 'molecules'
+
+# statistics across partial charge sets compared between methods
+QUANTITIES = ['mean', 'stdev']
+PERCENTILES = [50, 95, 99]
+DIFFERENCE_SUMMARY = ['n', 'mean_diff', 'mean_abs_diff', 'rms_diff'] + [f'p{p}_abs_diff' for p in PERCENTILES] + ['max_abs_diff']
+
+_PERIODIC_TABLE = Chem.GetPeriodicTable()
+
+
+class AlignedStatistics:
+	''' Statistics of the atoms (or bonds) of every molecule of a dataset for
+		several methods, aligned so item k is the same atom (bond) for every method
+
+		molecule: 			int array of the index of the molecule of each item,
+							the items of a molecule being next to each other
+		labels: 			array of the atom index ('12') or the atom indices of
+							the bond ('3-12') of each item in its molecule
+		elements: 			array of the element ('C') or the pair of elements
+							('C-O') of each item
+		stats: 				dictionary of methods x items arrays of each statistic,
+							NaN where a method has no charges for the molecule
+	'''
+
+	def __init__(self, molecule, labels, elements, stats):
+		self.molecule = np.asarray(molecule, dtype=np.intp)
+		self.labels = np.asarray(labels)
+		self.elements = np.asarray(elements)
+		self.stats = stats
+
+	def __len__(self):
+		return len(self.molecule)
+
+	@staticmethod
+	def concatenate(aligned_list, num_molecules):
+		''' returns the AlignedStatistics of the molecules of every dataset of
+			aligned_list one after another, num_molecules being the number of
+			molecules of each dataset
+		'''
+		offsets = np.cumsum([0] + list(num_molecules[:-1]))
+		return AlignedStatistics(
+			np.concatenate([a.molecule + offset for a, offset in zip(aligned_list, offsets)]),
+			np.concatenate([a.labels for a in aligned_list]),
+			np.concatenate([a.elements for a in aligned_list]),
+			{stat: np.concatenate([a.stats[stat] for a in aligned_list], axis=1) for stat in aligned_list[0].stats},
+		)
+
+
+class Dataset:
+	''' Partial charge statistics of the molecules of one sdf file for every
+		method, see load_dataset
+
+		name: 				str name of the dataset
+		methods: 			list of 'toolkit:charge_method' strings
+		molecules: 			list of the molecule names
+		atoms: 				AlignedStatistics of the partial charge of every atom
+		bonds: 				AlignedStatistics of the bond delta q of every bond
+		missing: 			methods x molecules bool array, True where a method
+							has no charges for a molecule
+	'''
+
+	def __init__(self, name, methods, molecules, atoms, bonds, missing):
+		self.name = name
+		self.methods = methods
+		self.molecules = molecules
+		self.atoms = atoms
+		self.bonds = bonds
+		self.missing = missing
+
+	@staticmethod
+	def concatenate(datasets, name='all'):
+		''' returns a Dataset of the molecules of every one of datasets
+		'''
+		num_molecules = [len(d.molecules) for d in datasets]
+		return Dataset(
+			name,
+			datasets[0].methods,
+			[molecule for d in datasets for molecule in d.molecules],
+			AlignedStatistics.concatenate([d.atoms for d in datasets], num_molecules),
+			AlignedStatistics.concatenate([d.bonds for d in datasets], num_molecules),
+			np.concatenate([d.missing for d in datasets], axis=1),
+		)
+
+
+def parse_method(method):
+	''' returns the (toolkit, charge_method) of a 'toolkit:charge_method' string
+	'''
+	toolkit, _, charge_method = method.partition(':')
+	if not charge_method:
+		raise ValueError(f"methods must be given as toolkit:charge_method, not {method!r}")
+	return toolkit, charge_method
+
+def _load_statistics(input_path, method, rdmol, bond_atoms, charge_store):
+	''' returns the statistics of the partial charges and bond delta q of rdmol
+		for method, or None if they are missing or do not match rdmol
+	'''
+	toolkit, charge_method = parse_method(method)
+	name = rdmol.GetProp('_Name')
+	try:
+		charge_matrix = load_charge_matrix(input_path, toolkit, charge_method, name, charge_store)
+	except (FileNotFoundError, KeyError):
+		return None
+	if charge_matrix.shape[0] != rdmol.GetNumAtoms():
+		print(f"WARNING: {method} charges of {name} do not match its {rdmol.GetNumAtoms()} atoms, skipped", file=sys.stderr)
+		return None
+	return get_statistics(charge_matrix), get_statistics(calc_bond_dq(charge_matrix, bond_atoms))
+
+def load_dataset(sdf_file, input_path, methods, input_format='csv', max_workers=8):
+	''' returns the Dataset of the molecules of sdf_file with the charges of
+		every method, loaded in parallel
+
+		sdf_file: 			str or Path of the sdf file of the molecules
+		input_path: 		str output_path of charge_molecules.py, {dataset} is
+							replaced by the name of the sdf file
+		methods: 			list of 'toolkit:charge_method' strings
+		input_format: 		'csv' reads the per molecule csv files, 'store' the charge stores
+		max_workers: 		int number of threads loading charges
+	'''
+	name = Path(sdf_file).stem
+	input_path = str(input_path).replace('{dataset}', name)
+	rdmols = [mol for mol in Chem.SDMolSupplier(str(sdf_file), removeHs=False)]
+
+	charge_stores = {}
+	for method in methods:
+		store_path = get_store_path(input_path, *parse_method(method))
+		charge_stores[method] = ChargeStore(store_path) if input_format == 'store' and store_path.exists() else None
+
+	molecule, atom_labels, atom_elements = [], [], []
+	bond_molecule, bond_labels, bond_elements = [], [], []
+	bond_atoms_by_mol = []
+	for i, rdmol in enumerate(rdmols):
+		symbols = np.array([atom.GetSymbol() for atom in rdmol.GetAtoms()])
+		atmnums = np.array([atom.GetAtomicNum() for atom in rdmol.GetAtoms()])
+		bond_atoms = get_bond_index_array(rdmol)
+		bond_atoms_by_mol.append(bond_atoms)
+
+		molecule += [i] * len(symbols)
+		atom_labels += [str(a) for a in range(len(symbols))]
+		atom_elements += list(symbols)
+
+		# element pairs are ordered by atomic number so C-O and O-C bonds are grouped
+		order = np.argsort(atmnums[bond_atoms], axis=1, kind='stable')
+		ordered = np.take_along_axis(bond_atoms, order, axis=1)
+		bond_molecule += [i] * len(bond_atoms)
+		bond_labels += [f'{a1}-{a2}' for a1, a2 in bond_atoms]
+		bond_elements += [f'{symbols[a1]}-{symbols[a2]}' for a1, a2 in ordered]
+
+	tasks = [
+		(input_path, method, rdmol, bond_atoms, charge_stores[method])
+		for method in methods for rdmol, bond_atoms in zip(rdmols, bond_atoms_by_mol)
+	]
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		results = list(executor.map(lambda task: _load_statistics(*task), tasks))
+
+	atom_offsets = np.cumsum([0] + [mol.GetNumAtoms() for mol in rdmols])
+	bond_offsets = np.cumsum([0] + [len(bond_atoms) for bond_atoms in bond_atoms_by_mol])
+	atom_stats = {stat: np.full((len(methods), atom_offsets[-1]), np.nan) for stat in QUANTITIES + ['range']}
+	bond_stats = {stat: np.full((len(methods), bond_offsets[-1]), np.nan) for stat in QUANTITIES + ['range']}
+	missing = np.ones((len(methods), len(rdmols)), dtype=bool)
+
+	for k, result in enumerate(results):
+		if result is None:
+			continue
+		m, i = divmod(k, len(rdmols))
+		missing[m, i] = False
+		for stats, loaded, offsets in [(atom_stats, result[0], atom_offsets), (bond_stats, result[1], bond_offsets)]:
+			for stat in stats:
+				stats[stat][m, offsets[i]:offsets[i + 1]] = loaded[stat]
+
+	return Dataset(
+		name, list(methods), [mol.GetProp('_Name') for mol in rdmols],
+		AlignedStatistics(molecule, atom_labels, atom_elements, atom_stats),
+		AlignedStatistics(bond_molecule, bond_labels, bond_elements, bond_stats),
+		missing,
+	)
+
+def get_method_pairs(methods):
+	''' returns every (a, b) pair of indices into methods, a < b
+	'''
+	return list(itertools.combinations(range(len(methods)), 2))
+
+def get_pair_differences(values, pairs):
+	''' returns the pairs x items array of values[a] - values[b] for every
+		(a, b) of pairs, values being a methods x items array
+	'''
+	a, b = np.array(pairs, dtype=np.intp).reshape(-1, 2).T
+	return values[a] - values[b]
+
+def summarize_differences(diffs):
+	''' returns a dictionary of the DIFFERENCE_SUMMARY statistics of each row
+		of the 2D array diffs, ignoring NaN. Rows of only NaN give NaN
+	'''
+	abs_diffs = np.abs(diffs)
+	with warnings.catch_warnings():
+		# all NaN rows, i.e. methods without charges for any of the items
+		warnings.simplefilter('ignore', RuntimeWarning)
+		summary = {
+			'n': np.sum(~np.isnan(diffs), axis=1),
+			'mean_diff': np.nanmean(diffs, axis=1),
+			'mean_abs_diff': np.nanmean(abs_diffs, axis=1),
+			'rms_diff': np.sqrt(np.nanmean(diffs ** 2, axis=1)),
+		}
+		percentiles = np.nanpercentile(abs_diffs, PERCENTILES, axis=1) if diffs.shape[1] else np.full((len(PERCENTILES), len(diffs)), np.nan)
+		for p, values in zip(PERCENTILES, percentiles):
+			summary[f'p{p}_abs_diff'] = values
+		summary['max_abs_diff'] = np.nanmax(abs_diffs, axis=1) if diffs.shape[1] else np.full(len(diffs), np.nan)
+	return summary
+
+def _levels(dataset):
+	return [('atom', dataset.atoms), ('bond', dataset.bonds)]
+
+def _pair_names(dataset, pairs):
+	return [(dataset.methods[a], dataset.methods[b]) for a, b in pairs]
+
+def get_method_rows(dataset):
+	''' returns the rows of the methods table of dataset: the number of
+		molecules with charges and the mean, 95th percentile and max of the
+		stdev and range of each method, for atoms and bonds
+	'''
+	rows = []
+	for level, aligned in _levels(dataset):
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', RuntimeWarning)
+			columns = []
+			for stat in ['stdev', 'range']:
+				values = aligned.stats[stat]
+				columns += [np.nanmean(values, axis=1), np.nanpercentile(values, 95, axis=1), np.nanmax(values, axis=1)]
+		for m, method in enumerate(dataset.methods):
+			rows.append([dataset.name, level, method, int((~dataset.missing[m]).sum())] + [float(c[m]) for c in columns])
+	return rows
+
+def get_pair_rows(dataset, pairs):
+	''' returns the rows of the pairs table of dataset: the summary of the
+		differences between each pair of methods of each quantity
+	'''
+	rows = []
+	for level, aligned in _levels(dataset):
+		for quantity in QUANTITIES:
+			summary = summarize_differences(get_pair_differences(aligned.stats[quantity], pairs))
+			for p, (method_a, method_b) in enumerate(_pair_names(dataset, pairs)):
+				rows.append([dataset.name, level, quantity, method_a, method_b] + [summary[s][p].item() for s in DIFFERENCE_SUMMARY])
+	return rows
+
+def get_element_rows(dataset, pairs):
+	''' returns the rows of the elements table of dataset: the summary of the
+		differences between each pair of methods of each quantity, by element
+		for atoms and by pair of elements for bonds
+	'''
+	rows = []
+	for level, aligned in _levels(dataset):
+		elements, inverse = np.unique(aligned.elements, return_inverse=True)
+		for quantity in QUANTITIES:
+			diffs = get_pair_differences(aligned.stats[quantity], pairs)
+			for e, element in enumerate(elements):
+				summary = summarize_differences(diffs[:, inverse == e])
+				for p, (method_a, method_b) in enumerate(_pair_names(dataset, pairs)):
+					rows.append([dataset.name, level, element, quantity, method_a, method_b] + [summary[s][p].item() for s in DIFFERENCE_SUMMARY])
+	return rows
+
+def get_molecule_rows(dataset, pairs):
+	''' returns the rows of the molecules table of dataset: the largest
+		absolute difference between each pair of methods of each quantity
+		over the atoms and the bonds of each molecule
+	'''
+	header_quantities = []
+	columns = []
+	for level, aligned in _levels(dataset):
+		# the items of each molecule are next to each other, so one reduceat
+		# gives the largest difference in every molecule
+		starts = np.searchsorted(aligned.molecule, np.arange(len(dataset.molecules)))
+		has_items = np.bincount(aligned.molecule, minlength=len(dataset.molecules)) > 0
+		for quantity in QUANTITIES:
+			abs_diffs = np.abs(get_pair_differences(aligned.stats[quantity], pairs))
+			max_abs = np.full((len(pairs), len(dataset.molecules)), np.nan)
+			if len(aligned):
+				max_abs[:, has_items] = np.fmax.reduceat(abs_diffs, starts[has_items], axis=1)
+			header_quantities.append(f'{level}_{quantity}')
+			columns.append(max_abs)
+
+	rows = []
+	for p, (method_a, method_b) in enumerate(_pair_names(dataset, pairs)):
+		for i, molecule in enumerate(dataset.molecules):
+			rows.append([dataset.name, molecule, method_a, method_b] + [float(c[p, i]) for c in columns])
+	return header_quantities, rows
+
+def get_outlier_rows(dataset, pairs, num_outliers=20):
+	''' returns the rows of the outliers table of dataset: for atoms and bonds
+		and each quantity, the num_outliers items with the largest absolute
+		difference between any two methods, the pair of methods it is between
+		and the value of every method
+	'''
+	rows = []
+	for level, aligned in _levels(dataset):
+		for quantity in QUANTITIES:
+			abs_diffs = np.abs(get_pair_differences(aligned.stats[quantity], pairs))
+			# items without charges from any pair of methods are ranked last
+			scores = np.where(np.isnan(abs_diffs), -np.inf, abs_diffs)
+			worst_pair = np.argmax(scores, axis=0)
+			worst = scores[worst_pair, np.arange(scores.shape[1])]
+
+			num = min(num_outliers, int(np.isfinite(worst).sum()))
+			top = np.argpartition(-worst, num - 1)[:num] if num else np.array([], dtype=np.intp)
+			top = top[np.argsort(-worst[top], kind='stable')]
+			for rank, k in enumerate(top, start=1):
+				a, b = pairs[worst_pair[k]]
+				rows.append([
+					dataset.name, level, quantity, rank, dataset.molecules[aligned.molecule[k]],
+					str(aligned.labels[k]), str(aligned.elements[k]), dataset.methods[a], dataset.methods[b], float(worst[k]),
+				] + [float(v) for v in aligned.stats[quantity][:, k]])
+	return rows
+
+def write_comparison(datasets, output_prefix, num_outliers=20):
+	''' writes the methods, pairs, elements, molecules and outliers tables of
+		datasets, see the module docstring, and returns the pairs table rows
+	'''
+	methods = datasets[0].methods
+	pairs = get_method_pairs(methods)
+	combined = datasets + [Dataset.concatenate(datasets)] if len(datasets) > 1 else datasets
+
+	method_rows = [row for d in combined for row in get_method_rows(d)]
+	write_table_csv(
+		f'{output_prefix}_methods.csv',
+		['dataset', 'level', 'method', 'n_molecules', 'stdev_mean', 'stdev_p95', 'stdev_max', 'range_mean', 'range_p95', 'range_max'],
+		method_rows,
+	)
+
+	pair_rows = [row for d in combined for row in get_pair_rows(d, pairs)]
+	write_table_csv(f'{output_prefix}_pairs.csv', ['dataset', 'level', 'quantity', 'method_a', 'method_b'] + DIFFERENCE_SUMMARY, pair_rows)
+
+	element_rows = [row for d in combined for row in get_element_rows(d, pairs)]
+	write_table_csv(f'{output_prefix}_elements.csv', ['dataset', 'level', 'element', 'quantity', 'method_a', 'method_b'] + DIFFERENCE_SUMMARY, element_rows)
+
+	molecule_rows = []
+	for d in datasets:
+		header_quantities, rows = get_molecule_rows(d, pairs)
+		molecule_rows += rows
+	write_table_csv(
+		f'{output_prefix}_molecules.csv',
+		['dataset', 'molecule', 'method_a', 'method_b'] + [f'{q}_max_abs_diff' for q in header_quantities],
+		molecule_rows,
+	)
+
+	outlier_rows = [row for d in datasets for row in get_outlier_rows(d, pairs, num_outliers)]
+	write_table_csv(
+		f'{output_prefix}_outliers.csv',
+		['dataset', 'level', 'quantity', 'rank', 'molecule', 'label', 'element', 'method_a', 'method_b', 'abs_diff'] + methods,
+		outlier_rows,
+	)
+	return pair_rows
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('input_path', help='output_path of charge_molecules.py, {dataset} is replaced by the name of each sdf file')
+	parser.add_argument('output_prefix', help='prefix of the csv tables written')
+	parser.add_argument('--methods', nargs='+', required=True, help='methods to compare, as toolkit:charge_method')
+	parser.add_argument('--sdf-files', nargs='*', type=Path, help=f'datasets to compare, every sdf file in {MOLECULES_DIR} by default')
+	parser.add_argument('--input-format', choices=['csv', 'store'], default='csv', help='read the csv files or the charge stores')
+	parser.add_argument('--num-outliers', type=int, default=20, help='number of atoms and bonds in the outliers table per quantity')
+	parser.add_argument('--workers', type=int, default=8, help='number of threads loading charges')
+	args = parser.parse_args()
+
+	if len(args.methods) < 2:
+		parser.error('at least two methods are needed')
+
+	sdf_files = args.sdf_files or sorted(MOLECULES_DIR.glob('*.sdf'))
+	datasets = []
+	for sdf_file in sdf_files:
+		dataset = load_dataset(sdf_file, args.input_path, args.methods, args.input_format, args.workers)
+		for method, missing in zip(dataset.methods, dataset.missing):
+			if missing.any():
+				print(f"WARNING: {dataset.name} has no {method} charges for {int(missing.sum())} of {len(missing)} molecules", file=sys.stderr)
+		datasets.append(dataset)
+
+	Path(args.output_prefix).parent.mkdir(exist_ok=True, parents=True)
+	pair_rows = write_comparison(datasets, args.output_prefix, args.num_outliers)
+
+	print(f"{'dataset':<24}{'level':<6}{'quantity':<10}{'methods':<60}{'mean |d|':>10}{'p95 |d|':>10}{'max |d|':>10}")
+	for dataset, level, quantity, method_a, method_b, *summary in pair_rows:
+		values = dict(zip(DIFFERENCE_SUMMARY, summary))
+		print(
+			f"{dataset:<24}{level:<6}{quantity:<10}{method_a + ' vs ' + method_b:<60}"
+			f"{values['mean_abs_diff']:>10.4f}{values['p95_abs_diff']:>10.4f}{values['max_abs_diff']:>10.4f}"
+		)
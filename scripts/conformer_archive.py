@@ -0,0 +1,242 @@
+'''
+Indexed archive of the conformers embedded for many molecules, used instead of
+one .oeb.gz file per molecule (and per seed for AM1-BCC ELF10) for record
+keeping.
+
+An archive is a directory holding
+	* conformers.bin 	one zlib compressed block of conformer coordinates
+						(conformers x atoms x 3, Angstrom) per molecule and seed,
+						appended one after another
+	* index.json 		the molblock of each molecule and where the block of
+						each of its seeds starts, its size and number of conformers
+
+Each block is compressed on its own, so reading the conformers of one seed
+only reads and decompresses that block. Blocks are written before the index
+that points to them, so an interrupted write leaves the archive readable.
+
+BackgroundWriter runs writes like ConformerArchive.append or write_confs_oeb
+in a background thread, so the charging loop does not wait on compression and
+file I/O.
+
+To write the .oeb.gz file of every molecule and seed of an archive, run
+	python conformer_archive.py export-oeb <archive> <directory>
+'''
+
+import json
+import os
+import queue
+import sys
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+from rdkit import Chem
+
+from conformer_pool import mol_from_coordinates
+
+INDEX_FILE = 'index.json'
+DATA_FILE = 'conformers.bin'
+
+# zlib compression level of the coordinate blocks
+COMPRESSION_LEVEL = 6
+
+
+def get_archive_path(output_path):
+	''' returns the path of the conformer archive of a charge_molecules.py run
+	'''
+	return Path(f'{output_path}/conformers.archive')
+
+def get_coordinates(rdmol_w_confs):
+	''' returns the conformers x atoms x 3 array of the coordinates (Angstrom)
+		of every conformer of rdmol_w_confs
+	'''
+	return np.array(
+		[conf.GetPositions() for conf in rdmol_w_confs.GetConformers()],
+		dtype=np.float64,
+	).reshape(-1, rdmol_w_confs.GetNumAtoms(), 3)
+
+
+class ConformerArchive:
+	''' Archive of conformers by molecule name and seed, see module docstring
+
+		path: 				str or Path of the archive directory
+		mode: 				'r' to read an existing archive, 'a' to create or add to one
+	'''
+
+	def __init__(self, path, mode='r'):
+		self.path = Path(path)
+		self.mode = mode
+
+		if mode not in ('r', 'a'):
+			raise ValueError(f"mode must be 'r' or 'a', not {mode!r}")
+
+		index_path = self.path / INDEX_FILE
+		if index_path.exists():
+			with open(index_path) as f:
+				self._index = json.load(f)
+		elif mode == 'a':
+			self.path.mkdir(exist_ok=True, parents=True)
+			(self.path / DATA_FILE).touch()
+			self._index = {'molecules': {}}
+			self._write_index()
+		else:
+			raise FileNotFoundError(f'No conformer archive found at {self.path}')
+
+	def names(self):
+		''' returns the names of the molecules in the archive
+		'''
+		return list(self._index['molecules'])
+
+	def seeds(self, name):
+		''' returns the seeds of the conformer blocks of molecule name
+		'''
+		return [int(seed) for seed in self._entry(name)['seeds']]
+
+	def __contains__(self, key):
+		''' True if the archive holds molecule name, or (name, seed)
+		'''
+		if isinstance(key, tuple):
+			name, seed = key
+			return name in self._index['molecules'] and str(seed) in self._index['molecules'][name]['seeds']
+		return key in self._index['molecules']
+
+	def _entry(self, name):
+		try:
+			return self._index['molecules'][name]
+		except KeyError:
+			raise KeyError(f'{name} is not in the conformer archive {self.path}') from None
+
+	def _write_index(self):
+		# write to a temporary file first so the index is never left half written
+		tmp_path = self.path / f'{INDEX_FILE}.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(self._index, f)
+		os.replace(tmp_path, self.path / INDEX_FILE)
+
+	def append(self, rdmol_w_confs, seed):
+		''' adds the conformers of rdmol_w_confs embedded with seed, replacing
+			the block of a seed already in the archive
+
+			rdmol_w_confs: 		rdkit Mol with a _Name and the conformers to add
+			seed: 				int random seed the conformers were embedded with
+		'''
+		if self.mode != 'a':
+			raise ValueError('The conformer archive was opened read only')
+
+		name = rdmol_w_confs.GetProp('_Name')
+		smiles = Chem.MolToSmiles(rdmol_w_confs)
+		entry = self._index['molecules'].get(name)
+		if entry is None:
+			entry = {'smiles': smiles, 'molblock': Chem.MolToMolBlock(rdmol_w_confs, includeStereo=True), 'seeds': {}}
+		elif entry['smiles'] != smiles:
+			raise ValueError(f'{name} is already in the conformer archive as a different molecule')
+
+		coordinates = get_coordinates(rdmol_w_confs)
+		block = zlib.compress(coordinates.tobytes(), COMPRESSION_LEVEL)
+		data_path = self.path / DATA_FILE
+		with open(data_path, 'ab') as f:
+			offset = f.seek(0, os.SEEK_END)
+			f.write(block)
+
+		entry['seeds'][str(seed)] = {'offset': offset, 'size': len(block), 'n_confs': len(coordinates)}
+		self._index['molecules'][name] = entry
+		self._write_index()
+
+	def read_coordinates(self, name, seed, conformer_ids=None):
+		''' returns the coordinates (conformers x atoms x 3 array, Angstrom) of
+			the conformers of molecule name embedded with seed, only those of
+			conformer_ids if given
+		'''
+		entry = self._entry(name)
+		try:
+			block = entry['seeds'][str(seed)]
+		except KeyError:
+			raise KeyError(f'{name} has no conformers for seed {seed} in the conformer archive {self.path}') from None
+
+		with open(self.path / DATA_FILE, 'rb') as f:
+			f.seek(block['offset'])
+			data = zlib.decompress(f.read(block['size']))
+		coordinates = np.frombuffer(data, dtype=np.float64).reshape(block['n_confs'], -1, 3)
+		if conformer_ids is not None:
+			coordinates = coordinates[np.asarray(conformer_ids, dtype=np.intp)]
+		return coordinates
+
+	def read_mol(self, name, seed, conformer_ids=None):
+		''' returns an rdkit Mol of molecule name with the conformers embedded
+			with seed as its conformers, only those of conformer_ids if given
+		'''
+		rdmol = Chem.MolFromMolBlock(self._entry(name)['molblock'], removeHs=False)
+		rdmol.SetProp('_Name', name)
+		return mol_from_coordinates(rdmol, self.read_coordinates(name, seed, conformer_ids))
+
+	def export_oeb(self, name, seed, oeb_path):
+		''' writes the conformers of molecule name embedded with seed to a
+			.oeb.gz file
+		'''
+		from conformers import write_confs_oeb
+		write_confs_oeb(self.read_mol(name, seed), oeb_path)
+
+
+class BackgroundWriter:
+	''' Runs functions submitted to it one at a time, in order, in a background
+		thread. An error raised by one of them is raised again by the next
+		submit or by close, which waits for every submitted function to finish
+
+		max_pending: 		int number of submitted functions that can wait to be
+							run before submit blocks, bounding the memory they hold
+	'''
+
+	_STOP = object()
+
+	def __init__(self, max_pending=8):
+		self._queue = queue.Queue(maxsize=max_pending)
+		self._error = None
+		self._thread = threading.Thread(target=self._run, name='BackgroundWriter', daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is self._STOP:
+				return
+			function, args = item
+			# once a write has failed the remaining ones are skipped
+			if self._error is None:
+				try:
+					function(*args)
+				except Exception as e:
+					self._error = e
+
+	def _raise_error(self):
+		if self._error is not None:
+			raise self._error
+
+	def submit(self, function, *args):
+		''' runs function(*args) in the background thread
+		'''
+		self._raise_error()
+		self._queue.put((function, args))
+
+	def close(self):
+		''' waits for every submitted function to finish and stops the thread
+		'''
+		if self._thread.is_alive():
+			self._queue.put(self._STOP)
+			self._thread.join()
+		self._raise_error()
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 4 or sys.argv[1] != 'export-oeb':
+		print("usage: python conformer_archive.py export-oeb <archive> <directory>", file=sys.stderr)
+		sys.exit(1)
+
+	archive = ConformerArchive(sys.argv[2])
+	outdir = Path(sys.argv[3])
+	for name in archive.names():
+		(outdir / name).mkdir(exist_ok=True, parents=True)
+		for seed in archive.seeds(name):
+			oeb_path = outdir / name / f'{name}_{seed}.oeb.gz'
+			archive.export_oeb(name, seed, oeb_path)
+			print(oeb_path)
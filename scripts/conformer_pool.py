@@ -0,0 +1,130 @@
+'''
+Persistent pool of embedded conformers so that conformers generated for a
+molecule with a given random seed are reused by later runs instead of being
+embedded again.
+
+The pool holds one directory per molecule, named after the molecule and a
+short hash of its canonical SMILES so that molecules without a name, or
+sharing one, do not overwrite each other's conformers, with
+	* seed_{seed}.npy 	conformer coordinates (conformers x atoms x 3, Angstrom)
+	* index.json 		the SMILES of the molecule and the number of conformers
+						requested for each seed
+
+RDKit embeds the same conformers for a seed whatever the number of conformers
+requested, only adding more to the end, so a request for fewer conformers
+than are stored is answered with the first conformers of that seed.
+'''
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from rdkit import Chem
+from rdkit.Chem import AllChem
+from rdkit.Geometry import Point3D
+
+INDEX_FILE = 'index.json'
+
+
+class ConformerPool:
+	''' Pool of embedded conformers stored in pool_dir, see module docstring
+
+		pool_dir: 			str or Path of the directory holding the pool
+	'''
+
+	def __init__(self, pool_dir):
+		self.pool_dir = Path(pool_dir)
+		self.pool_dir.mkdir(exist_ok=True, parents=True)
+		self.embedded = 0
+		self.reused = 0
+
+	def _mol_dir(self, rdmol, smiles):
+		name = rdmol.GetProp('_Name') if rdmol.HasProp('_Name') else ''
+		smiles_hash = hashlib.sha1(smiles.encode()).hexdigest()[:10]
+		return self.pool_dir / f'{name}_{smiles_hash}'
+
+	def _read_index(self, mol_dir, smiles):
+		''' returns the index of the conformers in mol_dir, a new empty index if
+			there is none or if the stored one belongs to a different molecule
+		'''
+		try:
+			with open(mol_dir / INDEX_FILE) as f:
+				index = json.load(f)
+		except FileNotFoundError:
+			index = None
+
+		if index is None or index['smiles'] != smiles:
+			index = {'smiles': smiles, 'seeds': {}}
+		return index
+
+	def _write_index(self, mol_dir, index):
+		tmp_path = mol_dir / f'{INDEX_FILE}.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(index, f)
+		os.replace(tmp_path, mol_dir / INDEX_FILE)
+
+	def get_coordinates(self, rdmol, numconfs, seed, num_threads=1):
+		''' returns the coordinates (conformers x atoms x 3 array, Angstrom) of
+			the first numconfs conformers embedded for rdmol with the random seed,
+			embedding them only if the pool does not already hold enough
+
+			rdmol: 				rdkit Mol to generate conformers for
+			numconfs: 			int number of conformers
+			seed: 				int random seed
+			num_threads: 		int number of threads used for embedding
+		'''
+		smiles = Chem.MolToSmiles(rdmol)
+		mol_dir = self._mol_dir(rdmol, smiles)
+		index = self._read_index(mol_dir, smiles)
+		seed_path = mol_dir / f'seed_{seed}.npy'
+
+		if index['seeds'].get(str(seed), 0) >= numconfs:
+			try:
+				coordinates = np.load(seed_path, mmap_mode='r')
+			except FileNotFoundError:
+				pass
+			else:
+				self.reused += 1
+				return np.asarray(coordinates[:numconfs])
+
+		# RDKit can not start embedding part way through a seed's sequence of
+		# conformers, so a seed that needs more conformers is embedded again
+		rdmol_copy = Chem.Mol(rdmol)
+		AllChem.EmbedMultipleConfs(rdmol_copy, numConfs=numconfs, randomSeed=seed, numThreads=num_threads)
+		coordinates = np.array(
+			[conf.GetPositions() for conf in rdmol_copy.GetConformers()],
+			dtype=np.float64,
+		).reshape(-1, rdmol.GetNumAtoms(), 3)
+		self.embedded += 1
+
+		mol_dir.mkdir(exist_ok=True, parents=True)
+		tmp_path = seed_path.with_name(f'{seed_path.stem}.tmp.npy')
+		np.save(tmp_path, coordinates)
+		os.replace(tmp_path, seed_path)
+
+		index['seeds'][str(seed)] = numconfs
+		self._write_index(mol_dir, index)
+
+		return coordinates
+
+	def stats(self):
+		''' returns a dictionary of how many requests were embedded or reused
+		'''
+		return {'embedded': self.embedded, 'reused': self.reused}
+
+
+def mol_from_coordinates(rdmol, coordinates):
+	''' returns a copy of rdmol with one conformer per entry of coordinates
+		(conformers x atoms x 3 array, Angstrom)
+	'''
+	rdmol_copy = Chem.Mol(rdmol)
+	rdmol_copy.RemoveAllConformers()
+	for conf_coordinates in coordinates:
+		conf = Chem.Conformer(rdmol_copy.GetNumAtoms())
+		for atom_idx, xyz in enumerate(conf_coordinates):
+			conf.SetAtomPosition(atom_idx, Point3D(*xyz))
+		conf.Set3D(True)
+		rdmol_copy.AddConformer(conf, assignId=True)
+	return rdmol_copy
@@ -0,0 +1,192 @@
+'''
+Conformer helpers: embedding random conformers with RDKit, splitting them into
+single conformer molecules and writing them to .oeb.gz for record keeping.
+
+Only RDKit is imported with this module, OpenFF and OpenEye are imported by
+the functions that need them.
+'''
+
+import numpy as np
+from rdkit import Chem
+from rdkit.Chem import AllChem
+from rdkit.Geometry import Point3D
+
+from conformer_pool import mol_from_coordinates
+import tracing
+
+
+def embed_random_confs(rdmol, numconfs, seed, num_threads=1, conformer_pool=None):
+	''' Returns a copy of rdmol with numconfs conformers embedded by RDKit 
+		using the random seed. The conformers are the same for any num_threads
+
+		rdmol: 				rdkit Mol to generate conformers for
+		numconfs: 			int number of conformers to embed
+		seed: 				int random seed
+		num_threads: 		int number of threads used for embedding, 0 uses all cores
+		conformer_pool: 	ConformerPool object to reuse previously embedded conformers from, or None
+	'''
+	with tracing.span('embed', molecule=tracing.mol_name(rdmol), num_confs=numconfs, seed=seed):
+		if conformer_pool is not None:
+			coordinates = conformer_pool.get_coordinates(rdmol, numconfs, seed, num_threads)
+			return mol_from_coordinates(rdmol, coordinates)
+
+		rdmol_copy = Chem.Mol(rdmol)
+
+		AllChem.EmbedMultipleConfs(rdmol_copy, numConfs=numconfs, randomSeed=seed, numThreads=num_threads)
+
+	return rdmol_copy
+
+def iter_mols_from_confs(rdmol_w_confs):
+	''' Yields one single conformer rdkit Mol per conformer of rdmol_w_confs 
+		The molecule is converted through OpenFF once to make a single conformer
+		template, each conformer then only copies the template and sets its 
+		coordinates, so the cost is linear in the number of conformers
+	'''
+	from openff.toolkit import Molecule
+
+	conf_ids = [conf.GetId() for conf in rdmol_w_confs.GetConformers()]
+	if not conf_ids:
+		return
+
+	with tracing.span('convert', molecule=tracing.mol_name(rdmol_w_confs)):
+		offmol_temp = Molecule.from_rdkit(Chem.Mol(rdmol_w_confs, confId=conf_ids[0]))
+		rdmol_template = Molecule.to_rdkit(offmol_temp)
+
+	for conf_id in conf_ids:
+		coordinates = rdmol_w_confs.GetConformer(conf_id).GetPositions()
+
+		rdmol_temp = Chem.Mol(rdmol_template)
+		conf = rdmol_temp.GetConformer()
+		for atom_idx, xyz in enumerate(coordinates):
+			conf.SetAtomPosition(atom_idx, Point3D(*xyz))
+
+		yield rdmol_temp
+
+def get_mols_from_random_confs(rdmol, numconfs, seed, num_threads=1, lazy=False, conformer_pool=None):
+	''' Embeds numconfs random conformers of rdmol and returns the multi conformer
+		rdkit Mol along with a list of single conformer rdkit Mols, one per conformer
+		
+		rdmol: 				rdkit Mol to generate conformers for
+		numconfs: 			int number of conformers to embed
+		seed: 				int random seed
+		num_threads: 		int number of threads used for embedding, 0 uses all cores
+		lazy: 				if True a generator is returned instead of the list, 
+							so each single conformer Mol is only built when needed
+		conformer_pool: 	ConformerPool object to reuse previously embedded conformers from, or None
+	'''
+	rdmol_copy = embed_random_confs(rdmol, numconfs, seed, num_threads, conformer_pool)
+
+	rdmols_by_conf = iter_mols_from_confs(rdmol_copy)
+	if not lazy:
+		rdmols_by_conf = list(rdmols_by_conf)
+
+	return rdmol_copy, rdmols_by_conf
+
+def write_confs_oeb(rdmol_w_confs, oeb_path):
+	''' Writes a multi conformer rdkit Mol to a .oeb.gz file for record keeping
+		using OpenFF to convert it to an OpenEye molecule
+	'''
+	from openff.toolkit import Molecule
+	from openeye import oechem
+
+	with tracing.span('write_oeb', molecule=tracing.mol_name(rdmol_w_confs)):
+		offmol_w_confs = Molecule.from_rdkit(rdmol_w_confs)
+		oemol_w_confs = Molecule.to_openeye(offmol_w_confs)
+		ofs = oechem.oemolostream(str(oeb_path))
+		ofs.SetFormat(oechem.OEFormat_OEB)
+		# Write the molecule to the stream
+		oechem.OEWriteMolecule(ofs, oemol_w_confs)
+		# Close the stream
+		ofs.close()
+
+def get_heavy_atom_symmetries(rdmol, max_matches=1000):
+	''' returns the symmetry equivalent orderings of the heavy atoms of rdmol, 
+		as a matches x heavy atoms array of indices into its heavy atoms
+	'''
+	heavy_mol = Chem.RWMol(Chem.RemoveHs(rdmol))
+	# terminal O and N conjugated to the same atom (e.g. carboxylates and nitro
+	# groups) are interchangeable, as with RDKit's symmetrizeConjugatedTerminalGroups
+	for atom in heavy_mol.GetAtoms():
+		if atom.GetDegree() == 1 and atom.GetAtomicNum() in (7, 8) and atom.GetBonds()[0].GetIsConjugated():
+			atom.SetFormalCharge(0)
+			atom.GetBonds()[0].SetBondType(Chem.BondType.ONEANDAHALF)
+	matches = heavy_mol.GetSubstructMatches(heavy_mol, uniquify=False, maxMatches=max_matches)
+	return np.array(matches, dtype=np.intp).reshape(-1, heavy_mol.GetNumAtoms())
+
+def get_rmsd_matrix(rdmol_w_confs, max_matches=1000):
+	''' returns the conformers x conformers matrix of the symmetry aware heavy
+		atom RMSD (Angstrom) of every pair of conformers of rdmol_w_confs after 
+		optimal superposition. The superpositions of all pairs are done at once
+		(Kabsch, from a batched SVD of their 3x3 covariance matrices) for each
+		symmetry equivalent ordering of the heavy atoms, keeping the lowest RMSD
+
+		rdmol_w_confs: 		rdkit Mol with the conformers to compare
+		max_matches: 		int maximum number of symmetry equivalent orderings
+	'''
+	heavy_idx = [atom.GetIdx() for atom in rdmol_w_confs.GetAtoms() if atom.GetAtomicNum() > 1]
+	coordinates = np.array([conf.GetPositions()[heavy_idx] for conf in rdmol_w_confs.GetConformers()])
+	coordinates -= coordinates.mean(axis=1, keepdims=True)
+	num_atoms = coordinates.shape[1]
+	sq_norms = (coordinates ** 2).sum(axis=(1, 2))
+
+	rmsd = np.full((len(coordinates), len(coordinates)), np.inf)
+	for match in get_heavy_atom_symmetries(rdmol_w_confs, max_matches):
+		# covariance of every pair of conformers, conformer j reordered by match
+		covariance = np.einsum('iak,jal->ijkl', coordinates, coordinates[:, match])
+		u, s, vt = np.linalg.svd(covariance)
+		# the last singular value changes sign when the best rotation is a reflection
+		s[..., -1] *= np.sign(np.linalg.det(u @ vt))
+		sq_dev = (sq_norms[:, None] + sq_norms[None, :] - 2 * s.sum(axis=-1)) / num_atoms
+		np.minimum(rmsd, np.sqrt(np.clip(sq_dev, 0, None)), out=rmsd)
+	return rmsd
+
+def prune_conformers(rdmol_w_confs, rmsd_threshold, max_matches=1000):
+	''' finds the conformers of rdmol_w_confs that are near duplicates of an 
+		earlier one. Conformers are taken in order and each is kept unless its
+		heavy atom RMSD (see get_rmsd_matrix) to a kept conformer is below 
+		rmsd_threshold, in which case the closest kept conformer represents it
+		Returns the index of the representative of every conformer (its own
+		index if it is kept) and the RMSD to it
+
+		rdmol_w_confs: 		rdkit Mol with the conformers to prune
+		rmsd_threshold: 	float RMSD (Angstrom) below which conformers are duplicates
+		max_matches: 		int maximum number of symmetry equivalent orderings
+	'''
+	rmsd = get_rmsd_matrix(rdmol_w_confs, max_matches)
+
+	kept = []
+	representatives = np.arange(len(rmsd))
+	for i in range(len(rmsd)):
+		if kept:
+			closest = kept[int(np.argmin(rmsd[i, kept]))]
+			if rmsd[i, closest] < rmsd_threshold:
+				representatives[i] = closest
+				continue
+		kept.append(i)
+
+	return representatives, rmsd[np.arange(len(rmsd)), representatives]
+
+def iter_elf10_conformer_sets(rdmol, seeds, numconfs, save_confs=None, num_threads=1, conformer_pool=None, skip=()):
+	''' Yields one multi conformer rdkit Mol of numconfs conformers per random 
+		seed, to be charged with AM1-BCC ELF10. Each set is only embedded when
+		it is needed and is passed to save_confs as it is made
+		None is yielded instead for the indices in skip, such as the charge sets
+		finished by an earlier run
+
+		rdmol: 				rdkit Mol to generate conformers for
+		seeds: 				list of int random seeds, one per conformer set
+		numconfs: 			int number of conformers in each set
+		save_confs: 		function called with (rdmol_w_confs, seed) for every
+							set to keep a record of it, or None
+		num_threads: 		int number of threads used for embedding, 0 uses all cores
+		conformer_pool: 	ConformerPool object to reuse previously embedded conformers from, or None
+		skip: 				collection of int indices of seeds not to embed
+	'''
+	for i, seed in enumerate(seeds):
+		if i in skip:
+			yield None
+			continue
+		rdmol_w_confs, _ = get_mols_from_random_confs(rdmol, numconfs, seed, num_threads, lazy=True, conformer_pool=conformer_pool)
+		if save_confs is not None:
+			save_confs(rdmol_w_confs, seed)
+		yield rdmol_w_confs
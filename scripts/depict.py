@@ -0,0 +1,279 @@
+'''
+Renders 2D depictions of molecules colored by how much the partial charges of
+two partial charge sets differ, for every molecule and every chosen pair of
+partial charge sets in one pass
+	* qdiff 	each atom colored by the absolute difference of its partial charge
+	* bonddq 	each bond colored by the absolute difference of its bond delta q
+
+This replaces plot_2dmol_with_qdiff.ipynb and plot_2dmol_with_bonddq.ipynb.
+The sdf file is read once, the 2D coordinates and the heavy atom index maps of
+each molecule are computed once and reused by all of its images, and the
+images (molecule and color bar) are written straight to SVG or PNG by RDKit.
+Molecules are rendered in parallel, one task per molecule.
+
+Images are written to {output_dir}/{molecule}/{molecule}_{kind}_{i}_{j}.{format}
+
+Usage, with the conda environment created from openfe.yaml
+	python depict.py ../molecules/PLB_simulation_all.sdf <input_path> <output_dir> \\
+		--toolkit openeye --charge-method am1bcc --pairs 0:1 0:2
+where input_path is the output_path of charge_molecules.py
+'''
+
+import argparse
+import itertools
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from rdkit import Chem
+from rdkit.Chem import AllChem
+from rdkit.Chem.Draw import rdMolDraw2D
+from rdkit.Geometry import Point2D
+
+from charge_analysis import calc_bond_dq, get_bond_index_array
+from charge_store import ChargeStore, get_store_path, load_charge_matrix
+
+KINDS = ['qdiff', 'bonddq']
+FORMATS = ['svg', 'png']
+
+# color bar label of each kind of image
+LABELS = {
+	'qdiff': 'partial charge difference (e)',
+	'bonddq': 'bond delta q difference (e)',
+}
+
+# ColorBrewer Blues, the matplotlib colormap used by the notebooks
+BLUES = np.array([
+	(247, 251, 255), (222, 235, 247), (198, 219, 239), (158, 202, 225), (107, 174, 214),
+	(66, 146, 198), (33, 113, 181), (8, 81, 156), (8, 48, 107),
+]) / 255
+
+HIGHLIGHT_RADIUS = 0.5
+# height (pixels) of the color bar area under the molecule
+LEGEND_HEIGHT = 90
+
+
+class Depiction:
+	''' 2D depiction of a molecule, made once and reused for every image of it
+
+		rdmol: 				rdkit Mol with hydrogens, as read from the sdf file
+		hydrogens: 			if False only the heavy atoms are drawn
+	'''
+
+	def __init__(self, rdmol, hydrogens=True):
+		self.name = rdmol.GetProp('_Name')
+		mol = Chem.RemoveHs(rdmol) if not hydrogens else Chem.Mol(rdmol)
+		mol.RemoveAllConformers()
+		AllChem.Compute2DCoords(mol)
+
+		# RemoveHs keeps the heavy atoms in order, so the drawn index of every
+		# atom of rdmol is its rank among the drawn atoms, -1 for removed atoms
+		drawn = np.array([hydrogens or atom.GetAtomicNum() > 1 for atom in rdmol.GetAtoms()])
+		self.atom_map = np.where(drawn, np.cumsum(drawn) - 1, -1)
+		self.bond_atoms = get_bond_index_array(rdmol)
+		self.bond_map = np.array([
+			mol.GetBondBetweenAtoms(int(self.atom_map[a1]), int(self.atom_map[a2])).GetIdx() if drawn[a1] and drawn[a2] else -1
+			for a1, a2 in self.bond_atoms
+		], dtype=np.intp)
+
+		# atoms are labeled with their index in rdmol, i.e. in the charge files
+		for atom_idx, drawn_idx in enumerate(self.atom_map):
+			if drawn_idx >= 0:
+				mol.GetAtomWithIdx(int(drawn_idx)).SetProp('atomNote', str(atom_idx))
+		self.mol = mol
+
+	def __getstate__(self):
+		# rdkit Mols are pickled without their atom notes by default
+		state = dict(self.__dict__)
+		state['mol'] = self.mol.ToBinary(Chem.PropertyPickleOptions.AllProps)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.mol = Chem.Mol(state['mol'])
+
+
+def round_up_to_tenth(number):
+	return np.ceil(number * 10) / 10
+
+def get_colors(values, vmax):
+	''' returns the rgb color of each of values on the Blues color scale from
+		0 to vmax, as an N x 3 array
+	'''
+	fractions = np.clip(np.asarray(values, dtype=np.float64) / vmax, 0, 1)
+	anchors = np.linspace(0, 1, len(BLUES))
+	return np.column_stack([np.interp(fractions, anchors, BLUES[:, c]) for c in range(3)])
+
+def get_pair_values(charge_matrix, bond_atoms, kind, i, j):
+	''' returns the absolute difference between partial charge sets i and j
+		of each atom (qdiff) or of the bond delta q of each bond (bonddq)
+	'''
+	charge_pair = charge_matrix[:, [i, j]]
+	if kind == 'bonddq':
+		charge_pair = calc_bond_dq(charge_pair, bond_atoms)
+	return np.abs(charge_pair[:, 0] - charge_pair[:, 1])
+
+def _draw_legend(drawer, width, height, vmax, label):
+	''' draws a horizontal color bar from 0 to vmax with a tick every 0.1 e
+		across the bottom LEGEND_HEIGHT pixels of the canvas
+	'''
+	left, right = 0.1 * width, 0.9 * width
+	top = height - LEGEND_HEIGHT + 10
+	bottom = top + 20
+
+	drawer.SetFillPolys(True)
+	steps = np.linspace(0, 1, 101)
+	for (start, end), color in zip(itertools.pairwise(steps), get_colors(steps[1:] * vmax, vmax)):
+		drawer.SetColour(tuple(color))
+		drawer.DrawRect(
+			Point2D(left + start * (right - left), top),
+			Point2D(left + end * (right - left) + 1, bottom),
+			rawCoords=True,
+		)
+
+	drawer.SetColour((0, 0, 0))
+	drawer.SetLineWidth(1)
+	drawer.SetFontSize(14)
+	for tick in np.arange(0, vmax + 1e-9, 0.1):
+		x = left + tick / vmax * (right - left)
+		drawer.DrawLine(Point2D(x, bottom), Point2D(x, bottom + 5), rawCoords=True)
+		drawer.DrawString(f'{tick:.1f}', Point2D(x, bottom + 16), 0, rawCoords=True)
+	drawer.DrawString(label, Point2D(width / 2, bottom + 40), 0, rawCoords=True)
+
+def draw_depiction(depiction, kind, values, vmax, image_format='svg', size=(800, 480)):
+	''' returns the image (str for svg, bytes for png) of depiction with the
+		atoms (qdiff) or bonds (bonddq) colored by values and a color bar
+
+		depiction: 			Depiction of the molecule
+		kind: 				'qdiff' with one value per atom or 'bonddq' with one per bond
+		values: 			array of the values to color by, indexed like the sdf molecule
+		vmax: 				float value colored with the darkest blue
+		image_format: 		'svg' or 'png'
+		size: 				(width, height) of the image in pixels
+	'''
+	width, height = size
+	if image_format == 'png':
+		drawer = rdMolDraw2D.MolDraw2DCairo(width, height, width, height - LEGEND_HEIGHT)
+	else:
+		drawer = rdMolDraw2D.MolDraw2DSVG(width, height, width, height - LEGEND_HEIGHT)
+
+	index_map = depiction.atom_map if kind == 'qdiff' else depiction.bond_map
+	drawn = index_map >= 0
+	highlights = [int(i) for i in index_map[drawn]]
+	colors = {i: tuple(color) for i, color in zip(highlights, get_colors(values[drawn], vmax))}
+
+	if kind == 'qdiff':
+		rdMolDraw2D.PrepareAndDrawMolecule(
+			drawer, depiction.mol,
+			highlightAtoms=highlights,
+			highlightAtomColors=colors,
+			highlightAtomRadii={i: HIGHLIGHT_RADIUS for i in highlights},
+		)
+	else:
+		drawer.SetLineWidth(5)
+		rdMolDraw2D.PrepareAndDrawMolecule(
+			drawer, depiction.mol,
+			highlightAtoms=[],
+			highlightBonds=highlights,
+			highlightBondColors=colors,
+		)
+
+	_draw_legend(drawer, width, height, vmax, LABELS[kind])
+	drawer.FinishDrawing()
+	return drawer.GetDrawingText()
+
+def render_molecule(depiction, charge_matrix, pairs, kinds, formats, output_dir, vmax=None, size=(800, 480)):
+	''' writes the images of every kind in kinds and every (i, j) of pairs
+		of partial charge sets of one molecule and returns their paths
+
+		depiction: 			Depiction of the molecule
+		charge_matrix: 		atoms x sets array of the partial charges of the molecule
+		pairs: 				list of (i, j) partial charge set indices
+		kinds: 				list of 'qdiff' and/or 'bonddq'
+		formats: 			list of 'svg' and/or 'png'
+		output_dir: 		Path the molecule's directory is made in
+		vmax: 				float top of the color scale shared by every image,
+							None uses the largest value of each image rounded up
+							to the nearest 0.1 e
+		size: 				(width, height) of the images in pixels
+	'''
+	mol_dir = Path(output_dir) / depiction.name
+	mol_dir.mkdir(exist_ok=True, parents=True)
+
+	paths = []
+	for kind, (i, j) in itertools.product(kinds, pairs):
+		values = get_pair_values(charge_matrix, depiction.bond_atoms, kind, i, j)
+		image_vmax = vmax if vmax is not None else max(round_up_to_tenth(values.max()), 0.1)
+		for image_format in formats:
+			image = draw_depiction(depiction, kind, values, image_vmax, image_format, size)
+			path = mol_dir / f'{depiction.name}_{kind}_{i}_{j}.{image_format}'
+			if image_format == 'png':
+				path.write_bytes(image)
+			else:
+				path.write_text(image)
+			paths.append(path)
+	return paths
+
+def _render_molecule_task(task):
+	return render_molecule(*task)
+
+def parse_pairs(pairs, all_pairs=None):
+	''' returns the (i, j) partial charge set pairs from 'i:j' strings, or
+		every pair of the first all_pairs sets if all_pairs is given
+	'''
+	if all_pairs is not None:
+		return list(itertools.combinations(range(all_pairs), 2))
+	return [tuple(int(i) for i in pair.split(':')) for pair in pairs]
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('sdf_file', help='sdf file of the charged molecules')
+	parser.add_argument('input_path', help='output_path of charge_molecules.py')
+	parser.add_argument('output_dir', type=Path, help='directory the images are written to')
+	parser.add_argument('--toolkit', default='openeye')
+	parser.add_argument('--charge-method', default='am1bcc')
+	parser.add_argument('--input-format', choices=['csv', 'store'], default='csv', help='read the csv files or the charge store')
+	parser.add_argument('--molecules', nargs='*', help='names of the molecules to render, all of them by default')
+	parser.add_argument('--pairs', nargs='*', default=['0:1'], help='pairs of partial charge sets to compare, as i:j')
+	parser.add_argument('--all-pairs', type=int, metavar='N', help='compare every pair of the first N partial charge sets instead of --pairs')
+	parser.add_argument('--kinds', nargs='*', choices=KINDS, default=KINDS)
+	parser.add_argument('--formats', nargs='*', choices=FORMATS, default=['png'])
+	parser.add_argument('--heavy-atoms-only', action='store_true', help='do not draw the hydrogens')
+	parser.add_argument('--vmax', type=float, help='top of the color scale of every image (e), by default that of each image')
+	parser.add_argument('--size', type=int, nargs=2, default=[800, 480], metavar=('WIDTH', 'HEIGHT'))
+	parser.add_argument('--workers', type=int, default=1, help='number of processes rendering molecules')
+	args = parser.parse_args()
+
+	if 'png' in args.formats and not hasattr(rdMolDraw2D, 'MolDraw2DCairo'):
+		print("ERROR: this RDKit build has no Cairo support, use --formats svg", file=sys.stderr)
+		sys.exit(1)
+
+	pairs = parse_pairs(args.pairs, args.all_pairs)
+
+	charge_store = None
+	if args.input_format == 'store':
+		charge_store = ChargeStore(get_store_path(args.input_path, args.toolkit, args.charge_method))
+
+	rdmols = [mol for mol in Chem.SDMolSupplier(args.sdf_file, removeHs=False)]
+	if args.molecules:
+		rdmols = [mol for mol in rdmols if mol.GetProp('_Name') in args.molecules]
+
+	tasks = []
+	for rdmol in rdmols:
+		name = rdmol.GetProp('_Name')
+		charge_matrix = load_charge_matrix(args.input_path, args.toolkit, args.charge_method, name, charge_store)
+		tasks.append((
+			Depiction(rdmol, hydrogens=not args.heavy_atoms_only), charge_matrix, pairs,
+			args.kinds, args.formats, args.output_dir, args.vmax, tuple(args.size),
+		))
+
+	if args.workers > 1:
+		with ProcessPoolExecutor(max_workers=args.workers) as executor:
+			results = list(executor.map(_render_molecule_task, tasks))
+	else:
+		results = [render_molecule(*task) for task in tasks]
+
+	print(f"{sum(len(paths) for paths in results)} images of {len(tasks)} molecules written to {args.output_dir}")
@@ -0,0 +1,112 @@
+'''
+Batched OpenFF NAGL charging.
+
+Charging through NAGLToolkitWrapper runs each molecule through the GNN as its
+own graph. Here the model is loaded once per process and the graphs of many
+molecules are packed into a single batch for each forward pass.
+
+Requires the environment created from nagl.yaml.
+
+To answer the charging requests of a NAGLSubprocess (see charge_exchange.py)
+from another environment, run
+	python nagl_batch.py serve
+'''
+
+import os
+import sys
+
+import numpy as np
+
+# GNN models loaded so far by charge method (model file name)
+_NAGL_MODELS = {}
+
+
+def load_nagl_model(charge_method):
+	''' returns the NAGL GNNModel for charge_method (e.g.
+		'openff-gnn-am1bcc-0.1.0-rc.1.pt'), loading it only the first time
+	'''
+	if charge_method not in _NAGL_MODELS:
+		from openff.nagl import GNNModel
+		from openff.nagl_models import validate_nagl_model_path
+
+		model_path = validate_nagl_model_path(charge_method)
+		_NAGL_MODELS[charge_method] = GNNModel.load(model_path, eval_mode=True)
+	return _NAGL_MODELS[charge_method]
+
+def _get_readout(outputs):
+	''' returns the single readout tensor predicted by the model
+	'''
+	if len(outputs) != 1:
+		raise ValueError(f'Expected a model with one readout, found {list(outputs)}')
+	return next(iter(outputs.values()))
+
+def _charge_batch(model, offmols):
+	''' returns the partial charges of each molecule of offmols from a single
+		forward pass of model over the batched molecular graphs
+	'''
+	import torch
+	from openff.nagl.molecule._dgl import DGLMolecule, DGLMoleculeBatch
+
+	dglmols = [
+		DGLMolecule.from_openff(
+			offmol,
+			atom_features=model.config.atom_features,
+			bond_features=model.config.bond_features,
+		)
+		for offmol in offmols
+	]
+	batch = DGLMoleculeBatch.from_dgl_molecules(dglmols)
+
+	with torch.no_grad():
+		charges = _get_readout(model.forward(batch)).detach().cpu().numpy().reshape(-1)
+
+	splits = np.cumsum(batch.n_atoms_per_molecule)[:-1]
+	return [q.astype(np.float64) for q in np.split(charges, splits)]
+
+def gen_nagl_charges_batched(charge_method, offmols, batch_size=64):
+	''' Returns the NAGL partial charges (in units of e) of each OpenFF Molecule
+		in offmols as a list of numpy arrays, in the same order as offmols
+		The molecules are run through the model batch_size at a time
+
+		charge_method: 		str NAGL model file name
+		offmols: 			list of Molecule objects to charge
+		batch_size: 		int number of molecules per forward pass
+	'''
+	model = load_nagl_model(charge_method)
+
+	# models with lookup tables take some charges from the table instead of
+	# the GNN, which only happens when molecules are charged one at a time
+	if getattr(model, 'lookup_tables', None):
+		return [
+			np.asarray(model.compute_property(offmol, as_numpy=True), dtype=np.float64).reshape(-1)
+			for offmol in offmols
+		]
+
+	all_charges = []
+	for start in range(0, len(offmols), batch_size):
+		all_charges += _charge_batch(model, offmols[start:start + batch_size])
+	return all_charges
+
+def charge_mapped_smiles(charge_method, mapped_smiles, batch_size=64):
+	''' Returns the NAGL partial charges (in units of e) of the molecule of
+		each mapped SMILES, in the atom order of the mapped SMILES
+	'''
+	from openff.toolkit import Molecule
+
+	offmols = [Molecule.from_mapped_smiles(smiles, allow_undefined_stereo=True) for smiles in mapped_smiles]
+	return gen_nagl_charges_batched(charge_method, offmols, batch_size)
+
+
+if __name__ == "__main__":
+	if sys.argv[1:] != ['serve']:
+		print("usage: python nagl_batch.py serve", file=sys.stderr)
+		sys.exit(1)
+
+	from charge_exchange import serve
+
+	# the responses get their own copy of stdout, anything the toolkits print
+	# goes to stderr so it cannot end up in the middle of a response
+	responses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+	sys.stdout.flush()
+	os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+	serve(charge_mapped_smiles, sys.stdin, responses)
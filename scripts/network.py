@@ -0,0 +1,93 @@
+'''
+Helpers to build the openfe Absolute Solvation Protocol transformations and
+networks for the absolute hydration free energy calculations.
+
+openfe is imported by the functions that use it, not with this module.
+'''
+
+from charging import nagl_wrapper_exists
+
+
+# OpenMM platforms in the order get_compute_platform prefers them
+COMPUTE_PLATFORMS = ['CUDA', 'OpenCL', 'CPU']
+
+
+def get_compute_platform():
+	''' returns the fastest OpenMM platform that works on this machine, 
+		see COMPUTE_PLATFORMS
+	'''
+	import openmm
+
+	available = {openmm.Platform.getPlatform(i).getName() for i in range(openmm.Platform.getNumPlatforms())}
+	for platform in COMPUTE_PLATFORMS:
+		if platform not in available:
+			continue
+		try:
+			# a platform can be installed without a device to run on
+			openmm.Context(openmm.System(), openmm.VerletIntegrator(1.0), openmm.Platform.getPlatformByName(platform))
+		except Exception:
+			continue
+		return platform
+	return 'Reference'
+
+def get_ahfe_settings(compute_platform='CUDA'):
+	''' returns the AbsoluteSolvationProtocol settings used for our paper
+
+		compute_platform: 	str OpenMM platform to run on, 'auto' for the fastest
+							platform of this machine (see get_compute_platform), 
+							or None to let openfe choose when the simulation runs
+	'''
+	from openfe.protocols.openmm_afe import AbsoluteSolvationProtocol
+	from openff.units import unit
+
+	settings = AbsoluteSolvationProtocol.default_settings()
+	settings.solvent_simulation_settings.equilibration_length = 500 * unit.picosecond
+	settings.solvent_simulation_settings.production_length = 10000 * unit.picosecond
+	settings.vacuum_simulation_settings.equilibration_length = 500 * unit.picosecond
+	settings.vacuum_simulation_settings.production_length = 1000 * unit.picosecond
+	if not nagl_wrapper_exists():
+		settings.alchemical_settings.lambda_elec_windows = 7
+		settings.alchemical_settings.lambda_vdw_windows = 13
+		settings.alchemsampler_settings.n_repeats = 1
+		settings.alchemsampler_settings.n_replicas = 20
+		settings.alchemsampler_settings.online_analysis_target_error = 0.0 * unit.boltzmann_constant * unit.kelvin
+
+	if compute_platform == 'auto':
+		compute_platform = get_compute_platform()
+	settings.vacuum_engine_settings.compute_platform = compute_platform
+	settings.solvent_engine_settings.compute_platform = compute_platform
+
+	# Set to 0 to prevent early termination due to convergence detection
+	
+
+	return settings
+
+def create_transformations(settings, charged_ligands):
+	''' Creates one Absolute Solvation Protocol transformation per charged ligand
+		returned in the same order as charged_ligands
+	'''
+	import openfe
+	from openfe.protocols.openmm_afe import AbsoluteSolvationProtocol
+
+	protocol = AbsoluteSolvationProtocol(settings=settings)
+
+	stateB = openfe.ChemicalSystem({'s': openfe.SolventComponent()})
+
+	transformations = []
+
+	for smc in charged_ligands:
+		stateA = openfe.ChemicalSystem({'l': smc, 's': openfe.SolventComponent()})   
+		t = openfe.Transformation(stateA=stateA, stateB=stateB, mapping=None, protocol=protocol, name=smc.name)
+		transformations.append(t)
+
+	return transformations
+
+def create_network(settings, charged_ligands):
+	''' Creates an Absolute Solvation Protocol network
+	'''
+	import openfe
+
+	transformations = create_transformations(settings, charged_ligands)
+		
+	network = openfe.AlchemicalNetwork(transformations)
+	return network
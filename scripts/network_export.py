@@ -0,0 +1,192 @@
+'''
+Compact export of the AHFE transformations written by the prep_fe_* scripts.
+
+Every replicate's ahfe.json repeats the same AbsoluteSolvationProtocol settings
+and solvent component, only the charged ligand differs. In the compact format
+the shared part is written once to ahfe_shared_{hash}.json and each replicate
+directory only holds an ahfe.delta.json with the ligand and the transformation
+name. load_transformation rebuilds the full Transformation from the two files,
+and materialize writes the ahfe.json that openfe quickrun needs.
+
+The shared part (protocol settings, solvent) is always encoded with gufe's json
+encoder, as it holds the values orjson encodes differently (NaN and inf, Enum
+members, non-str keys). The deltas use orjson if it is installed. Every file is
+written to a temporary file first and moved into place, so an interrupted run
+never leaves a truncated file that a resumed run would take as written.
+benchmarks/check_compact_export.py checks that the export is lossless.
+
+To write the ahfe.json of every replicate under a directory, run
+	python network_export.py materialize <directory>
+'''
+
+import copy
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from gufe.tokenization import JSON_HANDLER
+
+try:
+	import orjson
+	ORJSON_EXISTS = True
+except ImportError:
+	ORJSON_EXISTS = False
+
+DELTA_FILE = 'ahfe.delta.json'
+FULL_FILE = 'ahfe.json'
+# key of the ligand in stateA of the transformations made by create_transformations
+LIGAND_KEY = 'l'
+
+
+def _dumps(obj, use_orjson=True):
+	''' returns obj encoded as JSON bytes, with orjson if it is installed and
+		use_orjson is True, otherwise with json exactly as gufe writes it
+		gufe's encoder handles the objects JSON does not support natively
+	'''
+	if use_orjson and ORJSON_EXISTS:
+		try:
+			# datetimes and dataclasses are passed to gufe's encoder as json would
+			return orjson.dumps(
+				obj,
+				default=JSON_HANDLER.encoder().default,
+				option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS,
+			)
+		except orjson.JSONEncodeError:
+			# e.g. dictionaries with keys that are not str
+			pass
+	return json.dumps(obj, cls=JSON_HANDLER.encoder).encode()
+
+def split_transformation(transformation):
+	''' returns the JSON bytes of the part of transformation shared by all
+		replicates and the delta dictionary holding the rest
+	'''
+	tdict = transformation.to_dict()
+	delta = {
+		'name': tdict['name'],
+		'ligand': tdict['stateA']['components'].pop(LIGAND_KEY),
+	}
+	tdict['name'] = None
+	return _dumps(tdict, use_orjson=False), delta
+
+def _write_bytes(path, data):
+	# the temporary name is unique to the thread, so processes or threads
+	# writing the same shared file do not write to the same temporary file
+	path = Path(path)
+	tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+	with open(tmp_path, 'wb') as f:
+		f.write(data)
+	os.replace(tmp_path, path)
+
+def _write_compact(shared, delta, outdir, shared_dir, written_shared, submit):
+	''' writes the shared part of a transformation to shared_dir unless it is
+		in written_shared or on disk already, and its delta to outdir, each with
+		submit(function, *args)
+	'''
+	shared_path = shared_dir / f'ahfe_shared_{hashlib.sha256(shared).hexdigest()[:16]}.json'
+	writes = []
+	if shared_path not in written_shared and not shared_path.exists():
+		writes.append(submit(_write_bytes, shared_path, shared))
+	written_shared.add(shared_path)
+
+	outdir = Path(outdir)
+	outdir.mkdir(exist_ok=True, parents=True)
+	# relative so the tree can be moved or synced to another machine
+	delta['shared'] = os.path.relpath(shared_path, outdir)
+	writes.append(submit(_write_bytes, outdir / DELTA_FILE, _dumps(delta)))
+	return writes
+
+def export_transformations(transformations, outdirs, shared_dir, max_workers=8):
+	''' Writes transformations in the compact format, the shared part once to
+		shared_dir and one ahfe.delta.json per transformation to the matching
+		directory of outdirs. The files are written in parallel
+
+		transformations: 	list of Transformation objects from create_transformations
+		outdirs: 			list of Path, the replicate directory of each transformation
+		shared_dir: 		Path of the directory to write the shared file to
+		max_workers: 		int number of threads used to write the files
+	'''
+	shared_dir = Path(shared_dir)
+	shared_dir.mkdir(exist_ok=True, parents=True)
+
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		splits = list(executor.map(split_transformation, transformations))
+
+		writes = []
+		written_shared = set()
+		for (shared, delta), outdir in zip(splits, outdirs):
+			writes += _write_compact(shared, delta, outdir, shared_dir, written_shared, executor.submit)
+
+		for w in writes:
+			w.result()
+
+def export_transformation(transformation, outdir, shared_dir=None):
+	''' Writes a single replicate's transformation to outdir, as the full
+		ahfe.json, or in the compact format if shared_dir is given. The files
+		are written one after the other in the calling thread, for scripts that
+		write each replicate as soon as it is charged
+
+		transformation: 	Transformation object from create_transformations
+		outdir: 			Path of the replicate directory
+		shared_dir: 		Path of the directory to write the shared file to, or
+							None to write the full ahfe.json
+	'''
+	outdir = Path(outdir)
+	if shared_dir is not None:
+		shared_dir = Path(shared_dir)
+		shared_dir.mkdir(exist_ok=True, parents=True)
+		shared, delta = split_transformation(transformation)
+		_write_compact(shared, delta, outdir, shared_dir, set(), lambda function, *args: function(*args))
+	else:
+		outdir.mkdir(exist_ok=True, parents=True)
+		transformation.dump(outdir / FULL_FILE)
+
+@lru_cache(maxsize=None)
+def _load_shared(shared_path):
+	with open(shared_path) as f:
+		return json.load(f, cls=JSON_HANDLER.decoder)
+
+def load_transformation(delta_path):
+	''' returns the Transformation stored in the compact format by the
+		ahfe.delta.json at delta_path and the shared file it refers to
+	'''
+	import gufe
+
+	delta_path = Path(delta_path)
+	with open(delta_path) as f:
+		delta = json.load(f, cls=JSON_HANDLER.decoder)
+
+	shared_path = os.path.normpath(delta_path.parent / delta['shared'])
+	tdict = copy.deepcopy(_load_shared(shared_path))
+	tdict['name'] = delta['name']
+	tdict['stateA']['components'][LIGAND_KEY] = delta['ligand']
+	return gufe.Transformation.from_dict(tdict)
+
+def materialize(delta_path, full_path=None):
+	''' writes the full ahfe.json of the compact transformation at delta_path
+		next to it, or to full_path
+	'''
+	delta_path = Path(delta_path)
+	if full_path is None:
+		full_path = delta_path.with_name(FULL_FILE)
+	load_transformation(delta_path).dump(full_path)
+	return full_path
+
+def materialize_all(directory, max_workers=8):
+	''' writes the full ahfe.json of every ahfe.delta.json under directory
+	'''
+	delta_paths = sorted(Path(directory).rglob(DELTA_FILE))
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		return list(executor.map(materialize, delta_paths))
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 3 or sys.argv[1] != 'materialize':
+		print("usage: python network_export.py materialize <directory>", file=sys.stderr)
+		sys.exit(1)
+	for path in materialize_all(sys.argv[2]):
+		print(path)
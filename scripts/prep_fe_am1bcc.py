@@ -9,8 +9,21 @@ Instructions:
 	* modify the variables below within the EDIT THESE VARIABLES blocks below
 '''
 
-from utils import * 
+import openfe
+from openff.toolkit import Molecule
+from openeye import oechem
+from rdkit import Chem
+import numpy as np
+
+from conformers import get_mols_from_random_confs
+from charging import check_provided_charge_type, get_toolkit_wrapper, gen_charges_smc, get_charged_smc, get_charges_array, use_scratch_dir
+from charge_analysis import select_representative_sets, write_table_csv
+from network import get_ahfe_settings, create_transformations
+from charge_cache import ChargeCache
+from run_manifest import RunManifest
+from network_export import export_transformation
 import sys
+from pathlib import Path
 
 SEED = 42
 
@@ -25,6 +38,38 @@ if __name__ == "__main__":
 	toolkit = 'openeye'   # can also be 'ambertools'
 	charge_method = 'am1bcc'
 	output_path = '/Users/megosato/Desktop/testing'
+
+	# directory of the persistent charge cache, conformers charged in an
+	# earlier run are not charged again. None disables the cache
+	charge_cache_dir = None
+
+	# number of replicates to prepare from the num_confs charge sets, picking
+	# the charge sets that best span the variability of all of them with
+	# selection_method ('kmedoids' or 'farthest_point', see charge_analysis.py)
+	# None makes every conformer's charge set a replicate
+	num_representative_sets = None
+	selection_method = 'kmedoids'
+
+	# directory that the scratch files of each charge calculation are written
+	# to, e.g. the antechamber/sqm files for AmberTools AM1-BCC. '/dev/shm' 
+	# keeps them in RAM on Linux. None uses the system temporary directory
+	scratch_dir = None
+
+	# file recording the molecules and replicates that have been finished,
+	# re-running the script with the same file only does the work that is 
+	# missing. None disables resuming
+	manifest_file = None
+
+	# True writes the shared protocol settings and solvent once and only the
+	# charged ligand per replicate (see network_export.py), 
+	# run `python network_export.py materialize <output_path>` to write the
+	# ahfe.json files openfe quickrun needs
+	compact_export = False
+
+	# OpenMM platform the simulations run on, 'CUDA' was used for our paper
+	# 'auto' picks the fastest platform of this machine and None lets openfe
+	# choose on the machine that runs the simulation
+	compute_platform = 'CUDA'
 	####################################
 	#### END   EDIT THESE VARIABLES ####
 	####################################
@@ -35,6 +80,10 @@ if __name__ == "__main__":
 		print("ERROR: Invalid toolkit and charge method pairing", file=sys.stderr)
 		sys.exit()
 	toolkit_wrapper = get_toolkit_wrapper(toolkit)
+	if scratch_dir is not None:
+		use_scratch_dir(scratch_dir)
+	charge_cache = ChargeCache(charge_cache_dir) if charge_cache_dir is not None else None
+	run_manifest = RunManifest(manifest_file) if manifest_file is not None else None
 
 	all_rdmols = [mol for mol in Chem.SDMolSupplier(sdf_file, removeHs=False)]
 
@@ -42,6 +91,11 @@ if __name__ == "__main__":
 	for rdmol in all_rdmols:
 
 		offmol_orig = Molecule.from_rdkit(rdmol)
+		if run_manifest is not None and run_manifest.is_done(offmol_orig.name):
+			continue
+
+		# replicates finished by an earlier, interrupted run
+		completed_rpts = run_manifest.completed_sets(offmol_orig.name) if run_manifest is not None else set()
 
 		# step 1
 		# generate conformers based off the random seed
@@ -67,24 +121,65 @@ if __name__ == "__main__":
 		# Generate the small molecule component for the openFE simulation 
 		ligands = [openfe.SmallMoleculeComponent.from_rdkit(mol) for mol in rdmols_by_conf]
 
+		settings = get_ahfe_settings(compute_platform)
+		shared_dir = output_path if compact_export else None
+
+		def export_replicate(idx, chg_lig):
+			# step 5
+			# Create the openFE transformation for the FE calc of the charged ligand
+			transformation = create_transformations(settings, [chg_lig])[0]
+
+			# step 6
+			# write it to its replicate directory, the replicate is finished
+			# as soon as it is written so it is never charged again
+			export_transformation(transformation, parent_outdir / str(idx), shared_dir)
+			if run_manifest is not None:
+				run_manifest.mark_set_done(offmol_orig.name, idx)
+
 		# step 4
 		# generate charges for each small molecule component
-		charged_ligands = []
-		for idx,lig in enumerate(ligands):
-			chg_lig = gen_charges_smc(toolkit_wrapper, charge_method, lig, offmol_orig)
-			charged_ligands.append(chg_lig)
-
-		# step 5
-		# Create openFE network for all FE clacs
-		settings = get_ahfe_settings()
-		network = create_network(settings, charged_ligands)
-
-		# step 6
-		# create the directory structure to run your calculations
-		for idx,transformation in enumerate(network.edges):
-			outdir = parent_outdir / str(idx)
-			outdir.mkdir(exist_ok=True)
-			transformation.dump(outdir / f"ahfe.json")
+		if num_representative_sets is None:
+			# every conformer is a replicate
+			# the replicates already finished are not charged again
+			for idx in range(len(ligands)):
+				if idx in completed_rpts:
+					continue
+				chg_lig = gen_charges_smc(toolkit_wrapper, charge_method, ligands[idx], offmol_orig, charge_cache)
+				export_replicate(idx, chg_lig)
+		else:
+			# every conformer is charged and only the num_representative_sets
+			# charge sets that best span their variability become replicates
+			# the charge set of each conformer is saved as soon as it is charged,
+			# under a key of its own as the molecule's name records replicates
+			conformers_key = f'{offmol_orig.name}/conformers'
+			charge_sets = run_manifest.load_sets(conformers_key) if run_manifest is not None else {}
+			for idx, ligand in enumerate(ligands):
+				if idx in charge_sets:
+					continue
+				chg_lig = gen_charges_smc(toolkit_wrapper, charge_method, ligand, offmol_orig, charge_cache)
+				charge_sets[idx] = get_charges_array(chg_lig.to_openff())
+				if run_manifest is not None:
+					run_manifest.save_set(conformers_key, idx, charge_sets[idx])
+			charge_matrix = np.column_stack([charge_sets[idx] for idx in range(len(ligands))])
+			selected, weights, labels = select_representative_sets(charge_matrix, num_representative_sets, selection_method)
+
+			# replicate r is the charge set of conformer selected[r], standing
+			# in for the conformers in members, a weight fraction of all of them
+			write_table_csv(
+				parent_outdir / 'representative_charge_sets.csv',
+				['replicate', 'conformer', 'weight', 'members'],
+				[
+					[rpt, conf, weight, ' '.join(str(m) for m in np.flatnonzero(labels == rpt))]
+					for rpt, (conf, weight) in enumerate(zip(selected.tolist(), weights.tolist()))
+				],
+			)
+
+			for rpt in range(len(selected)):
+				if rpt not in completed_rpts:
+					export_replicate(rpt, get_charged_smc(offmol_orig, charge_matrix[:, selected[rpt]]))
+
+		if run_manifest is not None:
+			run_manifest.mark_done(offmol_orig.name)
 
 
 
@@ -8,7 +8,20 @@ Instructions:
 	* modify the variables below within the EDIT THESE VARIABLES blocks below
 '''
 
-from utils import *
+import openfe
+from openff.toolkit import Molecule
+from openeye import oechem
+from rdkit import Chem
+
+from conformers import get_mols_from_random_confs
+from charging import check_provided_charge_type, get_toolkit_wrapper, gen_charges_smc
+from network import get_ahfe_settings, create_transformations
+from charge_cache import ChargeCache
+from conformer_pool import ConformerPool
+from run_manifest import RunManifest
+from network_export import export_transformation
+import sys
+from pathlib import Path
 
 
 if __name__ == "__main__":
@@ -23,6 +36,34 @@ if __name__ == "__main__":
 	toolkit = 'openeye' 
 	charge_method = 'am1bccelf10'
 	output_path = '/Users/megosato/Desktop/testing'
+
+	# directory of the persistent charge cache, conformers charged in an
+	# earlier run are not charged again. None disables the cache
+	charge_cache_dir = None
+
+	# number of threads RDKit uses to embed conformers, 0 uses all cores
+	# the conformers generated for a seed do not depend on this
+	num_embed_threads = 1
+
+	# directory of the persistent conformer pool, conformers embedded for a
+	# seed in an earlier run are reused. None disables the pool
+	conformer_pool_dir = None
+
+	# file recording the molecules and replicates that have been finished,
+	# re-running the script with the same file only does the work that is 
+	# missing. None disables resuming
+	manifest_file = None
+
+	# True writes the shared protocol settings and solvent once and only the
+	# charged ligand per replicate (see network_export.py), 
+	# run `python network_export.py materialize <output_path>` to write the
+	# ahfe.json files openfe quickrun needs
+	compact_export = False
+
+	# OpenMM platform the simulations run on, 'CUDA' was used for our paper
+	# 'auto' picks the fastest platform of this machine and None lets openfe
+	# choose on the machine that runs the simulation
+	compute_platform = 'CUDA'
 	####################################
 	#### END   EDIT THESE VARIABLES ####
 	####################################
@@ -33,19 +74,30 @@ if __name__ == "__main__":
 		print("ERROR: Invalid toolkit and charge method pairing", file=sys.stderr)
 		sys.exit()
 	toolkit_wrapper = get_toolkit_wrapper(toolkit)
+	charge_cache = ChargeCache(charge_cache_dir) if charge_cache_dir is not None else None
+	conformer_pool = ConformerPool(conformer_pool_dir) if conformer_pool_dir is not None else None
+	run_manifest = RunManifest(manifest_file) if manifest_file is not None else None
 
 	all_rdmols = [mol for mol in Chem.SDMolSupplier(sdf_file, removeHs=False)]
 
 	for rdmol in all_rdmols:
 
 		offmol_orig = Molecule.from_rdkit(rdmol)	
-		charged_ligands = []	
-		for idx,seed in enumerate(SEEDS):
+		if run_manifest is not None and run_manifest.is_done(offmol_orig.name):
+			continue
+
+		# replicates finished by an earlier, interrupted run
+		completed_rpts = run_manifest.completed_sets(offmol_orig.name) if run_manifest is not None else set()
+		rpt_idxs = [idx for idx in range(len(SEEDS)) if idx not in completed_rpts]
+
+		settings = get_ahfe_settings(compute_platform)
+		for idx in rpt_idxs:
+			seed = SEEDS[idx]
 
 			print(seed)
 			# step 1
 			# generate conformers based off the random seed
-			rdmol_w_confs,_ = get_mols_from_random_confs(rdmol, num_confs, seed)
+			rdmol_w_confs,_ = get_mols_from_random_confs(rdmol, num_confs, seed, num_embed_threads, lazy=True, conformer_pool=conformer_pool)
 
 			# step 2
 			# Convert the rdkit molecule to an openeye molecule using openff
@@ -69,21 +121,21 @@ if __name__ == "__main__":
 
 			# step 4
 			# generate charges for small molecule component
-			chg_lig = gen_charges_smc(toolkit_wrapper, charge_method, smc, offmol_orig)
-			charged_ligands.append(chg_lig)
+			chg_lig = gen_charges_smc(toolkit_wrapper, charge_method, smc, offmol_orig, charge_cache)
 
-		# step 5
-		# Create openFE network for all FE clacs
-		settings = get_ahfe_settings()
-		network = create_network(settings, charged_ligands)
+			# step 5
+			# Create the openFE transformation for the FE calc of the charged ligand
+			transformation = create_transformations(settings, [chg_lig])[0]
 
+			# step 6
+			# write it to its replicate directory, the replicate is finished
+			# as soon as it is written so it is never charged again
+			export_transformation(transformation, parent_outdir / str(idx), output_path if compact_export else None)
+			if run_manifest is not None:
+				run_manifest.mark_set_done(offmol_orig.name, idx)
 
-		# step 6
-		# create the directory structure to run your calculations
-		for idx,transformation in enumerate(network.edges):
-			outdir = parent_outdir / str(idx)
-			outdir.mkdir(exist_ok=True)
-			transformation.dump(outdir / f"ahfe.json")
+		if run_manifest is not None:
+			run_manifest.mark_done(offmol_orig.name)
 
 
 
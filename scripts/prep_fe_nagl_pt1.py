@@ -2,7 +2,9 @@
 Part ONE of the script to prepare OpenFE Absolute Solvation Free Energies with WATER 
 as the solvent (in other words Absolute Hydration Free Energies) using:
 	* OpenFF NAGL charges
-This script generates the NAGL charges.
+This script generates the NAGL charges and saves the charges and starting 3D
+coordinates of every molecule to a single charge exchange file (see 
+charge_exchange.py) read by part TWO.
 It is necessary to do this in 2 steps as the OpenFE version used in the paper is not
 compatible with the OpenFF toolkit versions need to run NAGL charge generation.
 
@@ -11,8 +13,20 @@ Instructions:
 	* modify the variables below within the EDIT THESE VARIABLES blocks below
 '''
 
-from utils import * 
+import openfe
+from openff.toolkit import Molecule
+from openff.units import unit
+from openeye import oechem
+from rdkit import Chem
+
+from conformers import get_mols_from_random_confs
+from charging import check_provided_charge_type, get_toolkit_wrapper, gen_charges_smc
+from charge_cache import ChargeCache
+from run_manifest import RunManifest
+from nagl_batch import gen_nagl_charges_batched
+from charge_exchange import ChargeExchange, ChargeExchangeWriter, get_exchange_path, get_reference
 import sys
+from pathlib import Path
 
 SEED = 42
 
@@ -27,6 +41,25 @@ if __name__ == "__main__":
 	toolkit = 'nagl'
 	charge_method = 'openff-gnn-am1bcc-0.1.0-rc.1.pt'
 	output_path = '/Users/megosato/Desktop/testing'
+
+	# directory of the persistent charge cache, conformers charged in an
+	# earlier run are not charged again. None disables the cache
+	# Only used with nagl_batch_size = None, batched charging does not use it
+	charge_cache_dir = None
+
+	# file recording the molecules that have been finished, re-running the
+	# script with the same file only does the work that is missing. 
+	# None disables resuming
+	manifest_file = None
+
+	# number of molecules run through the NAGL model in each forward pass
+	# None charges the molecules one at a time through the NAGL toolkit wrapper
+	nagl_batch_size = 64
+
+	# how the charged molecules are saved for part TWO: 'exchange' writes one
+	# charge exchange file for the whole dataset, 'mol2' one charged.mol2 per
+	# molecule
+	output_formats = ['exchange']
 	####################################
 	#### END   EDIT THESE VARIABLES ####
 	####################################
@@ -36,14 +69,55 @@ if __name__ == "__main__":
 	if not check_provided_charge_type(toolkit, charge_method):
 		print("ERROR: Invalid toolkit and charge method pairing", file=sys.stderr)
 		sys.exit()
-	toolkit_wrapper = get_toolkit_wrapper(toolkit)
+	# batched charging loads the NAGL model itself and does not use the cache
+	if nagl_batch_size is not None and charge_cache_dir is not None:
+		print("ERROR: charge_cache_dir requires nagl_batch_size = None", file=sys.stderr)
+		sys.exit()
+	toolkit_wrapper = get_toolkit_wrapper(toolkit) if nagl_batch_size is None else None
+	charge_cache = ChargeCache(charge_cache_dir) if charge_cache_dir is not None else None
+	run_manifest = RunManifest(manifest_file) if manifest_file is not None else None
 
 	all_rdmols = [mol for mol in Chem.SDMolSupplier(sdf_file, removeHs=False)]
 
+	exchange_writer = None
+	previous_exchange = None
+	if 'exchange' in output_formats:
+		exchange_path = get_exchange_path(output_path, toolkit, charge_method)
+		# molecules finished in an earlier run are copied from its exchange file
+		if exchange_path.exists():
+			previous_exchange = ChargeExchange(exchange_path)
+		exchange_writer = ChargeExchangeWriter(exchange_path, {'toolkit': toolkit, 'charge_method': charge_method})
+
+	# names of the molecules charged in this run
+	charged_names = []
+
+	def save_charged(offmol_chg, outdir):
+		# step 5 
+		# save out molecule with partial charges and starting 3D coordinates
+		if exchange_writer is not None:
+			name, mapped_smiles, coordinates = get_reference(offmol_chg)
+			exchange_writer.write(name, mapped_smiles, offmol_chg.partial_charges.m_as(unit.elementary_charge), coordinates)
+		if 'mol2' in output_formats:
+			offmol_chg.to_file(f'{outdir}/charged.mol2', file_format='mol2')
+		charged_names.append(offmol_chg.name)
+		# the exchange file is only complete once it is closed
+		if run_manifest is not None and exchange_writer is None:
+			run_manifest.mark_done(offmol_chg.name)
+
+	# molecules waiting to be charged in a batch, as 
+	# (original Molecule, Molecule to charge, output directory)
+	batch_jobs = []
 
 	for rdmol in all_rdmols:
 
 		offmol_orig = Molecule.from_rdkit(rdmol)
+		if run_manifest is not None and run_manifest.is_done(offmol_orig.name):
+			if exchange_writer is None or previous_exchange is None or offmol_orig.name not in previous_exchange:
+				continue
+			if previous_exchange.mapped_smiles(offmol_orig.name) == offmol_orig.to_smiles(mapped=True):
+				exchange_writer.copy(previous_exchange, offmol_orig.name)
+				continue
+			# a molecule that changed since it was charged is charged again
 
 		# step 1
 		# generate conformers based off the random seed
@@ -69,16 +143,33 @@ if __name__ == "__main__":
 		# Generate the small molecule component for the openFE simulation 
 		smc = openfe.SmallMoleculeComponent.from_rdkit(rdmol_w_confs)
 
-		# step 4
-		# generate charges for each small molecule component
-		chg_mol = gen_charges_smc(toolkit_wrapper, charge_method, smc, offmol_orig)
-		offmol_chg = chg_mol.to_openff()
-
-		# step 5 
-		# save out molecule as a mol2 file with partial charges and starting 
-		# 3D coordinates
 		outdir = parent_outdir 
 		outdir.mkdir(exist_ok=True)
-		offmol_chg.to_file(f'{outdir}/charged.mol2', file_format='mol2')
 
-		break
\ No newline at end of file
+		if nagl_batch_size is not None:
+			# charged together with the other molecules after this loop
+			batch_jobs.append((offmol_orig, smc.to_openff(), outdir))
+			continue
+
+		# step 4
+		# generate charges for each small molecule component
+		chg_mol = gen_charges_smc(toolkit_wrapper, charge_method, smc, offmol_orig, charge_cache)
+		save_charged(chg_mol.to_openff(), outdir)
+
+	if batch_jobs:
+		# step 4
+		# generate charges for every molecule, loading the NAGL model once and
+		# charging nagl_batch_size molecules per forward pass
+		all_charges = gen_nagl_charges_batched(charge_method, [offmol for _, offmol, _ in batch_jobs], nagl_batch_size)
+
+		for (offmol_orig, _, outdir), charges in zip(batch_jobs, all_charges):
+			offmol_chg = Molecule(offmol_orig)
+			offmol_chg.partial_charges = charges * unit.elementary_charge
+			save_charged(offmol_chg, outdir)
+
+	if exchange_writer is not None:
+		exchange_writer.close()
+		print(exchange_writer.path)
+		if run_manifest is not None:
+			for name in charged_names:
+				run_manifest.mark_done(name)
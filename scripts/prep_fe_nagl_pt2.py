@@ -4,6 +4,9 @@ as the solvent (in other words Absolute Hydration Free Energies) using:
 	* OpenFF NAGL charges
 This script takes the NAGL charges generated in PART ONE and creates OpenFE input
 files with them
+With nagl_command set, this script instead generates the NAGL charges itself by
+running nagl_batch.py in the nagl.yaml environment as a subprocess, so PART ONE
+does not need to be run.
 It is necessary to do this in 2 steps as the OpenFE version used in the paper is not
 compatible with the OpenFF toolkit versions need to run NAGL charge generation.
 
@@ -12,8 +15,16 @@ Instructions:
 	* modify the variables below within the EDIT THESE VARIABLES blocks below
 '''
 
-from utils import * 
-import json
+import openfe
+from openff.toolkit import Molecule
+from rdkit import Chem
+
+from network import get_ahfe_settings, create_network
+from run_manifest import RunManifest
+from network_export import export_transformations
+from charge_exchange import ChargeExchange, ChargeExchangeWriter, NAGLSubprocess, get_exchange_path, get_reference
+import shutil
+from pathlib import Path
 
 SEED = 42
 
@@ -28,19 +39,96 @@ if __name__ == "__main__":
 	num_rpts = 5
 	input_path = '/Users/megosato/Desktop/testing'
 	output_path = '/Users/megosato/Desktop/testing'
+	toolkit = 'nagl'
+	charge_method = 'openff-gnn-am1bcc-0.1.0-rc.1.pt'
+
+	# how PART ONE saved the charged molecules under input_path: 'exchange' for
+	# the charge exchange file, 'mol2' for one charged.mol2 per molecule
+	input_format = 'exchange'
+
+	# command starting nagl_batch.py in the nagl.yaml environment, e.g.
+	# ['conda', 'run', '--no-capture-output', '-n', 'nagl', 'python', 'nagl_batch.py', 'serve']
+	# The molecules missing from the exchange file under input_path are all 
+	# sent to it in one request and charged nagl_batch_size per forward pass.
+	# None reads the exchange file written by PART ONE
+	nagl_command = None
+	nagl_batch_size = 64
+
+	# file recording the molecules that have been finished, re-running the
+	# script with the same file only does the work that is missing. 
+	# None disables resuming
+	manifest_file = None
+
+	# True writes the shared protocol settings and solvent once and only the
+	# charged ligand per replicate (see network_export.py), 
+	# run `python network_export.py materialize <output_path>` to write the
+	# ahfe.json files openfe quickrun needs
+	compact_export = False
+
+	# OpenMM platform the simulations run on, 'CUDA' was used for our paper
+	# 'auto' picks the fastest platform of this machine and None lets openfe
+	# choose on the machine that runs the simulation
+	compute_platform = 'CUDA'
 	####################################
 	#### END   EDIT THESE VARIABLES ####
 	####################################
 
+	run_manifest = RunManifest(manifest_file) if manifest_file is not None else None
+
 	all_rdmols = [mol for mol in Chem.SDMolSupplier(sdf_file, removeHs=False)]
 
+	exchange = None
+	if input_format == 'exchange':
+		exchange_path = get_exchange_path(input_path, toolkit, charge_method)
+
+		if nagl_command is not None:
+			# step 0
+			# generate the NAGL charges of the molecules missing from the
+			# exchange file in the nagl.yaml environment and add them to it
+			previous_exchange = ChargeExchange(exchange_path) if exchange_path.exists() else None
+			# (name, mapped SMILES, coordinates) of the molecules to write and
+			# the names and mapped SMILES of the ones to charge
+			references, missing, missing_smiles = [], [], []
+			for rdmol in all_rdmols:
+				name, mapped_smiles, coordinates = get_reference(Molecule.from_rdkit(rdmol))
+				in_previous = previous_exchange is not None and name in previous_exchange
+				if in_previous and previous_exchange.mapped_smiles(name) == mapped_smiles:
+					references.append((name, mapped_smiles, coordinates))
+				# a molecule that changed since it was charged is charged again
+				# even if it is finished, so its stale charges are not kept
+				elif in_previous or run_manifest is None or not run_manifest.is_done(name):
+					references.append((name, mapped_smiles, coordinates))
+					missing.append(name)
+					missing_smiles.append(mapped_smiles)
+
+			if missing:
+				with NAGLSubprocess(nagl_command) as nagl_process:
+					charges_by_name = dict(zip(missing, nagl_process.charge(charge_method, missing_smiles, nagl_batch_size)))
+
+				with ChargeExchangeWriter(exchange_path, {'toolkit': toolkit, 'charge_method': charge_method}) as exchange_writer:
+					for name, mapped_smiles, coordinates in references:
+						if name in charges_by_name:
+							exchange_writer.write(name, mapped_smiles, charges_by_name[name], coordinates)
+						else:
+							exchange_writer.copy(previous_exchange, name)
+				print(f"{len(missing)} molecules charged, {exchange_path}")
+
 	for rdmol in all_rdmols:
 		molname = rdmol.GetProp('_Name')
+		if run_manifest is not None and run_manifest.is_done(molname):
+			continue
 
 		# step 1
-		# Load in the .mol2 file with partial charges from NAGL and the original
-		# 3D coordinates
-		offmol_chg = Molecule.from_file(f'{input_path}/{molname}/charged.mol2')
+		# Load in the partial charges from NAGL and the original 3D coordinates,
+		# from the memory-mapped exchange file or the .mol2 file
+		if input_format == 'exchange':
+			# opened by the first molecule that needs it, a run with every
+			# molecule finished does not need the file to exist
+			if exchange is None:
+				exchange = ChargeExchange(exchange_path)
+			offmol_chg = exchange.to_openff(molname)
+		else:
+			offmol_chg = Molecule.from_file(f'{input_path}/{molname}/charged.mol2')
 		print(offmol_chg.partial_charges)
 
 		# step 2
@@ -49,7 +137,7 @@ if __name__ == "__main__":
 
 		# # step 3
 		# # Create openFE network for all FE clacs
-		settings = get_ahfe_settings()
+		settings = get_ahfe_settings(compute_platform)
 		network = create_network(settings, [smc])
 
 		# step 4
@@ -57,18 +145,20 @@ if __name__ == "__main__":
 		parent_outdir = Path(f"{output_path}/{molname}")
 		parent_outdir.mkdir(exist_ok=True,parents=True)
 
+		# NAGL charges are conformer independent so every replicate is the same
+		# single transformation, it is serialized once and copied to the others
 		transformation = [e for e in network.edges][0]
-		for rpt in range(num_rpts):
-			outdir = parent_outdir / str(rpt)
-			outdir.mkdir(exist_ok=True)
-			transformation.dump(outdir / f"ahfe.json")
-
-		break
-
-
-
-
-
-
-
-	
\ No newline at end of file
+		if compact_export:
+			outdirs = [parent_outdir / str(rpt) for rpt in range(num_rpts)]
+			export_transformations([transformation] * num_rpts, outdirs, output_path)
+		else:
+			for rpt in range(num_rpts):
+				outdir = parent_outdir / str(rpt)
+				outdir.mkdir(exist_ok=True)
+				if rpt == 0:
+					transformation.dump(outdir / f"ahfe.json")
+				else:
+					shutil.copyfile(parent_outdir / '0' / 'ahfe.json', outdir / 'ahfe.json')
+
+		if run_manifest is not None:
+			run_manifest.mark_done(molname)
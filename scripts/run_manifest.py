@@ -0,0 +1,101 @@
+'''
+Run manifest recording which molecules, and which partial charge sets (or
+replicates) within a molecule, a script has finished, so an interrupted run
+can be restarted and only do the missing work.
+
+The manifest is a journal with one JSON record per line that is appended to
+and flushed as each piece of work finishes, so a crash can at worst lose the
+record being written. The partial charges of the charge sets of molecules
+that are not finished are kept next to it in {manifest}.partial/ until the
+molecule is done.
+'''
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+
+class RunManifest:
+	''' Journal of the work completed by a run, see module docstring
+
+		path: 				str or Path of the manifest file, created if missing
+	'''
+
+	def __init__(self, path):
+		self.path = Path(path)
+		self.path.parent.mkdir(exist_ok=True, parents=True)
+		self.partial_dir = self.path.with_name(f'{self.path.name}.partial')
+
+		self._done = set()
+		self._sets = {}
+		if self.path.exists():
+			self._replay()
+
+	def _replay(self):
+		with open(self.path) as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except json.JSONDecodeError:
+					# a record cut short by a crash, the work it describes is redone
+					continue
+				if record.get('done'):
+					self._done.add(record['name'])
+				else:
+					self._sets.setdefault(record['name'], set()).add(record['set'])
+
+	def _append(self, record):
+		with open(self.path, 'a') as f:
+			f.write(json.dumps(record) + '\n')
+			f.flush()
+			os.fsync(f.fileno())
+
+	def is_done(self, name):
+		''' returns True if molecule name has been marked done
+		'''
+		return name in self._done
+
+	def mark_done(self, name):
+		''' marks molecule name as done and removes its saved partial charge sets
+		'''
+		self._append({'name': name, 'done': True})
+		self._done.add(name)
+		shutil.rmtree(self.partial_dir / name, ignore_errors=True)
+
+	def completed_sets(self, name):
+		''' returns the set of charge set (or replicate) indices of molecule name
+			that have been marked done
+		'''
+		return set(self._sets.get(name, set()))
+
+	def mark_set_done(self, name, set_idx):
+		''' marks charge set (or replicate) set_idx of molecule name as done
+		'''
+		self._append({'name': name, 'set': int(set_idx)})
+		self._sets.setdefault(name, set()).add(int(set_idx))
+
+	def save_set(self, name, set_idx, charges):
+		''' saves the partial charges of charge set set_idx of molecule name
+			and marks the set as done
+		'''
+		mol_dir = self.partial_dir / name
+		mol_dir.mkdir(exist_ok=True, parents=True)
+		tmp_path = mol_dir / f'{set_idx}.tmp.npy'
+		np.save(tmp_path, np.asarray(charges, dtype=np.float64))
+		os.replace(tmp_path, mol_dir / f'{set_idx}.npy')
+		self.mark_set_done(name, set_idx)
+
+	def load_sets(self, name):
+		''' returns a dictionary of the saved partial charges of molecule name
+			by charge set index
+		'''
+		sets = {}
+		for set_idx in self.completed_sets(name):
+			try:
+				sets[set_idx] = np.load(self.partial_dir / name / f'{set_idx}.npy')
+			except FileNotFoundError:
+				continue
+		return sets
@@ -0,0 +1,222 @@
+'''
+Script to run the absolute hydration free energy calculations of a start
+files tree (e.g. ../simulations/start_files) on a local workstation without
+SLURM, using `openfe quickrun`.
+
+Every replicate directory with an ahfe.json (or an ahfe.delta.json from
+compact_export, see network_export.py) is a job. Jobs are run max_jobs at a
+time, each pinned to its own threads_per_job CPU cores (and one of gpu_ids if
+given), writing to {replicate}/output/ like run_openfe.sh does. The state of
+every job is saved to state_file as it changes, so re-running the script skips
+the jobs that finished and re-runs the ones that failed or were interrupted.
+
+Instructions:
+	* Run with conda environment created from openfe.yaml
+	* modify the variables below within the EDIT THESE VARIABLES blocks below
+'''
+
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from network import get_compute_platform
+from network_export import DELTA_FILE, FULL_FILE, materialize
+
+# ahfe.json with the compute platform set by this script, written next to the original
+LOCAL_FILE = 'ahfe.local.json'
+OUTPUT_DIR = 'output'
+OUTPUT_FILE = 'output.json'
+LOG_FILE = 'quickrun.log'
+
+# environment variables limiting the threads of each job
+THREAD_ENV_VARS = ['OPENMM_CPU_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+def find_jobs(start_files_dir):
+	''' returns the sorted replicate directories under start_files_dir that
+		have an ahfe.json or an ahfe.delta.json
+	'''
+	start_files_dir = Path(start_files_dir)
+	job_dirs = {path.parent for path in start_files_dir.rglob(FULL_FILE)}
+	job_dirs |= {path.parent for path in start_files_dir.rglob(DELTA_FILE)}
+	return sorted(job_dirs)
+
+def is_complete(job_dir):
+	return (Path(job_dir) / OUTPUT_DIR / OUTPUT_FILE).exists()
+
+def prepare_input(job_dir, compute_platform):
+	''' returns the path of the transformation json quickrun should run for
+		job_dir, writing the full ahfe.json of compact exports first and a copy
+		with compute_platform set if it is not None
+	'''
+	job_dir = Path(job_dir)
+	input_path = job_dir / FULL_FILE
+	if not input_path.exists():
+		materialize(job_dir / DELTA_FILE)
+
+	if compute_platform is None:
+		return input_path
+
+	with open(input_path) as f:
+		tdict = json.load(f)
+	settings = tdict['protocol']['settings']
+	for engine_settings in ['solvent_engine_settings', 'vacuum_engine_settings']:
+		settings[engine_settings]['compute_platform'] = compute_platform
+
+	local_path = job_dir / LOCAL_FILE
+	with open(local_path, 'w') as f:
+		json.dump(tdict, f)
+	return local_path
+
+def get_slots(max_jobs, threads_per_job, gpu_ids=None):
+	''' returns a list of (cores, gpu_id) job slots, each a disjoint set of
+		threads_per_job of the CPU cores this process may run on and, if gpu_ids
+		is given, one of them. At most max_jobs slots are made
+	'''
+	cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+	num_slots = min(max_jobs, max(1, len(cores) // threads_per_job))
+	if gpu_ids:
+		num_slots = min(num_slots, len(gpu_ids))
+
+	return [
+		(set(cores[i * threads_per_job:(i + 1) * threads_per_job]), gpu_ids[i] if gpu_ids else None)
+		for i in range(num_slots)
+	]
+
+def start_job(job_dir, input_path, slot, threads_per_job, quickrun_command):
+	''' starts openfe quickrun for job_dir in the background on the cores and
+		GPU of slot and returns the Popen object
+	'''
+	cores, gpu_id = slot
+	output_dir = Path(job_dir) / OUTPUT_DIR
+	output_dir.mkdir(exist_ok=True)
+
+	env = dict(os.environ)
+	env.update({var: str(threads_per_job) for var in THREAD_ENV_VARS})
+	if gpu_id is not None:
+		env['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
+
+	preexec_fn = None
+	if hasattr(os, 'sched_setaffinity'):
+		preexec_fn = lambda: os.sched_setaffinity(0, cores)
+
+	with open(output_dir / LOG_FILE, 'a') as log:
+		return subprocess.Popen(
+			quickrun_command + [input_path.name, '-d', OUTPUT_DIR, '-o', f'{OUTPUT_DIR}/{OUTPUT_FILE}'],
+			cwd=job_dir, env=env, stdout=log, stderr=subprocess.STDOUT, preexec_fn=preexec_fn,
+		)
+
+def load_state(state_file):
+	try:
+		with open(state_file) as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return {}
+
+def save_state(state_file, state):
+	tmp_path = Path(f'{state_file}.tmp')
+	with open(tmp_path, 'w') as f:
+		json.dump(state, f, indent=1)
+	os.replace(tmp_path, state_file)
+
+def _now():
+	return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+if __name__ == "__main__":
+
+	####################################
+	#### START EDIT THESE VARIABLES ####
+	####################################
+	start_files_dir = '../simulations/start_files'
+
+	# maximum number of simulations run at the same time
+	max_jobs = 4
+	# CPU cores (and threads) given to each simulation
+	threads_per_job = 4
+	# GPUs to spread the simulations over, one per running simulation, e.g.
+	# [0, 1]. None does not restrict the GPUs a simulation can see
+	gpu_ids = None
+
+	# OpenMM platform to run on, overriding the one in the start files:
+	# 'auto' picks the fastest platform of this machine, so the same start
+	# files run on CPU-only machines, None keeps the platform of the files
+	compute_platform = 'auto'
+
+	# file saving the state of each job, re-running with the same file skips
+	# the jobs that finished
+	state_file = '../simulations/quickrun_state.json'
+	# False skips the jobs that failed in an earlier run instead of re-running them
+	retry_failed = True
+
+	quickrun_command = ['openfe', 'quickrun']
+	####################################
+	#### END   EDIT THESE VARIABLES ####
+	####################################
+
+	if compute_platform == 'auto':
+		compute_platform = get_compute_platform()
+		print(f"compute platform: {compute_platform}")
+
+	state = load_state(state_file)
+
+	pending = []
+	for job_dir in find_jobs(start_files_dir):
+		job_state = state.get(str(job_dir), {})
+		if is_complete(job_dir):
+			if job_state.get('status') != 'done':
+				state[str(job_dir)] = {**job_state, 'status': 'done'}
+			continue
+		if job_state.get('status') == 'failed' and not retry_failed:
+			continue
+		pending.append(job_dir)
+	save_state(state_file, state)
+
+	slots = get_slots(max_jobs, threads_per_job, gpu_ids)
+	print(f"{len(pending)} jobs to run, {len(slots)} at a time")
+
+	# running jobs as {slot index: (job directory, Popen, start time)}
+	running = {}
+	failed = 0
+	while pending or running:
+		for i, slot in enumerate(slots):
+			if i in running or not pending:
+				continue
+			job_dir = pending.pop(0)
+			try:
+				input_path = prepare_input(job_dir, compute_platform)
+				process = start_job(job_dir, input_path, slot, threads_per_job, quickrun_command)
+			except Exception as e:
+				print(f"ERROR: could not start {job_dir}: {e}", file=sys.stderr)
+				state[str(job_dir)] = {'status': 'failed', 'error': str(e), 'end': _now()}
+				failed += 1
+				continue
+			running[i] = (job_dir, process, time.monotonic())
+			state[str(job_dir)] = {'status': 'running', 'start': _now(), 'cores': sorted(slot[0]), 'gpu': slot[1]}
+			print(f"started  {job_dir}")
+		save_state(state_file, state)
+
+		time.sleep(1)
+
+		for i, (job_dir, process, start) in list(running.items()):
+			returncode = process.poll()
+			if returncode is None:
+				continue
+			del running[i]
+
+			status = 'done' if returncode == 0 and is_complete(job_dir) else 'failed'
+			failed += status == 'failed'
+			state[str(job_dir)].update({
+				'status': status,
+				'returncode': returncode,
+				'end': _now(),
+				'elapsed_s': round(time.monotonic() - start, 1),
+			})
+			print(f"{status:<8} {job_dir}")
+		save_state(state_file, state)
+
+	print(f"finished, {failed} jobs failed")
@@ -0,0 +1,222 @@
+'''
+Optional timing and tracing of the stages of the charging pipeline (conformer
+embedding, toolkit conversions, charging, record keeping and output writes).
+
+Tracing is off unless enable is called, or the CHARGE_TRACE_DIR environment
+variable is set, and span then returns a shared do-nothing context manager.
+When it is on, each process (including charging workers, which inherit the
+environment variable) records one event per span with its duration and the
+peak resident memory of the process and writes them to
+{trace_dir}/events_{pid}.jsonl. write_chrome_trace merges them into a trace
+for chrome://tracing or Perfetto and write_summary into csv tables of the
+time spent in each stage and by each molecule.
+'''
+
+import contextlib
+import json
+import multiprocessing.util
+import os
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+
+from charge_analysis import write_table_csv
+
+TRACE_DIR_ENV = 'CHARGE_TRACE_DIR'
+
+# number of events a process keeps in memory before appending them to its file
+FLUSH_EVERY = 1000
+
+_ENABLED = bool(os.environ.get(TRACE_DIR_ENV))
+_TRACER = None
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def _max_rss_mb():
+	''' returns the peak resident memory of this process in MB
+	'''
+	max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kB on Linux, bytes on macOS
+	return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+class _Tracer:
+	''' Buffer of the events recorded by one process
+	'''
+
+	def __init__(self, trace_dir):
+		self.pid = os.getpid()
+		self.path = Path(trace_dir) / f'events_{self.pid}.jsonl'
+		self.path.parent.mkdir(exist_ok=True, parents=True)
+		self.events = []
+		self.lock = threading.Lock()
+		# run on exit by multiprocessing, in worker processes as well as the main one
+		multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+	def record(self, event):
+		with self.lock:
+			self.events.append(event)
+			if len(self.events) >= FLUSH_EVERY:
+				self._flush()
+
+	def _flush(self):
+		if self.events:
+			with open(self.path, 'a') as f:
+				f.writelines(json.dumps(event) + '\n' for event in self.events)
+			self.events = []
+
+	def flush(self):
+		with self.lock:
+			self._flush()
+
+
+class _Span:
+	''' Context manager recording one event for a stage
+	'''
+
+	__slots__ = ('tracer', 'stage', 'args', 'start')
+
+	def __init__(self, tracer, stage, args):
+		self.tracer = tracer
+		self.stage = stage
+		self.args = args
+
+	def __enter__(self):
+		self.start = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, *exc):
+		end = time.perf_counter_ns()
+		self.tracer.record({
+			'stage': self.stage,
+			'start_us': self.start / 1000,
+			'dur_us': (end - self.start) / 1000,
+			'pid': self.tracer.pid,
+			'tid': threading.get_ident(),
+			'max_rss_mb': _max_rss_mb(),
+			'args': self.args,
+		})
+		return False
+
+
+def _get_tracer():
+	''' returns the tracer of this process, making a new one in a forked child
+		so the events buffered by the parent are not written twice
+	'''
+	global _TRACER
+	if _TRACER is None or _TRACER.pid != os.getpid():
+		_TRACER = _Tracer(os.environ[TRACE_DIR_ENV])
+	return _TRACER
+
+def enable(trace_dir):
+	''' turns tracing on for this process and the processes it starts, writing
+		the events to trace_dir. Events left in trace_dir by an earlier run
+		are removed
+	'''
+	global _ENABLED
+	for path in Path(trace_dir).glob('events_*.jsonl'):
+		path.unlink()
+	os.environ[TRACE_DIR_ENV] = str(trace_dir)
+	_ENABLED = True
+
+def is_enabled():
+	return _ENABLED
+
+def span(stage, **args):
+	''' returns a context manager recording the time spent in stage, with args
+		(e.g. molecule=name) saved with the event, when tracing is enabled
+
+		with tracing.span('embed', molecule=name):
+			...
+	'''
+	if not _ENABLED:
+		return _NULL_SPAN
+	return _Span(_get_tracer(), stage, args)
+
+def flush():
+	''' writes the events recorded by this process so far to its file
+	'''
+	if _ENABLED:
+		_get_tracer().flush()
+
+def mol_name(rdmol):
+	''' returns the name of an rdkit Mol to save with its events, or None
+	'''
+	return rdmol.GetProp('_Name') if rdmol.HasProp('_Name') else None
+
+def load_events(trace_dir):
+	''' returns the events written to trace_dir by every process, by start time
+	'''
+	events = []
+	for path in sorted(Path(trace_dir).glob('events_*.jsonl')):
+		with open(path) as f:
+			events += [json.loads(line) for line in f]
+	return sorted(events, key=lambda event: event['start_us'])
+
+def write_chrome_trace(trace_dir, trace_file):
+	''' writes the events in trace_dir as a Chrome trace (JSON) to trace_file
+	'''
+	trace_events = [
+		{
+			'name': event['stage'],
+			'cat': 'charging',
+			'ph': 'X',
+			'ts': event['start_us'],
+			'dur': event['dur_us'],
+			'pid': event['pid'],
+			'tid': event['tid'],
+			'args': {**event['args'], 'max_rss_mb': event['max_rss_mb']},
+		}
+		for event in load_events(trace_dir)
+	]
+	with open(trace_file, 'w') as f:
+		json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+def summarize(trace_dir):
+	''' returns the header and rows of two tables of the events in trace_dir
+		* by stage: number of events, total, mean and max time (s) and the peak
+		  resident memory (MB) of the processes running it
+		* by molecule: total time (s) over every stage and the time in each
+		  stage, slowest molecule first
+	'''
+	events = load_events(trace_dir)
+	stages = sorted({event['stage'] for event in events})
+
+	by_stage = {stage: [] for stage in stages}
+	by_molecule = {}
+	for event in events:
+		by_stage[event['stage']].append(event)
+		molecule = event['args'].get('molecule')
+		if molecule is not None:
+			stage_times = by_molecule.setdefault(molecule, dict.fromkeys(stages, 0.0))
+			stage_times[event['stage']] += event['dur_us'] / 1e6
+
+	stage_header = ['stage', 'count', 'total_s', 'mean_s', 'max_s', 'max_rss_mb']
+	stage_rows = []
+	for stage, stage_events in by_stage.items():
+		durations = [event['dur_us'] / 1e6 for event in stage_events]
+		stage_rows.append([
+			stage, len(durations), sum(durations), sum(durations) / len(durations), max(durations),
+			max(event['max_rss_mb'] for event in stage_events),
+		])
+
+	molecule_header = ['molecule', 'total_s'] + [f'{stage}_s' for stage in stages]
+	molecule_rows = sorted(
+		([molecule, sum(stage_times.values())] + [stage_times[stage] for stage in stages] for molecule, stage_times in by_molecule.items()),
+		key=lambda row: row[1], reverse=True,
+	)
+	return (stage_header, stage_rows), (molecule_header, molecule_rows)
+
+def write_summary(trace_dir, csv_prefix):
+	''' writes the tables from summarize to {csv_prefix}_stages.csv and
+		{csv_prefix}_molecules.csv and prints the by stage table
+	'''
+	(stage_header, stage_rows), (molecule_header, molecule_rows) = summarize(trace_dir)
+	write_table_csv(f'{csv_prefix}_stages.csv', stage_header, stage_rows)
+	write_table_csv(f'{csv_prefix}_molecules.csv', molecule_header, molecule_rows)
+
+	print(f"{'stage':<16}{'count':>8}{'total (s)':>12}{'mean (s)':>12}{'max (s)':>12}{'max rss (MB)':>14}")
+	for stage, count, total, mean, maximum, max_rss in stage_rows:
+		print(f"{stage:<16}{count:>8}{total:>12.3f}{mean:>12.4f}{maximum:>12.4f}{max_rss:>14.1f}")